@@ -0,0 +1,179 @@
+"""Change feed of the client IPs the DNS servers should answer.
+
+Every write that changes the IP a service allows appends (seq, service_id, ip_address) to
+allowlist_changes in the same transaction; ip_address is NULL once the service allows no
+IP (expired or deleted). A DNS node bootstraps from snapshot(), which also says which seq
+it is current to, then applies changes(since) in seq order, keeping service_id -> ip and
+allowing the distinct IPs. Replaying a change twice is harmless.
+
+    python allowlist.py export PATH     # write a snapshot file (atomically)
+    python allowlist.py changes SINCE   # print the changes after SINCE
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import mysql.connector
+
+import db
+import queries
+
+logger = logging.getLogger(__name__)
+
+# Sequence numbers are handed out at INSERT but become visible at COMMIT, so a missing
+# seq may still appear; readers stop in front of one for up to this many seconds.
+GAP_WAIT = 10
+# The LIMIT of queries.ALLOWLIST_CHANGES_SINCE.
+PAGE_SIZE = 1000
+
+SNAPSHOT_SEQ = (
+    "SELECT COALESCE((SELECT MIN(seq) - 1 FROM allowlist_changes "
+    "WHERE created_at > NOW() - INTERVAL %s SECOND), (SELECT MAX(seq) FROM allowlist_changes), 0)"
+)
+SNAPSHOT_SERVICES = (
+    "SELECT service_id, ip_address FROM services "
+    "WHERE status = 'active' AND deleted = FALSE AND ip_address IS NOT NULL"
+)
+PRUNE_CHANGES = "DELETE FROM allowlist_changes WHERE created_at < NOW() - INTERVAL %s DAY AND seq < %s"
+
+
+def record(cursor, service_ids):
+    """Append the current allowed IP of each service; call inside the writing transaction."""
+    if service_ids:
+        cursor.execute(
+            "INSERT INTO allowlist_changes (service_id, ip_address) "
+            "SELECT service_id, IF(status = 'active' AND deleted = FALSE, ip_address, NULL) FROM services "
+            f"WHERE service_id IN ({', '.join(['%s'] * len(service_ids))})",
+            list(service_ids)
+        )
+
+
+def _set_ip(conn, ip, service_id, telegram_id):
+    conn.start_transaction()
+    try:
+        updated = queries.execute_in(conn, queries.SET_SERVICE_IP, ip, service_id, telegram_id)
+        if updated:
+            queries.execute_in(conn, queries.RECORD_ALLOWLIST_CHANGE, service_id)
+        conn.commit()
+        return updated
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+async def set_ip(ip, service_id, telegram_id):
+    """Register the client IP of a service; returns the number of services matched."""
+    return await db.run(_set_ip, ip, service_id, telegram_id)
+
+
+def _changes(conn, since):
+    low, high = queries.fetchall_in(conn, queries.ALLOWLIST_BOUNDS)[0]
+    if low is not None and since + 1 < low and since < high:
+        # The changes right after `since` were pruned; the caller has to bootstrap again.
+        return None
+    changes = []
+    for change in queries.fetchall_in(conn, queries.ALLOWLIST_CHANGES_SINCE, GAP_WAIT, since):
+        if change.seq != since + 1 and not change.settled:
+            break
+        changes.append((change.seq, change.service_id, change.ip_address))
+        since = change.seq
+    return changes
+
+
+async def changes(since):
+    """[(seq, service_id, ip or None)] after `since`, at most PAGE_SIZE; None if `since` is too old."""
+    return await db.run(_changes, since)
+
+
+def _snapshot(conn):
+    conn.start_transaction(consistent_snapshot=True, readonly=True)
+    cursor = conn.cursor()
+    try:
+        # Changes from the last GAP_WAIT seconds may belong to transactions this snapshot
+        # cannot see yet, so the reader is told to replay them.
+        cursor.execute(SNAPSHOT_SEQ, (GAP_WAIT,))
+        seq = cursor.fetchone()[0]
+        cursor.execute(SNAPSHOT_SERVICES)
+        services = cursor.fetchall()
+        conn.commit()
+        return seq, services
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+async def snapshot():
+    """(seq, [(service_id, ip)]) for every service that currently allows an IP."""
+    return await db.run(_snapshot)
+
+
+def prune(conn, retention_days):
+    """Delete changes older than retention_days, always keeping the newest one."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT MAX(seq) FROM allowlist_changes")
+        newest = cursor.fetchone()[0]
+        if newest is None:
+            return 0
+        cursor.execute(PRUNE_CHANGES, (retention_days, newest))
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def export(conn, path):
+    """Write a snapshot to path as JSON, replacing the file atomically."""
+    seq, services = _snapshot(conn)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".allowlist-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"seq": seq, "services": services}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return seq, len(services)
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Export the IP allowlist or read its change feed")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("export").add_argument("path")
+    commands.add_parser("changes").add_argument("since", type=int)
+    args = parser.parse_args()
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    db.init_pool()
+    conn = db.get_connection()
+    try:
+        if args.command == "export":
+            seq, count = export(conn, args.path)
+            print(f"Wrote {count} services at seq {seq} to {args.path}")
+        else:
+            rows = _changes(conn, args.since)
+            if rows is None:
+                print(f"Changes after {args.since} were pruned; export a new snapshot", file=sys.stderr)
+                sys.exit(2)
+            for row in rows:
+                print(json.dumps(row))
+    except mysql.connector.Error as e:
+        logger.error("Allowlist command %s failed: %s", args.command, e)
+        sys.exit(1)
+    finally:
+        conn.close()
+        db.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,54 @@
+import asyncio
 import logging
 import uuid
 import os
 import mysql.connector
-import requests
 import re
 import fcntl
 import sys
+import allowlist
+import broadcast
+import cluster
+import db
+import expiry
+import geoip
+import logsetup
+import membership
+import metrics
+import migrations
+import outbox
+import payments
+import persistence
+import queries
+import reports
+import screens
+import servicecache
+import snapshot
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 
+load_dotenv()
+
 # تنظیم لاگ‌گیری
+# Workers run side by side, each with its own file.
+logsetup.configure('bot.log', console=True, per_process=(os.getenv("BOT_MODE") or "polling").lower() == "worker")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("tornado.access").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-file_handler = logging.FileHandler('bot.log')
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
-
-load_dotenv()
 
 ADMIN_ID = os.getenv("ADMIN_ID", "1631919159")
 IPDNS1 = os.getenv("IPDNS1")
 IPDNS2 = os.getenv("IPDNS2")
+SCREENS = screens.build(IPDNS1, IPDNS2)
+ADMIN_SCREENS = screens.build(IPDNS1, IPDNS2, admin=True)
 SERVER_IP = "game.redexping.tech"
 CARD_NUMBER = "1234-5678-9012-3456"
+# With several workers only one of them should run the expiry sweep and resume broadcasts.
+RUN_JOBS = (os.getenv("BOT_RUN_JOBS") or "1") == "1"
+# How many of the oldest pending payments /approve_all approves in one transaction.
+PAYMENT_BATCH_SIZE = int(os.getenv("PAYMENT_BATCH_SIZE") or 50)
 
 def acquire_lock():
     lock_file = '/tmp/bot.lock'
@@ -40,31 +61,39 @@ def acquire_lock():
         logger.error("Another instance of the bot is already running")
         sys.exit(1)
 
-def get_db_connection():
+async def report_pool_stats(context: ContextTypes.DEFAULT_TYPE):
+    pruned = db.pool.prune_idle()
+    logger.info("DB pool stats: %s, pruned %s idle connections", db.pool.stats(), pruned)
+    logger.info("Outbox stats: %s", outbox.stats())
+    logger.info("Log records dropped: %s", logsetup.dropped())
+    logger.info("Top statements by DB time: %s", queries.stats(limit=5))
+    logger.info("Service cache stats: %s", servicecache.stats())
+    logger.info("Membership index stats: %s", membership.stats())
+
+async def expire_user_state(context: ContextTypes.DEFAULT_TYPE):
     try:
-        conn = mysql.connector.connect(
-            host=os.getenv("MYSQL_HOST", "127.0.0.1"),
-            port=3307,
-            user=os.getenv("MYSQL_USER", "root"),
-            password=os.getenv("MYSQL_PASSWORD"),
-            database="dnsbot",
-            autocommit=True
-        )
-        logger.debug("Successfully connected to database with autocommit=True")
-        return conn
-    except mysql.connector.Error as err:
-        logger.error(f"Database connection error: {err}")
-        return None
+        await context.application.persistence.expire(context.application)
+    except mysql.connector.Error as e:
+        logger.error("Error expiring conversation state: %s", e)
 
-def is_iranian_ip(ip):
+async def post_init(app: Application):
+    outbox.start(app.bot)
+    servicecache.start()
+    if not RUN_JOBS:
+        return
+    snapshot.start()
     try:
-        response = requests.get(f"https://ipapi.co/{ip}/json/")
-        data = response.json()
-        logger.debug(f"IP check response for {ip}: {data}")
-        return data.get("country_code") == "IR"
-    except requests.RequestException as e:
-        logger.error(f"Error checking IP with ipapi.co: {e}")
-        return False
+        resumed = await broadcast.resume(app.bot)
+        if resumed:
+            logger.info("Resumed %s unfinished broadcasts", resumed)
+    except mysql.connector.Error as e:
+        logger.error("Database error resuming broadcasts: %s", e)
+
+async def post_stop(app: Application):
+    await broadcast.stop()
+    await outbox.stop()
+    await servicecache.stop()
+    await snapshot.stop()
 
 def generate_random_name(telegram_id, username):
     base_name = username.lstrip('@') if username else f"user_{telegram_id}"
@@ -77,123 +106,87 @@ def escape_markdown_v2(text):
     special_chars = r'[_*[\]()~`>#+-=|{}.!]'
     return re.sub(special_chars, r'\\\g<0>', text)
 
-def check_expired_services(context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to check expired services: DB connection failed")
+async def notify_expired_test(service_id, telegram_id, name):
+    keyboard = [[InlineKeyboardButton("🛒 خرید سرویس جدید", callback_data="buy_new_service")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    outbox.send_message(
+        telegram_id,
+        outbox.PRIORITY_BULK,
+        text=f"🧪 سرویس تست شما ({name}) منقضی شد! ⏳ لطفاً برای ادامه، سرویس جدیدی خریداری کنید:",
+        reply_markup=reply_markup
+    )
+
+async def check_expired_services(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        report = await expiry.sweep(notify_expired_test)
+    except mysql.connector.Error as e:
+        logger.error("Error checking expired services: %s", e)
         return
+    snapshot.notify()
+    logger.info("Expiry sweep finished: %s", report)
+
+async def prune_allowlist_changes(context: ContextTypes.DEFAULT_TYPE):
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE services SET status = 'expired', ip_address = NULL WHERE expiry_date <= NOW() AND status = 'active' AND deleted = FALSE"
-        )
-        cursor.execute(
-            "DELETE FROM services WHERE status = 'expired' AND expiry_date <= %s AND deleted = FALSE AND is_test = FALSE",
-            (datetime.now() - timedelta(days=7),)
-        )
-        cursor.execute(
-            "SELECT service_id, telegram_id, name, is_test FROM services WHERE status = 'expired' AND deleted = FALSE"
-        )
-        expired_services = cursor.fetchall()
-        for service_id, telegram_id, name, is_test in expired_services:
-            if is_test:
-                keyboard = [[InlineKeyboardButton("🛒 خرید سرویس جدید", callback_data="buy_new_service")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                context.bot.send_message(
-                    chat_id=telegram_id,
-                    text=f"🧪 سرویس تست شما ({name}) منقضی شد! ⏳ لطفاً برای ادامه، سرویس جدیدی خریداری کنید:",
-                    reply_markup=reply_markup
-                )
-            logger.debug(f"Expired service {service_id} for user {telegram_id}")
-        logger.debug(f"Checked expired services, found {len(expired_services)}")
+        deleted = await db.run(allowlist.prune, int(os.getenv("ALLOWLIST_RETENTION_DAYS") or 7))
     except mysql.connector.Error as e:
-        logger.error(f"Error checking expired services: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+        logger.error("Error pruning allowlist changes: %s", e)
+        return
+    logger.info("Pruned %s allowlist changes", deleted)
+
+async def reconcile_membership(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await membership.reload()
+    except mysql.connector.Error as e:
+        logger.error("Error loading users into the membership index: %s", e)
+
+async def is_blocked(user_id):
+    blocked = membership.is_blocked(user_id)
+    if blocked is None:
+        user = await queries.fetchone(queries.USER, user_id)
+        blocked = bool(user and user.blocked)
+        membership.remember(user_id, user is not None, blocked)
+    return blocked
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    logger.debug(f"User {user_id} started the bot")
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("INSERT IGNORE INTO users (telegram_id) VALUES (%s)", (user_id,))
-            logger.debug(f"User {user_id} added to database")
-        except mysql.connector.Error as e:
-            logger.error(f"Database error in start: {e}")
-        finally:
-            cursor.close()
-            conn.close()
-    keyboard = [
-        [InlineKeyboardButton("📋 سرویس‌های من", callback_data="my_services")],
-        [InlineKeyboardButton("🛒 خرید سرویس جدید", callback_data="buy_new_service")],
-        [InlineKeyboardButton("🧪 تست رایگان", callback_data="get_test")],
-        [InlineKeyboardButton("🌐 تنظیمات DNS", callback_data="dns_servers")],
-        [InlineKeyboardButton("📚 آموزش‌ها", callback_data="tutorials")],
-        [InlineKeyboardButton("❓ سوالات متداول", callback_data="faq")]
-    ]
-    if user_id == ADMIN_ID:
-        keyboard.append([InlineKeyboardButton("📊 آمار کاربران", callback_data="stats")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    logger.debug("User %s started the bot", user_id)
+    try:
+        if not membership.is_known(user_id):
+            await queries.execute(queries.ADD_USER, user_id)
+            membership.add(user_id)
+            logger.debug("User %s added to database", user_id)
+    except mysql.connector.Error as e:
+        logger.error("Database error in start: %s", e)
+    screen = (ADMIN_SCREENS if user_id == ADMIN_ID else SCREENS)["main_menu"]
     await update.message.reply_text(
-        text="•.¸♡ به ربات ردکس گیم خوش اومدی ♡¸.•\n🚀 با DNS اختصاصی ما از بازی کردن لذت ببر 🚀",
-        reply_markup=reply_markup,
+        text=screens.WELCOME_TEXT,
+        reply_markup=screen.reply_markup,
         reply_to_message_id=update.message.message_id
     )
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await start(update, context)
 
-async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_screen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = str(query.from_user.id)
-    logger.debug(f"User {user_id} accessed main_menu")
-    keyboard = [
-        [InlineKeyboardButton("📋 سرویس‌های من", callback_data="my_services")],
-        [InlineKeyboardButton("🛒 خرید سرویس جدید", callback_data="buy_new_service")],
-        [InlineKeyboardButton("🧪 تست رایگان", callback_data="get_test")],
-        [InlineKeyboardButton("🌐 تنظیمات DNS", callback_data="dns_servers")],
-        [InlineKeyboardButton("📚 آموزش‌ها", callback_data="tutorials")],
-        [InlineKeyboardButton("❓ سوالات متداول", callback_data="faq")]
-    ]
-    if user_id == ADMIN_ID:
-        keyboard.append([InlineKeyboardButton("📊 آمار کاربران", callback_data="stats")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    logger.debug("User %s accessed %s", user_id, query.data)
+    screen = (ADMIN_SCREENS if user_id == ADMIN_ID else SCREENS)[query.data]
     try:
-        await query.message.edit_text(
-            text="•.¸♡ به ربات ردکس گیم خوش اومدی ♡¸.•\nلطفاً گزینه مورد نظر خود را انتخاب کنید: 🚀",
-            reply_markup=reply_markup
-        )
+        await query.message.edit_text(text=screen.text, reply_markup=screen.reply_markup)
     except Exception as e:
-        logger.error(f"Error editing main_menu: {e}")
-        await query.message.reply_text(
-            text="•.¸♡ به ربات ردکس گیم خوش اومدی ♡¸.•\nلطفاً گزینه مورد نظر خود را انتخاب کنید: 🚀",
-            reply_markup=reply_markup
-        )
+        logger.error("Error editing %s: %s", query.data, e)
+        await query.message.reply_text(text=screen.text, reply_markup=screen.reply_markup)
 
 async def my_services(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = str(query.from_user.id)
-    logger.debug(f"User {user_id} accessed my_services")
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in my_services")
-        await query.message.edit_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
+    logger.debug("User %s accessed my_services", user_id)
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT service_id, name, status, is_test FROM services WHERE telegram_id = %s AND deleted = FALSE",
-            (user_id,)
-        )
-        services = cursor.fetchall()
-        logger.debug(f"Found {len(services)} services for user {user_id}: {services}")
+        services = await servicecache.user_services(user_id)
+        logger.debug("Found %s services for user %s", len(services), user_id)
         if not services:
             keyboard = [
                 [InlineKeyboardButton("🛒 خرید سرویس جدید", callback_data="buy_new_service")],
@@ -206,8 +199,11 @@ async def my_services(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         keyboard = [
-            [InlineKeyboardButton(f"{name} {'🧪' if is_test else ''} {'✅' if status == 'active' else '⏳'}", callback_data=f"service_info_{service_id}")]
-            for service_id, name, status, is_test in services
+            [InlineKeyboardButton(
+                f"{service.name} {'🧪' if service.is_test else ''} {'✅' if service.status == 'active' else '⏳'}",
+                callback_data=f"service_info_{service.service_id}"
+            )]
+            for service in services
         ]
         keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")])
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -216,59 +212,43 @@ async def my_services(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
     except mysql.connector.Error as e:
-        logger.error(f"Database error in my_services: {e}")
+        logger.error("Database error in my_services: %s", e)
         await query.message.edit_text(
             text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
         )
-    finally:
-        cursor.close()
-        conn.close()
 
 async def service_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     service_id = query.data.split("_")[2]
     user_id = str(query.from_user.id)
-    logger.debug(f"User {user_id} accessed service_info for service {service_id}")
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in service_info")
-        await query.message.edit_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
+    logger.debug("User %s accessed service_info for service %s", user_id, service_id)
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT name, ip_address, purchase_date, expiry_date, status, is_test FROM services WHERE service_id = %s AND telegram_id = %s AND deleted = FALSE",
-            (service_id, user_id)
-        )
-        result = cursor.fetchone()
-        if not result:
-            logger.warning(f"Service {service_id} not found for user {user_id}")
+        service = await servicecache.service(service_id, user_id)
+        if not service:
+            logger.warning("Service %s not found for user %s", service_id, user_id)
             await query.message.edit_text(
                 text="🚫 سرویس مورد نظر یافت نشد!"
             )
             return
-        name, ip_address, purchase_date, expiry_date, status, is_test = result
-        remaining_days = max((expiry_date - datetime.now()).days, 0) if status == "active" else 0
-        status_text = "✅" if status == "active" else "⏳"
-        ip_text = ip_address or "ثبت نشده"
-        purchase_date_str = purchase_date.strftime('%Y-%m-%d')
-        expiry_date_str = expiry_date.strftime('%Y-%m-%d')
-        logger.debug(f"Service info: name={name}, ip={ip_text}, status={status_text}")
+        remaining_days = max((service.expiry_date - datetime.now()).days, 0) if service.status == "active" else 0
+        status_text = "✅" if service.status == "active" else "⏳"
+        ip_text = service.ip_address or "ثبت نشده"
+        purchase_date_str = service.purchase_date.strftime('%Y-%m-%d')
+        expiry_date_str = service.expiry_date.strftime('%Y-%m-%d')
+        logger.debug("Service info: name=%s, ip=%s, status=%s", service.name, ip_text, status_text)
         keyboard = [
-            [InlineKeyboardButton(f"📍 ثبت {'آی‌پی' if not ip_address else 'آی‌پی جدید'}", callback_data=f"register_ip_{service_id}")]
+            [InlineKeyboardButton(f"📍 ثبت {'آی‌پی' if not service.ip_address else 'آی‌پی جدید'}", callback_data=f"register_ip_{service_id}")]
         ]
-        if not is_test:
+        if not service.is_test:
             keyboard.append([InlineKeyboardButton("🔄 تمدید سرویس", callback_data=f"renew_service_{service_id}")])
         keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="my_services")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.message.edit_text(
             text=(
                 f"📋 اطلاعات سرویس:\n"
-                f"نام سرویس: {name}\n"
-                f"نوع: {'🧪 تست' if is_test else '💳 خریداری‌شده'}\n"
+                f"نام سرویس: {service.name}\n"
+                f"نوع: {'🧪 تست' if service.is_test else '💳 خریداری‌شده'}\n"
                 f"📅 تاریخ خرید: {purchase_date_str}\n"
                 f"📆 تاریخ انقضا: {expiry_date_str}\n"
                 f"⏰ زمان باقی‌مانده: {remaining_days} روز\n"
@@ -278,25 +258,22 @@ async def service_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
     except mysql.connector.Error as e:
-        logger.error(f"Database error in service_info: {e}")
+        logger.error("Database error in service_info: %s", e)
         await query.message.edit_text(
             text=f"⚠️ مشکلی در اتصال به سرور رخ داد! خطا: {str(e)}"
         )
     except Exception as e:
-        logger.error(f"Unexpected error in service_info: {e}")
+        logger.error("Unexpected error in service_info: %s", e)
         await query.message.edit_text(
             text="⚠️ خطای غیرمنتظره‌ای رخ داد! لطفاً دوباره تلاش کنید."
         )
-    finally:
-        cursor.close()
-        conn.close()
 
 async def register_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     service_id = query.data.split("_")[2]
     user_id = str(query.from_user.id)
-    logger.debug(f"User {user_id} requested to register IP for service {service_id}")
+    logger.debug("User %s requested to register IP for service %s", user_id, service_id)
     web_app_url = f"https://{SERVER_IP}/register/{service_id}/{user_id}"
     keyboard = [
         [InlineKeyboardButton("📍 ثبت خودکار آی‌پی", url=web_app_url)],
@@ -317,7 +294,7 @@ async def manual_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["service_id"] = service_id
     context.user_data["telegram_id"] = user_id
     context.user_data["state"] = "awaiting_ip"
-    logger.debug(f"User {user_id} entered manual_ip for service {service_id}")
+    logger.debug("User %s entered manual_ip for service %s", user_id, service_id)
     keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data=f"service_info_{service_id}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.message.edit_text(
@@ -334,43 +311,30 @@ async def manual_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     if context.user_data.get("state") != "awaiting_ip" or context.user_data.get("telegram_id") != user_id:
-        logger.info(f"Ignored text message '{update.message.text}' from user {user_id} - not in awaiting_ip state or user mismatch")
+        logger.info("Ignored text message '%s' from user %s - not in awaiting_ip state or user mismatch", update.message.text, user_id)
         return
     ip = update.message.text.strip()
     service_id = context.user_data.get("service_id")
-    logger.debug(f"User {user_id} submitted IP {ip} for service {service_id}")
+    logger.debug("User %s submitted IP %s for service %s", user_id, ip, service_id)
     if not service_id:
         await update.message.reply_text(
             text="⚠️ لطفاً از منوی سرویس‌ها شروع کنید!"
         )
         return
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in handle_ip")
-        await update.message.reply_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT name, purchase_date, expiry_date, status FROM services WHERE service_id = %s AND telegram_id = %s AND deleted = FALSE",
-            (service_id, user_id)
-        )
-        result = cursor.fetchone()
-        if not result:
-            logger.warning(f"Service {service_id} not found for user {user_id}")
+        service = await queries.fetchone(queries.SERVICE, service_id, user_id)
+        if not service:
+            logger.warning("Service %s not found for user %s", service_id, user_id)
             await update.message.reply_text(
                 text="🚫 سرویس مورد نظر یافت نشد!"
             )
             return
-        name, purchase_date, expiry_date, status = result
-        if is_iranian_ip(ip):
-            cursor.execute(
-                "UPDATE services SET ip_address = %s WHERE service_id = %s AND telegram_id = %s",
-                (ip, service_id, user_id)
-            )
-            logger.debug(f"IP {ip} registered for service {service_id}, user {user_id}")
+        name, purchase_date, expiry_date, status = service.name, service.purchase_date, service.expiry_date, service.status
+        if geoip.is_iranian_ip(ip):
+            await allowlist.set_ip(ip, service_id, user_id)
+            snapshot.notify()
+            await servicecache.invalidate(user_id, service_id)
+            logger.debug("IP %s registered for service %s, user %s", ip, service_id, user_id)
             remaining_days = max((expiry_date - datetime.now()).days, 0) if status == "active" else 0
             status_text = "✅" if status == "active" else "⏳"
             purchase_date_str = purchase_date.strftime('%Y-%m-%d')
@@ -399,56 +363,46 @@ async def handle_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text="⚠️ آی‌پی واردشده ایرانی نیست! لطفاً یک آی‌پی معتبر وارد کنید:",
                 reply_markup=reply_markup
             )
+    except geoip.GeoIPUnavailable as e:
+        logger.error("Cannot check IP %s for user %s: %s", ip, user_id, e)
+        # The state is kept, so the user can send the IP again.
+        await update.message.reply_text(
+            text="⚠️ بررسی آی‌پی موقتاً در دسترس نیست! لطفاً چند دقیقه دیگر دوباره آی‌پی را ارسال کنید."
+        )
+        return
     except mysql.connector.Error as e:
-        logger.error(f"Database error in handle_ip: {e}")
+        logger.error("Database error in handle_ip: %s", e)
         await update.message.reply_text(
             text=f"⚠️ مشکلی در اتصال به سرور رخ داد! خطا: {str(e)}"
         )
-    finally:
-        cursor.close()
-        conn.close()
     context.user_data.clear()
 
 async def buy_new_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = str(query.from_user.id)
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in buy_new_service")
-        await query.message.edit_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT blocked FROM users WHERE telegram_id = %s", (user_id,))
-        result = cursor.fetchone()
-        if result and result[0]:
-            logger.warning(f"User {user_id} is blocked")
+        if await is_blocked(user_id):
+            logger.warning("User %s is blocked", user_id)
             await query.message.edit_text(
                 text="🚫 شما از خدمات ربات مسدود هستید!"
             )
             return
-        cursor.execute("SELECT COUNT(*) FROM pending_payments WHERE telegram_id = %s AND status = 'pending'", (user_id,))
-        if cursor.fetchone()[0] > 0:
+        if await queries.scalar(queries.PENDING_PAYMENT_COUNT, user_id):
             await query.message.edit_text(
                 text="⚠️ شما یک پرداخت در حال بررسی دارید! لطفاً منتظر تأیید ادمین باشید."
             )
             return
     except mysql.connector.Error as e:
-        logger.error(f"Database error in buy_new_service: {e}")
+        logger.error("Database error in buy_new_service: %s", e)
         await query.message.edit_text(
             text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
         )
         return
-    finally:
-        cursor.close()
-        conn.close()
     context.user_data.clear()
     context.user_data["telegram_id"] = user_id
     context.user_data["state"] = "awaiting_service_name"
-    logger.debug(f"User {user_id} started buy_new_service")
+    logger.debug("User %s started buy_new_service", user_id)
     keyboard = [
         [InlineKeyboardButton("🎲 انتخاب نام تصادفی", callback_data="random_name")],
         [InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")]
@@ -465,9 +419,9 @@ async def random_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(query.from_user.id)
     if "telegram_id" not in context.user_data or context.user_data["telegram_id"] != user_id:
         context.user_data["telegram_id"] = user_id
-        logger.warning(f"Fixed missing or mismatched telegram_id in random_name for user {user_id}")
+        logger.warning("Fixed missing or mismatched telegram_id in random_name for user %s", user_id)
     username = query.from_user.username or f"user_{user_id}"
-    logger.debug(f"User {user_id} requested random_name")
+    logger.debug("User %s requested random_name", user_id)
     name = generate_random_name(user_id, username)
     context.user_data["service_name"] = name
     context.user_data["state"] = "awaiting_duration"
@@ -482,15 +436,15 @@ async def random_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text=f"📋 نام سرویس: {name}\nلطفاً دوره سرویس خود را انتخاب کنید:",
         reply_markup=reply_markup
     )
-    logger.debug(f"Generated random name: {name} for user {user_id}")
+    logger.debug("Generated random name: %s for user %s", name, user_id)
 
 async def handle_service_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     if context.user_data.get("state") != "awaiting_service_name" or context.user_data.get("telegram_id") != user_id:
-        logger.info(f"Ignored text message '{update.message.text}' from user {user_id} - not in awaiting_service_name state or user mismatch")
+        logger.info("Ignored text message '%s' from user %s - not in awaiting_service_name state or user mismatch", update.message.text, user_id)
         return
     name = update.message.text.strip()
-    logger.debug(f"User {user_id} submitted service name: {name}")
+    logger.debug("User %s submitted service name: %s", user_id, name)
     if not re.match(r'^[a-zA-Z0-9]+$', name):
         keyboard = [
             [InlineKeyboardButton("🎲 انتخاب نام تصادفی", callback_data="random_name")],
@@ -502,20 +456,8 @@ async def handle_service_name(update: Update, context: ContextTypes.DEFAULT_TYPE
             reply_markup=reply_markup
         )
         return
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in handle_service_name")
-        await update.message.reply_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT COUNT(*) FROM services WHERE telegram_id = %s AND name = %s AND deleted = FALSE",
-            (user_id, name)
-        )
-        if cursor.fetchone()[0] > 0:
+        if await queries.scalar(queries.SERVICE_NAME_TAKEN, user_id, name):
             keyboard = [
                 [InlineKeyboardButton("🎲 انتخاب نام تصادفی", callback_data="random_name")],
                 [InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")]
@@ -539,15 +481,12 @@ async def handle_service_name(update: Update, context: ContextTypes.DEFAULT_TYPE
             text="📋 لطفاً دوره سرویس خود را انتخاب کنید:",
             reply_markup=reply_markup
         )
-        logger.debug(f"Service name {name} accepted, moving to duration selection for user {user_id}")
+        logger.debug("Service name %s accepted, moving to duration selection for user %s", name, user_id)
     except mysql.connector.Error as e:
-        logger.error(f"Database error in handle_service_name: {e}")
+        logger.error("Database error in handle_service_name: %s", e)
         await update.message.reply_text(
             text=f"⚠️ مشکلی در اتصال به سرور رخ داد! خطا: {str(e)}"
         )
-    finally:
-        cursor.close()
-        conn.close()
 
 async def handle_duration(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -556,10 +495,10 @@ async def handle_duration(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(query.from_user.id)
     if "telegram_id" not in context.user_data or context.user_data.get("telegram_id") != user_id:
         context.user_data["telegram_id"] = user_id
-        logger.warning(f"Fixed missing or mismatched telegram_id in handle_duration for user {user_id}")
+        logger.warning("Fixed missing or mismatched telegram_id in handle_duration for user %s", user_id)
     name = context.user_data.get("service_name")
     if not name:
-        logger.error(f"Missing service_name in handle_duration for user {user_id}")
+        logger.error("Missing service_name in handle_duration for user %s", user_id)
         await query.message.edit_text(
             text="⚠️ خطایی رخ داد! لطفاً دوباره تلاش کنید."
         )
@@ -570,7 +509,7 @@ async def handle_duration(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["duration"] = duration
     context.user_data["price"] = price
     context.user_data["state"] = "awaiting_receipt"
-    logger.debug(f"User {user_id} selected duration {duration} for service {name}")
+    logger.debug("User %s selected duration %s for service %s", user_id, duration, name)
     keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="buy_new_service")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.message.edit_text(
@@ -585,14 +524,14 @@ async def handle_duration(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     if context.user_data.get("state") != "awaiting_receipt" or context.user_data.get("telegram_id") != user_id:
-        logger.info(f"Ignored message from user {user_id} - not in awaiting_receipt state or user mismatch")
+        logger.info("Ignored message from user %s - not in awaiting_receipt state or user mismatch", user_id)
         return
     service_id = context.user_data.get("service_id")
     name = context.user_data.get("service_name")
     duration = context.user_data.get("duration")
     price = context.user_data.get("price")
     if not (service_id and name and duration and price):
-        logger.error(f"Missing data in handle_receipt for user {user_id}")
+        logger.error("Missing data in handle_receipt for user %s", user_id)
         await update.message.reply_text(
             text="⚠️ خطایی رخ داد! لطفاً دوباره تلاش کنید."
         )
@@ -600,27 +539,15 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     receipt = update.message.photo[-1] if update.message.photo else None
     caption = update.message.caption or "بدون توضیح"
     if not receipt:
-        logger.warning(f"User {user_id} sent invalid receipt for service {service_id}")
+        logger.warning("User %s sent invalid receipt for service %s", user_id, service_id)
         await update.message.reply_text(
             text="⚠️ لطفاً تصویر رسید پرداخت را ارسال کنید!"
         )
         return
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in handle_receipt")
-        await update.message.reply_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
     try:
-        cursor = conn.cursor()
         payment_id = str(uuid.uuid4())
-        cursor.execute(
-            "INSERT INTO pending_payments (payment_id, telegram_id, service_id, service_name, duration, price, caption, status) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-            (payment_id, user_id, service_id, name, duration, price, caption, "pending")
-        )
-        logger.debug(f"Payment recorded for user {user_id}, service {service_id}")
+        await queries.execute(queries.ADD_PAYMENT, payment_id, user_id, service_id, name, duration, price, caption, False)
+        logger.debug("Payment recorded for user %s, service %s", user_id, service_id)
         await update.message.reply_text(
             text="⏳ پرداخت شما در حال بررسی است. لطفاً منتظر تأیید ادمین باشید."
         )
@@ -635,8 +562,9 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("🚫 بلاک کردن", callback_data=f"block_user_{payment_id}_{user_id}")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_photo(
-            chat_id=ADMIN_ID,
+        outbox.send_photo(
+            ADMIN_ID,
+            outbox.PRIORITY_ADMIN,
             photo=receipt.file_id,
             caption=(
                 f"📬 درخواست پرداخت جدید:\n"
@@ -650,96 +578,91 @@ async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup,
             parse_mode="MarkdownV2"
         )
-        logger.debug(f"Payment notification sent to admin for user {user_id}, service {service_id}")
+        logger.debug("Payment notification queued for admin for user %s, service %s", user_id, service_id)
     except mysql.connector.Error as e:
-        logger.error(f"Database error in handle_receipt: {e}")
+        logger.error("Database error in handle_receipt: %s", e)
         await update.message.reply_text(
             text=f"⚠️ مشکلی در اتصال به سرور رخ داد! خطا: {str(e)}"
         )
     except Exception as e:
-        logger.error(f"Unexpected error in handle_receipt: {e}")
+        logger.error("Unexpected error in handle_receipt: %s", e)
         await update.message.reply_text(
             text="⚠️ خطای غیرمنتظره‌ای رخ داد! لطفاً دوباره تلاش کنید."
         )
-    finally:
-        cursor.close()
-        conn.close()
     context.user_data.clear()
 
+def _approval_message(decision):
+    if decision.is_renewal:
+        return (
+            f"🎉 پرداخت شما برای تمدید سرویس {decision.service_name} ({decision.duration} روز) با موفقیت تأیید شد!\n"
+            f"📆 تاریخ انقضای جدید: {decision.expiry_date.strftime('%Y-%m-%d')}"
+        )
+    return (
+        f"🎉 تبریک! پرداخت شما برای سرویس {decision.service_name} ({decision.duration} روز) با موفقیت تأیید شد!\n"
+        f"📅 تاریخ شروع: {decision.purchase_date.strftime('%Y-%m-%d')}\n"
+        f"📆 تاریخ انقضا: {decision.expiry_date.strftime('%Y-%m-%d')}\n"
+        f"لطفاً آی‌پی خود را ثبت کنید."
+    )
+
+async def _notify_approved(decisions):
+    """Tell the users of freshly approved payments; called after the approval committed."""
+    applied = [decision for decision in decisions if decision.applied]
+    await servicecache.invalidate_many((decision.telegram_id, decision.service_id) for decision in applied)
+    for decision in applied:
+        keyboard = [[InlineKeyboardButton("📋 سرویس‌های من", callback_data="my_services")]]
+        outbox.send_message(
+            decision.telegram_id,
+            outbox.PRIORITY_PAYMENT,
+            text=_approval_message(decision),
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    if applied:
+        reports.invalidate()
+    return applied
+
 async def approve_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = str(query.from_user.id)
     if user_id != ADMIN_ID:
-        logger.warning(f"User {user_id} attempted unauthorized access to approve_payment")
+        logger.warning("User %s attempted unauthorized access to approve_payment", user_id)
         await query.message.reply_text(
             text="🚫 دسترسی غیرمجاز!"
         )
         return
     payment_id, target_user_id = query.data.split("_")[2:4]
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in approve_payment")
-        await query.message.reply_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT service_id, service_name, duration, price FROM pending_payments WHERE payment_id = %s AND telegram_id = %s AND status = 'pending'",
-            (payment_id, target_user_id)
-        )
-        result = cursor.fetchone()
-        if not result:
-            logger.warning(f"Pending payment not found for payment {payment_id}, user {target_user_id}")
+        decision = await payments.approve(payment_id, target_user_id)
+        if decision is None:
+            logger.warning("Pending payment not found for payment %s, user %s", payment_id, target_user_id)
             await query.message.reply_text(
                 text="🚫 پرداخت مورد نظر یافت نشد!"
             )
             return
-        service_id, name, duration, price = result
-        purchase_date = datetime.now()
-        expiry_date = purchase_date + timedelta(days=duration)
-        cursor.execute(
-            "INSERT INTO services (service_id, telegram_id, name, purchase_date, expiry_date, duration, status, is_test) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-            (service_id, target_user_id, name, purchase_date, expiry_date, duration, "active", False)
-        )
-        cursor.execute(
-            "UPDATE pending_payments SET status = 'approved' WHERE payment_id = %s AND telegram_id = %s",
-            (payment_id, target_user_id)
-        )
-        logger.debug(f"Payment approved for payment {payment_id}, user {target_user_id}")
-        keyboard = [[InlineKeyboardButton("📋 سرویس‌های من", callback_data="my_services")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(
-            chat_id=target_user_id,
-            text=(
-                f"🎉 تبریک! پرداخت شما برای سرویس {name} ({duration} روز) با موفقیت تأیید شد!\n"
-                f"📅 تاریخ شروع: {purchase_date.strftime('%Y-%m-%d')}\n"
-                f"📆 تاریخ انقضا: {expiry_date.strftime('%Y-%m-%d')}\n"
-                f"لطفاً آی‌پی خود را ثبت کنید."
-            ),
-            reply_markup=reply_markup
-        )
+        if not decision.applied:
+            logger.info("Payment %s for user %s was already %s", payment_id, target_user_id, decision.status)
+            await query.message.reply_text(
+                text="ℹ️ این پرداخت قبلاً بررسی شده است."
+            )
+            return
+        await _notify_approved([decision])
+        logger.debug("Payment approved for payment %s, user %s", payment_id, target_user_id)
         await query.message.reply_text(
-            text="✅ پرداخت با موفقیت تأیید شد و سرویس برای کاربر فعال شد."
+            text="✅ پرداخت تأیید شد و سرویس کاربر تمدید شد." if decision.is_renewal
+            else "✅ پرداخت با موفقیت تأیید شد و سرویس برای کاربر فعال شد."
         )
     except mysql.connector.Error as e:
-        logger.error(f"Database error in approve_payment: {e}")
+        logger.error("Database error in approve_payment: %s", e)
         await query.message.reply_text(
             text=f"⚠️ مشکلی در اتصال به سرور رخ داد! خطا: {str(e)}"
         )
-    finally:
-        cursor.close()
-        conn.close()
 
 async def reject_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = str(query.from_user.id)
     if user_id != ADMIN_ID:
-        logger.warning(f"User {user_id} attempted unauthorized access to reject_payment")
+        logger.warning("User %s attempted unauthorized access to reject_payment", user_id)
         await query.message.reply_text(
             text="🚫 دسترسی غیرمجاز!"
         )
@@ -758,7 +681,7 @@ async def block_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = str(query.from_user.id)
     if user_id != ADMIN_ID:
-        logger.warning(f"User {user_id} attempted unauthorized access to block_user")
+        logger.warning("User %s attempted unauthorized access to block_user", user_id)
         await query.message.reply_text(
             text="🚫 دسترسی غیرمجاز!"
         )
@@ -775,7 +698,7 @@ async def block_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_admin_reason(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     if user_id != ADMIN_ID:
-        logger.warning(f"User {user_id} attempted unauthorized access to handle_admin_reason")
+        logger.warning("User %s attempted unauthorized access to handle_admin_reason", user_id)
         await update.message.reply_text(
             text="🚫 دسترسی غیرمجاز!"
         )
@@ -785,131 +708,93 @@ async def handle_admin_reason(update: Update, context: ContextTypes.DEFAULT_TYPE
     payment_id = context.user_data.get("payment_id")
     target_user_id = context.user_data.get("target_user_id")
     reason = update.message.text.strip()
-    logger.debug(f"Handling admin reason for user {user_id}: state={state}, action={action}, payment_id={payment_id}, target_user_id={target_user_id}, reason={reason}")
+    logger.debug("Handling admin reason for user %s: state=%s, action=%s, payment_id=%s, target_user_id=%s, reason=%s", user_id, state, action, payment_id, target_user_id, reason)
     if not (action and payment_id and target_user_id and reason and state in ["awaiting_reject_reason", "awaiting_block_reason"]):
-        logger.error(f"Missing or invalid data in handle_admin_reason for admin {user_id}: action={action}, payment_id={payment_id}, target_user_id={target_user_id}, state={state}")
+        logger.error("Missing or invalid data in handle_admin_reason for admin %s: action=%s, payment_id=%s, target_user_id=%s, state=%s", user_id, action, payment_id, target_user_id, state)
         await update.message.reply_text(
             text="⚠️ خطایی رخ داد! لطفاً دوباره تلاش کنید."
         )
         return
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in handle_admin_reason")
-        await update.message.reply_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT service_name FROM pending_payments WHERE payment_id = %s AND telegram_id = %s AND status = 'pending'",
-            (payment_id, target_user_id)
-        )
-        result = cursor.fetchone()
-        if not result:
-            logger.warning(f"Pending payment not found for payment {payment_id}, user {target_user_id}")
+        decision = await payments.reject(payment_id, target_user_id, reason, block=action == "block")
+        if decision is None:
+            logger.warning("Pending payment not found for payment %s, user %s", payment_id, target_user_id)
             await update.message.reply_text(
                 text="🚫 پرداخت مورد نظر یافت نشد!"
             )
             return
-        service_name = result[0]
-        if action == "reject":
-            cursor.execute(
-                "UPDATE pending_payments SET status = 'rejected', reason = %s WHERE payment_id = %s AND telegram_id = %s",
-                (reason, payment_id, target_user_id)
+        if not decision.applied:
+            logger.info("Payment %s for user %s was already %s", payment_id, target_user_id, decision.status)
+            await update.message.reply_text(
+                text="ℹ️ این پرداخت قبلاً بررسی شده است."
             )
-            await context.bot.send_message(
-                chat_id=target_user_id,
+            context.user_data.clear()
+            return
+        service_name = decision.service_name
+        if action == "reject":
+            outbox.send_message(
+                target_user_id,
+                outbox.PRIORITY_PAYMENT,
                 text=f"❌ پرداخت شما برای سرویس {service_name} رد شد.\nدلیل رد شدن: {reason}"
             )
             await update.message.reply_text(
                 text=f"✅ پرداخت برای سرویس {service_name} رد شد و دلیل به کاربر ارسال شد."
             )
-            logger.debug(f"Payment rejected for payment {payment_id}, user {target_user_id}, reason: {reason}")
+            logger.debug("Payment rejected for payment %s, user %s, reason: %s", payment_id, target_user_id, reason)
         elif action == "block":
-            cursor.execute(
-                "UPDATE pending_payments SET status = 'rejected', reason = %s WHERE payment_id = %s AND telegram_id = %s",
-                (reason, payment_id, target_user_id)
-            )
-            cursor.execute(
-                "UPDATE users SET blocked = TRUE WHERE telegram_id = %s",
-                (target_user_id,)
-            )
-            await context.bot.send_message(
-                chat_id=target_user_id,
+            membership.block(target_user_id)
+            # Other processes learn about the block through the invalidation feed.
+            await servicecache.invalidate(target_user_id)
+            outbox.send_message(
+                target_user_id,
+                outbox.PRIORITY_PAYMENT,
                 text=f"🚫 شما از خدمات ربات مسدود شدید.\nدلیل مسدود شدن: {reason}"
             )
             await update.message.reply_text(
                 text=f"✅ کاربر {target_user_id} بلاک شد و دلیل به او ارسال شد."
             )
-            logger.debug(f"User {target_user_id} blocked for payment {payment_id}, reason: {reason}")
+            logger.debug("User %s blocked for payment %s, reason: %s", target_user_id, payment_id, reason)
     except mysql.connector.Error as e:
-        logger.error(f"Database error in handle_admin_reason: {e}")
+        logger.error("Database error in handle_admin_reason: %s", e)
         await update.message.reply_text(
             text=f"⚠️ مشکلی در اتصال به سرور رخ داد! خطا: {str(e)}"
         )
-    finally:
-        cursor.close()
-        conn.close()
     context.user_data.clear()
 
 async def get_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = str(query.from_user.id)
-    logger.debug(f"User {user_id} requested test service")
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in get_test")
-        await query.message.edit_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
+    logger.debug("User %s requested test service", user_id)
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT blocked FROM users WHERE telegram_id = %s", (user_id,))
-        result = cursor.fetchone()
-        if result and result[0]:
-            logger.warning(f"User {user_id} is blocked")
+        if await is_blocked(user_id):
+            logger.warning("User %s is blocked", user_id)
             await query.message.edit_text(
                 text="🚫 شما از خدمات ربات مسدود هستید!"
             )
             return
-        cursor.execute(
-            "SELECT COUNT(*) FROM services WHERE telegram_id = %s AND is_test = TRUE AND deleted = FALSE",
-            (user_id,)
-        )
-        test_count = cursor.fetchone()[0]
-        if test_count > 0:
+        if await queries.scalar(queries.TEST_SERVICE_COUNT, user_id):
             keyboard = [[InlineKeyboardButton("🛒 خرید سرویس جدید", callback_data="buy_new_service")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.message.edit_text(
                 text="🧪 شما پیش‌تر سرویس تست دریافت کرده‌اید! لطفاً برای ادامه، سرویس جدیدی خریداری کنید:",
                 reply_markup=reply_markup
             )
-            logger.debug(f"User {user_id} already has a test service")
+            logger.debug("User %s already has a test service", user_id)
             return
         service_id = str(uuid.uuid4())
         name = f"Test_{user_id}_{str(uuid.uuid4())[:8]}"
         purchase_date = datetime.now()
         expiry_date = purchase_date + timedelta(hours=24)
-        cursor.execute(
-            "INSERT INTO services (service_id, telegram_id, name, purchase_date, expiry_date, is_test, duration, status) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-            (service_id, user_id, name, purchase_date, expiry_date, True, 1, "active")
-        )
-        cursor.execute(
-            "SELECT service_id, telegram_id, name, duration, status, is_test FROM services WHERE service_id = %s AND telegram_id = %s AND deleted = FALSE",
-            (service_id, user_id)
-        )
-        result = cursor.fetchone()
-        if not result:
-            logger.error(f"Failed to verify test service insertion for service_id {service_id}, user {user_id}")
+        await queries.execute(queries.ADD_SERVICE, service_id, user_id, name, purchase_date, expiry_date, 1, "active", True)
+        await servicecache.invalidate(user_id)
+        if not await queries.fetchone(queries.SERVICE, service_id, user_id):
+            logger.error("Failed to verify test service insertion for service_id %s, user %s", service_id, user_id)
             await query.message.edit_text(
                 text="⚠️ خطایی در ثبت سرویس تست رخ داد! لطفاً دوباره تلاش کنید."
             )
             return
-        logger.debug(f"Test service inserted and verified: {result}")
+        logger.debug("Test service %s inserted and verified", service_id)
         purchase_date_str = purchase_date.strftime('%Y-%m-%d')
         expiry_date_str = expiry_date.strftime('%Y-%m-%d')
         keyboard = [
@@ -929,15 +814,12 @@ async def get_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ),
             reply_markup=reply_markup
         )
-        logger.debug(f"Test service {service_id} created for user {user_id}: name={name}")
+        logger.debug("Test service %s created for user %s: name=%s", service_id, user_id, name)
     except mysql.connector.Error as e:
-        logger.error(f"Database error in get_test: {e}")
+        logger.error("Database error in get_test: %s", e)
         await query.message.edit_text(
             text=f"⚠️ مشکلی در اتصال به سرور رخ داد! خطا: {str(e)}"
         )
-    finally:
-        cursor.close()
-        conn.close()
     context.user_data.clear()
 
 async def renew_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -945,28 +827,22 @@ async def renew_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     service_id = query.data.split("_")[2]
     user_id = str(query.from_user.id)
-    logger.debug(f"User {user_id} requested to renew service {service_id}")
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in renew_service")
-        await query.message.edit_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
+    logger.debug("User %s requested to renew service %s", user_id, service_id)
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT name FROM services WHERE service_id = %s AND telegram_id = %s AND deleted = FALSE",
-            (service_id, user_id)
-        )
-        result = cursor.fetchone()
-        if not result:
-            logger.warning(f"Service {service_id} not found for user {user_id}")
+        service = await queries.fetchone(queries.SERVICE, service_id, user_id)
+        if not service:
+            logger.warning("Service %s not found for user %s", service_id, user_id)
             await query.message.edit_text(
                 text="🚫 سرویس مورد نظر یافت نشد!"
             )
             return
-        name = result[0]
+        if await queries.scalar(queries.PENDING_RENEWAL_COUNT, user_id, service_id):
+            logger.info("User %s already has a pending renewal for service %s", user_id, service_id)
+            await query.message.edit_text(
+                text="⚠️ برای این سرویس یک درخواست تمدید در حال بررسی دارید! لطفاً منتظر تأیید ادمین باشید."
+            )
+            return
+        name = service.name
         context.user_data["service_id"] = service_id
         context.user_data["service_name"] = name
         context.user_data["telegram_id"] = user_id
@@ -982,15 +858,12 @@ async def renew_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text=f"🔄 تمدید سرویس: {name}\nلطفاً دوره تمدید را انتخاب کنید:",
             reply_markup=reply_markup
         )
-        logger.debug(f"User {user_id} moved to renew duration for service {service_id}")
+        logger.debug("User %s moved to renew duration for service %s", user_id, service_id)
     except mysql.connector.Error as e:
-        logger.error(f"Database error in renew_service: {e}")
+        logger.error("Database error in renew_service: %s", e)
         await query.message.edit_text(
             text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
         )
-    finally:
-        cursor.close()
-        conn.close()
 
 async def handle_renew_duration(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -999,11 +872,11 @@ async def handle_renew_duration(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = str(query.from_user.id)
     if "telegram_id" not in context.user_data or context.user_data.get("telegram_id") != user_id:
         context.user_data["telegram_id"] = user_id
-        logger.warning(f"Fixed missing or mismatched telegram_id in handle_renew_duration for user {user_id}")
+        logger.warning("Fixed missing or mismatched telegram_id in handle_renew_duration for user %s", user_id)
     service_id = context.user_data.get("service_id")
     name = context.user_data.get("service_name")
     if not service_id or not name:
-        logger.error(f"Missing service_id or service_name in handle_renew_duration: service_id={service_id}, name={name}")
+        logger.error("Missing service_id or service_name in handle_renew_duration: service_id=%s, name=%s", service_id, name)
         await query.message.edit_text(
             text="⚠️ خطایی رخ داد! لطفاً دوباره تلاش کنید."
         )
@@ -1012,7 +885,7 @@ async def handle_renew_duration(update: Update, context: ContextTypes.DEFAULT_TY
     context.user_data["duration"] = duration
     context.user_data["price"] = price
     context.user_data["state"] = "awaiting_renew_receipt"
-    logger.debug(f"User {user_id} selected renew duration {duration} for service {service_id}")
+    logger.debug("User %s selected renew duration %s for service %s", user_id, duration, service_id)
     keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data=f"renew_service_{service_id}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.message.edit_text(
@@ -1027,14 +900,14 @@ async def handle_renew_duration(update: Update, context: ContextTypes.DEFAULT_TY
 async def handle_renew_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     if context.user_data.get("state") != "awaiting_renew_receipt" or context.user_data.get("telegram_id") != user_id:
-        logger.info(f"Ignored message from user {user_id} - not in awaiting_renew_receipt state or user mismatch")
+        logger.info("Ignored message from user %s - not in awaiting_renew_receipt state or user mismatch", user_id)
         return
     service_id = context.user_data.get("service_id")
     name = context.user_data.get("service_name")
     duration = context.user_data.get("duration")
     price = context.user_data.get("price")
     if not (service_id and name and duration and price):
-        logger.error(f"Missing data in handle_renew_receipt for user {user_id}")
+        logger.error("Missing data in handle_renew_receipt for user %s", user_id)
         await update.message.reply_text(
             text="⚠️ خطایی رخ داد! لطفاً دوباره تلاش کنید."
         )
@@ -1042,27 +915,23 @@ async def handle_renew_receipt(update: Update, context: ContextTypes.DEFAULT_TYP
     receipt = update.message.photo[-1] if update.message.photo else None
     caption = update.message.caption or "بدون توضیح"
     if not receipt:
-        logger.warning(f"User {user_id} sent invalid receipt for renew service {service_id}")
+        logger.warning("User %s sent invalid receipt for renew service %s", user_id, service_id)
         await update.message.reply_text(
             text="⚠️ لطفاً تصویر رسید پرداخت را ارسال کنید!"
         )
         return
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in handle_renew_receipt")
-        await update.message.reply_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
     try:
-        cursor = conn.cursor()
+        # Checked again here: two renewals of a service can be started before either receipt is sent.
+        if await queries.scalar(queries.PENDING_RENEWAL_COUNT, user_id, service_id):
+            logger.info("User %s already has a pending renewal for service %s", user_id, service_id)
+            await update.message.reply_text(
+                text="⚠️ برای این سرویس یک درخواست تمدید در حال بررسی دارید! لطفاً منتظر تأیید ادمین باشید."
+            )
+            context.user_data.clear()
+            return
         payment_id = str(uuid.uuid4())
-        cursor.execute(
-            "INSERT INTO pending_payments (payment_id, telegram_id, service_id, service_name, duration, price, caption, status, is_renewal) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-            (payment_id, user_id, service_id, name, duration, price, caption, "pending", True)
-        )
-        logger.debug(f"Renewal payment recorded for user {user_id}, service {service_id}")
+        await queries.execute(queries.ADD_PAYMENT, payment_id, user_id, service_id, name, duration, price, caption, True)
+        logger.debug("Renewal payment recorded for user %s, service %s", user_id, service_id)
         await update.message.reply_text(
             text="⏳ پرداخت شما برای تمدید سرویس در حال بررسی است. لطفاً منتظر تأیید ادمین باشید."
         )
@@ -1077,8 +946,9 @@ async def handle_renew_receipt(update: Update, context: ContextTypes.DEFAULT_TYP
             [InlineKeyboardButton("🚫 بلاک کردن", callback_data=f"block_user_{payment_id}_{user_id}")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_photo(
-            chat_id=ADMIN_ID,
+        outbox.send_photo(
+            ADMIN_ID,
+            outbox.PRIORITY_ADMIN,
             photo=receipt.file_id,
             caption=(
                 f"📬 درخواست تمدید سرویس جدید:\n"
@@ -1092,332 +962,257 @@ async def handle_renew_receipt(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup=reply_markup,
             parse_mode="MarkdownV2"
         )
-        logger.debug(f"Renewal payment notification sent to admin for user {user_id}, service {service_id}")
+        logger.debug("Renewal payment notification queued for admin for user %s, service %s", user_id, service_id)
     except mysql.connector.Error as e:
-        logger.error(f"Database error in handle_renew_receipt: {e}")
+        logger.error("Database error in handle_renew_receipt: %s", e)
         await update.message.reply_text(
             text=f"⚠️ مشکلی در اتصال به سرور رخ داد! خطا: {str(e)}"
         )
     except Exception as e:
-        logger.error(f"Unexpected error in handle_renew_receipt: {e}")
+        logger.error("Unexpected error in handle_renew_receipt: %s", e)
         await update.message.reply_text(
             text="⚠️ خطای غیرمنتظره‌ای رخ داد! لطفاً دوباره تلاش کنید."
         )
-    finally:
-        cursor.close()
-        conn.close()
     context.user_data.clear()
 
-async def tutorials(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    logger.debug(f"User {query.from_user.id} accessed tutorials")
-    keyboard = [
-        [InlineKeyboardButton("📱 Android", callback_data="tutorial_android")],
-        [InlineKeyboardButton("🍎 iOS", callback_data="tutorial_ios")],
-        [InlineKeyboardButton("💻 Windows", callback_data="tutorial_windows")],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.edit_text(
-        text="📚 لطفاً پلتفرم مورد نظر خود را برای آموزش تنظیم DNS انتخاب کنید:",
-        reply_markup=reply_markup
-    )
-
-async def tutorial_android(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    logger.debug(f"User {query.from_user.id} accessed tutorial_android")
-    text = (
-        f"📱 آموزش تنظیم DNS در اندروید (دو روش):\n\n"
-        f"🔧 روش اول: تنظیم دستی DNS روی وای‌فای\n"
-        f"1. به تنظیمات دستگاه بروید و گزینه Wi-Fi را انتخاب کنید.\n"
-        f"2. روی نام شبکه وای‌فای خود کلیک کنید (یا گزینه Modify Network).\n"
-        f"3. گزینه Advanced را انتخاب کنید.\n"
-        f"4. تنظیمات IP را از DHCP به Static تغییر دهید.\n"
-        f"5. DNSهای قبلی را حذف کرده و مقادیر زیر را وارد کنید:\n"
-        f"     - DNS1: {IPDNS1}\n"
-        f"     - DNS2: {IPDNS2}\n"
-        f"6. تنظیمات را ذخیره کنید.\n\n"
-        f"---\n\n"
-        f"📲 روش دوم: استفاده از برنامه DNS Changer\n"
-        f"1. برنامه DNS Changer را از گوگل‌پلی دانلود کنید.\n"
-        f"2. برنامه را اجرا کرده و DNSهای زیر را وارد کنید:\n"
-        f"     - DNS1: {IPDNS1}\n"
-        f"     - DNS2: {IPDNS2}\n"
-        f"3. گزینه اتصال را فعال کنید.\n"
-        f"4. مجوز VPN را تأیید کنید (صرفاً برای تغییر DNS).\n"
-        f"5. اینترنت شما اکنون با DNS جدید فعال است!\n\n"
-        f"---\n"
-        f"📌 نکات مهم:\n"
-        f"- در صورت بروز مشکل، تنظیمات را به DHCP بازگردانید.\n"
-        f"- پس از اتمام دوره اشتراک ردکس گیم، تنظیمات را به حالت Automatic برگردانید.\n"
-        f"- در صورت تغییر آی‌پی، لطفاً آی‌پی جدید خود را ثبت کنید.\n\n"
-        f"✅ تنظیمات تکمیل شد! اکنون اینترنت شما بهینه‌تر است."
-    )
-    keyboard = [
-        [InlineKeyboardButton("📥 دانلود DNS Changer", url="https://play.google.com/store/apps/details?id=com.burakgon.dnschanger")],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data="tutorials")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.edit_text(
-        text=text,
-        reply_markup=reply_markup
-    )
-
-async def tutorial_ios(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    logger.debug(f"User {query.from_user.id} accessed tutorial_ios")
-    text = (
-        f"🍎 آموزش تنظیم DNS در iOS (دو روش):\n\n"
-        f"🔧 روش اول: تنظیم دستی DNS روی وای‌فای\n"
-        f"1. به تنظیمات دستگاه بروید و گزینه Wi-Fi را انتخاب کنید.\n"
-        f"2. روی آیکون (i) کنار شبکه وای‌فای خود کلیک کنید.\n"
-        f"3. به بخش DNS بروید.\n"
-        f"4. گزینه Manual را انتخاب کرده و DNSهای قبلی را حذف کنید.\n"
-        f"5. DNSهای زیر را اضافه کنید:\n"
-        f"     - DNS1: {IPDNS1}\n"
-        f"     - DNS2: {IPDNS2}\n"
-        f"6. تنظیمات را ذخیره کنید.\n\n"
-        f"---\n\n"
-        f"📲 روش دوم: استفاده از برنامه DNS Changer\n"
-        f"1. برنامه DNS Changer را از اپ‌استور دانلود کنید.\n"
-        f"2. برنامه را اجرا کرده و DNSهای زیر را وارد کنید:\n"
-        f"     - DNS1: {IPDNS1}\n"
-        f"     - DNS2: {IPDNS2}\n"
-        f"3. گزینه اتصال را فعال کنید.\n"
-        f"4. اینترنت شما اکنون با DNS جدید فعال است!\n\n"
-        f"---\n"
-        f"📌 نکات مهم:\n"
-        f"- در صورت بروز مشکل، تنظیمات DNS را به حالت Automatic بازگردانید.\n"
-        f"- پس از اتمام دوره اشتراک ردکس گیم، تنظیمات را به حالت Automatic برگردانید.\n"
-        f"- در صورت تغییر آی‌پی، لطفاً آی‌پی جدید خود را ثبت کنید.\n\n"
-        f"✅ تنظیمات تکمیل شد! اکنون اینترنت شما بهینه‌تر است."
-    )
-    keyboard = [
-        [InlineKeyboardButton("📥 دانلود DNS Changer", url="https://apps.apple.com/us/app/dns-ip-changer-secure-vpn/id1562292463")],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data="tutorials")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.edit_text(
-        text=text,
-        reply_markup=reply_markup
-    )
-
-async def tutorial_windows(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    logger.debug(f"User {query.from_user.id} accessed tutorial_windows")
-    text = (
-        f"💻 آموزش تنظیم DNS در ویندوز (دو روش):\n\n"
-        f"🔧 روش اول: تنظیم دستی از طریق Control Panel\n"
-        f"1. کلیدهای Win+R را فشار دهید، control را تایپ کرده و Enter بزنید.\n"
-        f"2. در کنترل پنل:\n"
-        f"   - گزینه View by را روی Large icons تنظیم کنید.\n"
-        f"   - روی Network and Sharing Center کلیک کنید.\n"
-        f"3. در صفحه جدید:\n"
-        f"   - از منوی سمت چپ، Change adapter settings را انتخاب کنید.\n"
-        f"4. روی اتصال اینترنت خود (Wi-Fi یا Ethernet):\n"
-        f"   - راست‌کلیک کرده و Properties را انتخاب کنید.\n"
-        f"5. در پنجره Properties:\n"
-        f"   - گزینه Internet Protocol Version 4 (TCP/IPv4) را انتخاب کنید.\n"
-        f"   - روی Properties کلیک کنید.\n"
-        f"6. تنظیم DNS:\n"
-        f"   - گزینه Use the following DNS server addresses را فعال کنید.\n"
-        f"   - در قسمت Preferred DNS: {IPDNS1}\n"
-        f"   - در قسمت Alternate DNS: {IPDNS2}\n"
-        f"7. روی OK کلیک کنید.\n"
-        f"8. تمام پنجره‌ها را با کلیک روی OK ببندید.\n\n"
-        f"---\n\n"
-        f"📲 روش دوم: استفاده از DNS Jumper\n"
-        f"1. برنامه DNS Jumper را از لینک زیر دانلود کنید.\n"
-        f"2. پس از دانلود:\n"
-        f"   - فایل ZIP را استخراج کنید.\n"
-        f"   - روی DnsJumper.exe دوبار کلیک کنید.\n"
-        f"3. در برنامه:\n"
-        f"   - از منوی بالا، Network Adapter را انتخاب کنید.\n"
-        f"   - در بخش Custom، مقادیر زیر را وارد کنید:\n"
-        f"     - DNS1: {IPDNS1}\n"
-        f"     - DNS2: {IPDNS2}\n"
-        f"4. روی Apply DNS کلیک کنید.\n"
-        f"5. پیام سبز رنگ Successfully applied نشان‌دهنده موفقیت است.\n\n"
-        f"---\n"
-        f"📌 نکات مهم:\n"
-        f"- برای بازگشت به حالت اولیه، در DNS Jumper روی Restore Original DNS کلیک کنید.\n"
-        f"- برای تست DNS جدید، در CMD دستور ping 1.1.1.1 را اجرا کنید.\n\n"
-        f"✅ تنظیمات تکمیل شد! اکنون اینترنت شما سریع‌تر و امن‌تر است."
-    )
-    keyboard = [
-        [InlineKeyboardButton("📥 دانلود DNS Jumper", url="https://www.sordum.org/files/downloads.php?dns-jumper")],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data="tutorials")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.edit_text(
-        text=text,
-        reply_markup=reply_markup
-    )
-
-async def tutorials(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    logger.debug(f"User {query.from_user.id} accessed tutorials")
-    keyboard = [
-        [InlineKeyboardButton("📱 Android", callback_data="tutorial_android")],
-        [InlineKeyboardButton("🍎 iOS", callback_data="tutorial_ios")],
-        [InlineKeyboardButton("💻 Windows", callback_data="tutorial_windows")],
-        [InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.edit_text(
-        text="📚 لطفاً پلتفرم مورد نظر خود را برای آموزش تنظیم DNS انتخاب کنید:",
-        reply_markup=reply_markup
-    )
-
-async def faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    logger.debug(f"User {query.from_user.id} accessed faq")
-    text = (
-        f"❓ سوالات متداول:\n\n"
-        f"🔍 DNS چیست و آیا خطری برای حساب‌های من دارد؟\n"
-        f"خیر، DNS (Domain Name System) مانند دفترچه تلفن اینترنت عمل می‌کند. برای مثال، Google.com را به آی‌پی 8.8.8.8 تبدیل می‌کند و هیچ خطری برای شما یا حساب‌هایتان ندارد.\n\n"
-        f"📡 DNS چگونه پینگ را کاهش می‌دهد؟\n"
-        f"بدون تنظیم DNS، دستگاه شما به سرورهای DNS عمومی (مانند 1.1.1.1) متصل می‌شود که معمولاً شلوغ و دور هستند. ردکس گیم با سرورهای قدرتمند در ایران و روتینگ بهینه، تأخیر را کاهش داده و پینگ شما را بهبود می‌بخشد.\n\n"
-        f"⚠️ آیا استفاده از DNS باعث بن شدن حساب بازی می‌شود؟\n"
-        f"خیر، استفاده از DNS ردکس گیم هیچ خطری برای حساب بازی شما ندارد."
-    )
-    keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.edit_text(
-        text=text,
-        reply_markup=reply_markup
-    )
-
-async def dns_servers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    logger.debug(f"User {query.from_user.id} accessed dns_servers")
-    text = (
-        f"🌐 آدرس‌های DNS ردکس گیم (IPv4):\n"
-        f"     - DNS1: {IPDNS1}\n"
-        f"     - DNS2: {IPDNS2}"
-    )
-    keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.edit_text(
-        text=text,
-        reply_markup=reply_markup
-    )
-
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = str(query.from_user.id)
     if user_id != ADMIN_ID:
-        logger.warning(f"User {user_id} attempted unauthorized access to stats")
+        logger.warning("User %s attempted unauthorized access to stats", user_id)
         await query.message.edit_text(
             text="🚫 دسترسی غیرمجاز!"
         )
         return
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Failed to connect to database in stats")
-        await query.message.edit_text(
-            text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
-        )
-        return
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM services WHERE is_test = TRUE AND deleted = FALSE")
-        test_services = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM services WHERE duration = 30 AND is_test = FALSE")
-        one_month = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM services WHERE duration = 60 AND is_test = FALSE")
-        two_month = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM services WHERE duration = 90 AND is_test = FALSE")
-        three_month = cursor.fetchone()[0]
+        result = await reports.get_stats()
         keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.message.edit_text(
             text=(
                 f"📊 آمار کاربران:\n"
-                f"👥 تعداد کل کاربران: {total_users}\n"
-                f"🧪 سرویس‌های تست: {test_services}\n"
+                f"👥 تعداد کل کاربران: {result['total_users']}\n"
+                f"🧪 سرویس‌های تست: {result['test_services']}\n"
                 f"💳 سرویس‌های خریداری‌شده:\n"
-                f"  • یک‌ماهه: {one_month}\n"
-                f"  • دوماهه: {two_month}\n"
-                f"  • سه‌ماهه: {three_month}"
+                f"  • یک‌ماهه: {result['one_month']}\n"
+                f"  • دوماهه: {result['two_month']}\n"
+                f"  • سه‌ماهه: {result['three_month']}\n"
+                f"✅ سرویس‌های فعال: {result['active_services']}\n"
+                f"⏳ سرویس‌های منقضی: {result['expired_services']}\n"
+                f"💰 درآمد تأییدشده: {result['revenue']:,} تومان ({result['approved_payments']} پرداخت)\n"
+                f"🧾 پرداخت‌های در انتظار بررسی: {result['pending_payments']}"
             ),
             reply_markup=reply_markup
         )
-        logger.debug(f"Stats retrieved for admin {user_id}")
+        logger.debug("Stats retrieved for admin %s", user_id)
     except mysql.connector.Error as e:
-        logger.error(f"Database error in stats: {e}")
+        logger.error("Database error in stats: %s", e)
         await query.message.edit_text(
             text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید."
         )
-    finally:
-        cursor.close()
-        conn.close()
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if user_id != ADMIN_ID:
+        logger.warning("User %s attempted unauthorized access to broadcast", user_id)
+        await update.message.reply_text(text="🚫 دسترسی غیرمجاز!")
+        return
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        await update.message.reply_text(
+            text="📣 برای ارسال همگانی، متن پیام را بعد از دستور بنویسید:\n/broadcast متن پیام\n🛑 برای لغو: /cancel_broadcast"
+        )
+        return
+    progress = await update.message.reply_text(text="📣 در حال آماده‌سازی ارسال همگانی...")
+    try:
+        broadcast_id, total = await broadcast.start(context.bot, parts[1].strip(), user_id, progress.message_id)
+        logger.info("Admin %s started broadcast %s to %s users", user_id, broadcast_id, total)
+    except mysql.connector.Error as e:
+        logger.error("Database error in broadcast: %s", e)
+        await progress.edit_text(text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید.")
+
+async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if user_id != ADMIN_ID:
+        logger.warning("User %s attempted unauthorized access to cancel_broadcast", user_id)
+        await update.message.reply_text(text="🚫 دسترسی غیرمجاز!")
+        return
+    try:
+        cancelled = await broadcast.cancel()
+        await update.message.reply_text(
+            text="🛑 ارسال همگانی لغو شد." if cancelled else "ℹ️ هیچ ارسال همگانی در جریان نیست."
+        )
+    except mysql.connector.Error as e:
+        logger.error("Database error in cancel_broadcast: %s", e)
+        await update.message.reply_text(text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید.")
+
+async def approve_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if user_id != ADMIN_ID:
+        logger.warning("User %s attempted unauthorized access to approve_all", user_id)
+        await update.message.reply_text(text="🚫 دسترسی غیرمجاز!")
+        return
+    try:
+        decisions = await payments.approve_pending(PAYMENT_BATCH_SIZE)
+        applied = await _notify_approved(decisions)
+        remaining = await queries.scalar(queries.PENDING_PAYMENTS_TOTAL)
+        logger.info("Admin %s approved %s pending payments in one batch", user_id, len(applied))
+        await update.message.reply_text(
+            text=(
+                f"✅ {len(applied)} پرداخت تأیید شد "
+                f"({sum(decision.is_renewal for decision in applied)} تمدید).\n"
+                f"🧾 پرداخت‌های باقی‌مانده در انتظار بررسی: {remaining}"
+            )
+        )
+    except mysql.connector.Error as e:
+        logger.error("Database error in approve_all: %s", e)
+        await update.message.reply_text(text="⚠️ مشکلی در اتصال به سرور رخ داد! لطفاً دوباره تلاش کنید.")
+
+# (conversation state, message kind) -> handler; each handler still checks that the state is its own.
+MESSAGE_ROUTES = {
+    ("awaiting_service_name", "text"): handle_service_name,
+    ("awaiting_ip", "text"): handle_ip,
+    ("awaiting_reject_reason", "text"): handle_admin_reason,
+    ("awaiting_block_reason", "text"): handle_admin_reason,
+    ("awaiting_receipt", "photo"): handle_receipt,
+    ("awaiting_renew_receipt", "photo"): handle_renew_receipt,
+}
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     state = context.user_data.get("state")
-    logger.debug(f"Handling text message from user {user_id} in state {state}: {update.message.text}")
-    if user_id == ADMIN_ID and state in ["awaiting_reject_reason", "awaiting_block_reason"]:
-        await handle_admin_reason(update, context)
-    elif state == "awaiting_service_name" and context.user_data.get("telegram_id") == user_id:
-        await handle_service_name(update, context)
-    elif state == "awaiting_ip" and context.user_data.get("telegram_id") == user_id:
-        await handle_ip(update, context)
-    else:
-        logger.info(f"Ignored text message '{update.message.text}' from user {user_id} - invalid state or user mismatch")
+    kind = "photo" if update.message.photo else "text"
+    logger.debug("Handling %s message from user %s in state %s", kind, user_id, state)
+    handler = MESSAGE_ROUTES.get((state, kind))
+    if handler is not None:
+        await handler(update, context)
+        return
+    metrics.UNROUTED_MESSAGES.labels(kind, state or "none").inc()
+    logger.info("Ignored %s message from user %s in state %s", kind, user_id, state)
+    if kind == "text":
         await update.message.reply_text(
             text="⚠️ لطفاً از منوی مناسب اقدام کنید!"
         )
 
+def run_webhook(app: Application):
+    secret = os.getenv("WEBHOOK_SECRET")
+    if not secret:
+        raise RuntimeError("WEBHOOK_SECRET must be set when BOT_MODE=webhook")
+    path = (os.getenv("WEBHOOK_PATH") or "telegram").strip("/")
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if not webhook_url:
+        raise RuntimeError("WEBHOOK_URL must be set when BOT_MODE=webhook")
+    listen = os.getenv("WEBHOOK_LISTEN") or "127.0.0.1"
+    port = int(os.getenv("WEBHOOK_PORT") or 8443)
+    logger.info("Bot started in webhook mode on %s:%s/%s", listen, port, path)
+    # TLS is terminated by the reverse proxy in front of WEBHOOK_URL; Telegram signs each delivery
+    # with the secret token, and requests without it are rejected with 403.
+    app.run_webhook(
+        listen=listen,
+        port=port,
+        url_path=path,
+        webhook_url=f"{webhook_url.rstrip('/')}/{path}",
+        secret_token=secret,
+        max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS") or 40),
+        allowed_updates=Update.ALL_TYPES
+    )
+
+def build_application(mode):
+    """Application with every handler registered; jobs and the run loop are up to the caller."""
+    processor = cluster.ChatSerialUpdateProcessor(int(os.getenv("BOT_CONCURRENT_UPDATES") or 64))
+    # Workers share user_data through MySQL, since the router may move a chat to another worker.
+    state_store = persistence.MySQLPersistence(
+        update_interval=float(os.getenv("STATE_FLUSH_INTERVAL") or 10),
+        ttl=float(os.getenv("STATE_TTL") or 86400),
+        shared=mode == "worker"
+    )
+    builder = (
+        Application.builder()
+        .token(os.getenv("BOT_TOKEN"))
+        .concurrent_updates(processor)
+        .request(metrics.TimedRequest(connection_pool_size=256))
+        .persistence(state_store)
+        # Bounded, so a burst of webhook deliveries waits in Telegram's retry queue instead of in memory.
+        .update_queue(asyncio.Queue(maxsize=int(os.getenv("BOT_UPDATE_QUEUE_SIZE") or 1000)))
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    api_url = os.getenv("TELEGRAM_API_URL")
+    if api_url:
+        builder = builder.base_url(f"{api_url.rstrip('/')}/bot").base_file_url(f"{api_url.rstrip('/')}/file/bot")
+    if mode == "worker":
+        builder = builder.updater(None)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("menu", menu))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(CommandHandler("cancel_broadcast", cancel_broadcast))
+    app.add_handler(CommandHandler("approve_all", approve_all_command))
+    # Static screens are matched with one dict lookup, ahead of the regex patterns below.
+    app.add_handler(CallbackQueryHandler(show_screen, pattern=lambda data: data in SCREENS))
+    app.add_handler(CallbackQueryHandler(my_services, pattern="my_services"))
+    app.add_handler(CallbackQueryHandler(service_info, pattern="service_info_.*"))
+    app.add_handler(CallbackQueryHandler(register_ip, pattern="register_ip_.*"))
+    app.add_handler(CallbackQueryHandler(manual_ip, pattern="manual_ip_.*"))
+    app.add_handler(CallbackQueryHandler(get_test, pattern="get_test"))
+    app.add_handler(CallbackQueryHandler(buy_new_service, pattern="buy_new_service"))
+    app.add_handler(CallbackQueryHandler(random_name, pattern="random_name"))
+    app.add_handler(CallbackQueryHandler(renew_service, pattern="renew_service_.*"))
+    app.add_handler(CallbackQueryHandler(handle_renew_duration, pattern="renew_duration_.*"))
+    app.add_handler(CallbackQueryHandler(stats, pattern="stats"))
+    app.add_handler(CallbackQueryHandler(handle_duration, pattern="duration_.*"))
+    app.add_handler(CallbackQueryHandler(approve_payment, pattern="approve_payment_.*"))
+    app.add_handler(CallbackQueryHandler(reject_payment, pattern="reject_payment_.*"))
+    app.add_handler(CallbackQueryHandler(block_user, pattern="block_user_.*"))
+    app.add_handler(MessageHandler(
+        ((filters.TEXT & ~filters.COMMAND) | filters.PHOTO) & filters.UpdateType.MESSAGE, handle_message
+    ))
+    metrics.instrument_handlers(app)
+    return app
+
 def main():
-    lock_fd = acquire_lock()
+    mode = (os.getenv("BOT_MODE") or "polling").lower()
+    if mode == "router":
+        logger.info("Bot started in router mode")
+        cluster.run_router()
+        return
+    # Only long polling needs the lock: webhook servers and workers cannot bind the same port twice,
+    # and several workers are expected to run side by side.
+    lock_fd = acquire_lock() if mode == "polling" else None
     try:
-        app = Application.builder().token(os.getenv("BOT_TOKEN")).build()
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("menu", menu))
-        app.add_handler(CallbackQueryHandler(main_menu, pattern="main_menu"))
-        app.add_handler(CallbackQueryHandler(my_services, pattern="my_services"))
-        app.add_handler(CallbackQueryHandler(service_info, pattern="service_info_.*"))
-        app.add_handler(CallbackQueryHandler(register_ip, pattern="register_ip_.*"))
-        app.add_handler(CallbackQueryHandler(manual_ip, pattern="manual_ip_.*"))
-        app.add_handler(CallbackQueryHandler(get_test, pattern="get_test"))
-        app.add_handler(CallbackQueryHandler(buy_new_service, pattern="buy_new_service"))
-        app.add_handler(CallbackQueryHandler(random_name, pattern="random_name"))
-        app.add_handler(CallbackQueryHandler(renew_service, pattern="renew_service_.*"))
-        app.add_handler(CallbackQueryHandler(handle_renew_duration, pattern="renew_duration_.*"))
-        app.add_handler(CallbackQueryHandler(tutorials, pattern="tutorials"))
-        app.add_handler(CallbackQueryHandler(tutorial_android, pattern="tutorial_android"))
-        app.add_handler(CallbackQueryHandler(tutorial_ios, pattern="tutorial_ios"))
-        app.add_handler(CallbackQueryHandler(tutorial_windows, pattern="tutorial_windows"))
-        app.add_handler(CallbackQueryHandler(faq, pattern="faq"))
-        app.add_handler(CallbackQueryHandler(dns_servers, pattern="dns_servers"))
-        app.add_handler(CallbackQueryHandler(stats, pattern="stats"))
-        app.add_handler(CallbackQueryHandler(handle_duration, pattern="duration_.*"))
-        app.add_handler(CallbackQueryHandler(approve_payment, pattern="approve_payment_.*"))
-        app.add_handler(CallbackQueryHandler(reject_payment, pattern="reject_payment_.*"))
-        app.add_handler(CallbackQueryHandler(block_user, pattern="block_user_.*"))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.UpdateType.MESSAGE, handle_text))
-        app.add_handler(MessageHandler(filters.PHOTO & filters.UpdateType.MESSAGE, handle_receipt))
-        app.add_handler(MessageHandler(filters.PHOTO & filters.UpdateType.MESSAGE, handle_renew_receipt))
-        app.job_queue.run_repeating(check_expired_services, interval=1800, first=0)
-        logger.info("Bot started")
-        app.run_polling()
+        db.init_pool()
+        if (os.getenv("DB_MIGRATE_ON_START") or "1") == "1":
+            migrations.apply_pending()
+        geoip.start_auto_reload()
+        app = build_application(mode)
+        if RUN_JOBS:
+            app.job_queue.run_repeating(metrics.instrument_job(check_expired_services), interval=1800, first=0)
+            app.job_queue.run_repeating(metrics.instrument_job(prune_allowlist_changes), interval=86400, first=3600)
+        app.job_queue.run_repeating(
+            metrics.instrument_job(reconcile_membership),
+            interval=float(os.getenv("MEMBERSHIP_RECONCILE_INTERVAL") or 3600),
+            first=0
+        )
+        app.job_queue.run_repeating(metrics.instrument_job(report_pool_stats), interval=300, first=300)
+        app.job_queue.run_repeating(metrics.instrument_job(expire_user_state), interval=600, first=600)
+        metrics.start_server()
+        if mode == "webhook":
+            run_webhook(app)
+        elif mode == "worker":
+            logger.info("Bot started in worker mode")
+            cluster.run_worker(app)
+        else:
+            logger.info("Bot started in polling mode")
+            app.run_polling()
     except Exception as e:
-        logger.error(f"Failed to start bot: {e}")
+        logger.error("Failed to start bot: %s", e)
         raise
     finally:
-        fcntl.flock(lock_fd, fcntl.LOCK_UN)
-        lock_fd.close()
+        db.close_pool()
+        if lock_fd is not None:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            lock_fd.close()
 
 if __name__ == "__main__":
     main()
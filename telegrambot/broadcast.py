@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+import mysql.connector
+from telegram.error import TelegramError
+
+import db
+import outbox
+
+logger = logging.getLogger(__name__)
+
+NEXT_PAGE = "SELECT telegram_id FROM users WHERE telegram_id > %s AND blocked = FALSE ORDER BY telegram_id LIMIT %s"
+
+_tasks = {}
+
+
+def _next_page(conn, after, limit):
+    cursor = conn.cursor()
+    try:
+        # Keyset pagination on the primary key, so each page is an index range scan.
+        cursor.execute(NEXT_PAGE, (after, limit))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def _checkpoint(conn, broadcast_id, cursor_id, sent, failed, deferred, status):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "UPDATE broadcasts SET cursor_id = %s, sent = %s, failed = %s, deferred = %s, status = %s "
+            "WHERE broadcast_id = %s AND status = 'running'",
+            (cursor_id, sent, failed, deferred, status, broadcast_id)
+        )
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def _format_progress(status, total, sent, failed, deferred, elapsed, processed):
+    done = sent + failed + deferred
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    remaining = max(total - done, 0)
+    if status == "done":
+        header = "✅ ارسال همگانی به پایان رسید."
+    elif status == "cancelled":
+        header = "🛑 ارسال همگانی لغو شد."
+    else:
+        header = "📣 در حال ارسال همگانی..."
+    lines = [
+        header,
+        f"📨 ارسال‌شده: {sent}",
+        f"❌ ناموفق: {failed}",
+    ]
+    if deferred:
+        # Hit flood limits or network errors; the outbox retries these later, outside this report.
+        lines.append(f"⏸ به تعویق افتاده (ارسال مجدد خودکار): {deferred}")
+    lines += [
+        f"📊 پیشرفت: {done}/{total}",
+        f"⚡ سرعت: {rate:.1f} پیام در ثانیه",
+    ]
+    if status == "running" and rate > 0:
+        lines.append(f"⏳ زمان باقی‌مانده: {int(remaining / rate)} ثانیه")
+    return "\n".join(lines)
+
+
+async def _edit_progress(bot, admin_chat_id, message_id, text):
+    if not message_id:
+        return
+    try:
+        await bot.edit_message_text(chat_id=admin_chat_id, message_id=message_id, text=text)
+    except TelegramError as e:
+        logger.debug("Could not update broadcast progress message: %s", e)
+
+
+async def _run(bot, broadcast_id):
+    page_size = int(os.getenv("BROADCAST_PAGE_SIZE") or 200)
+    progress_interval = float(os.getenv("BROADCAST_PROGRESS_INTERVAL") or 5)
+    row = await db.fetchone(
+        "SELECT broadcast_id, text, status, cursor_id, total, sent, failed, deferred, admin_chat_id, "
+        "progress_message_id FROM broadcasts WHERE broadcast_id = %s",
+        (broadcast_id,)
+    )
+    if row is None or row[2] != "running":
+        return
+    _, text, _, cursor_id, total, sent, failed, deferred, admin_chat_id, message_id = row
+    started = time.monotonic()
+    last_progress = 0.0
+    processed = 0
+    logger.info(
+        "Broadcast %s running from cursor '%s' (%s/%s)", broadcast_id, cursor_id, sent + failed + deferred, total
+    )
+
+    while True:
+        recipients = await db.run(_next_page, cursor_id, page_size)
+        if not recipients:
+            break
+        futures = [outbox.send_message(chat_id, outbox.PRIORITY_BULK, text=text) for chat_id in recipients]
+        # Waiting for the whole page keeps at most one page in the outbox, so memory stays flat
+        # and admin/payment messages are never stuck behind the full user list.
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                failed += 1
+            elif result is outbox.DEFERRED:
+                deferred += 1
+            else:
+                sent += 1
+        processed += len(recipients)
+        cursor_id = recipients[-1]
+        if not await db.run(_checkpoint, broadcast_id, cursor_id, sent, failed, deferred, "running"):
+            # Cancelled, possibly from another worker.
+            logger.info("Broadcast %s was cancelled at cursor '%s'", broadcast_id, cursor_id)
+            return
+        now = time.monotonic()
+        if now - last_progress >= progress_interval:
+            last_progress = now
+            await _edit_progress(
+                bot, admin_chat_id, message_id,
+                _format_progress("running", total, sent, failed, deferred, now - started, processed)
+            )
+        if len(recipients) < page_size:
+            break
+
+    await db.run(_checkpoint, broadcast_id, cursor_id, sent, failed, deferred, "done")
+    await _edit_progress(
+        bot, admin_chat_id, message_id,
+        _format_progress("done", total, sent, failed, deferred, time.monotonic() - started, processed)
+    )
+    logger.info("Broadcast %s finished: %s sent, %s failed, %s deferred", broadcast_id, sent, failed, deferred)
+
+
+def _spawn(bot, broadcast_id):
+    async def runner():
+        try:
+            await _run(bot, broadcast_id)
+        except asyncio.CancelledError:
+            # The checkpoint stays 'running', so the broadcast resumes on the next start.
+            raise
+        except mysql.connector.Error as e:
+            logger.error("Broadcast %s stopped on database error: %s", broadcast_id, e)
+        finally:
+            _tasks.pop(broadcast_id, None)
+
+    _tasks[broadcast_id] = asyncio.get_running_loop().create_task(runner(), name=f"broadcast-{broadcast_id}")
+
+
+async def start(bot, text, admin_chat_id, progress_message_id):
+    broadcast_id = str(uuid.uuid4())
+    total = (await db.fetchone("SELECT COUNT(*) FROM users WHERE blocked = FALSE"))[0]
+    await db.execute(
+        "INSERT INTO broadcasts (broadcast_id, text, status, total, admin_chat_id, progress_message_id) "
+        "VALUES (%s, %s, 'running', %s, %s, %s)",
+        (broadcast_id, text, total, admin_chat_id, progress_message_id)
+    )
+    _spawn(bot, broadcast_id)
+    return broadcast_id, total
+
+
+async def resume(bot):
+    """Restart every broadcast left 'running' by a previous process."""
+    rows = await db.fetchall("SELECT broadcast_id FROM broadcasts WHERE status = 'running' ORDER BY created_at")
+    for (broadcast_id,) in rows:
+        if broadcast_id not in _tasks:
+            _spawn(bot, broadcast_id)
+    return len(rows)
+
+
+async def cancel():
+    cancelled = await db.execute("UPDATE broadcasts SET status = 'cancelled' WHERE status = 'running'")
+    for task in list(_tasks.values()):
+        task.cancel()
+    return cancelled
+
+
+async def stop():
+    """Stop running broadcasts on shutdown without changing their checkpoint."""
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,165 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """Bounded LRU cache with per-entry expiry and single-flight loading.
+
+    Values for which `is_negative(value)` is true (by default None) are kept for
+    `negative_ttl` seconds instead of `ttl`, so failed or unknown lookups are retried sooner.
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl=None, is_negative=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.is_negative = is_negative or (lambda value: value is None)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+        # Bumped by invalidate()/clear() so a load that started before a write is not cached.
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _lookup(self, key, now):
+        # Caller holds self._lock.
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at <= now:
+            del self._data[key]
+            self.expirations += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key, time.monotonic())
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, epoch=None):
+        if ttl is None:
+            ttl = self.negative_ttl if self.is_negative(value) else self.ttl
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._epoch += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._epoch += 1
+
+    def get_or_load(self, key, loader):
+        """Return the cached value or call loader(); concurrent callers share one call."""
+        with self._lock:
+            value = self._lookup(key, time.monotonic())
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+            epoch = self._epoch
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = loader()
+            self.set(key, flight.value, epoch=epoch)
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    async def aget_or_load(self, key, loader):
+        """Async variant of get_or_load(); `loader` is a coroutine function."""
+        with self._lock:
+            value = self._lookup(key, time.monotonic())
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+            epoch = self._epoch
+            future = self._async_flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._async_flights[key] = future
+        try:
+            value = await loader()
+            self.set(key, value, epoch=epoch)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting for it.
+            future.exception()
+            raise
+        finally:
+            self._async_flights.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,218 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+import zlib
+
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Bot, Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def _has_secret(request, secret):
+    # Constant-time, so response timing does not reveal how much of a guess was right.
+    return hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), secret.encode())
+
+
+def chat_key(data):
+    """Chat (or user) id of a raw update dict, used to pin a chat to one worker."""
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return str(chat["id"])
+        sender = value.get("from") or value.get("user")
+        if sender and "id" in sender:
+            return str(sender["id"])
+    return None
+
+
+def shard_for(key, count):
+    # crc32 is stable across processes, unlike hash() on str.
+    return zlib.crc32(key.encode()) % count if key is not None else 0
+
+
+class ChatSerialUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently, but never two updates of the same chat at once.
+
+    An update waits for its chat first and only then for one of the max_concurrent_updates
+    slots, so a chat sending a burst queues behind itself without holding slots other chats need.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # key -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_update(self, update, coroutine):
+        if not isinstance(update, Update) or (update.effective_chat is None and update.effective_user is None):
+            await super().process_update(update, coroutine)
+            return
+        key = update.effective_chat.id if update.effective_chat else update.effective_user.id
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                # Takes the concurrency slot, then calls do_process_update.
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+
+class _WorkerUpdateHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app, secret):
+        self.bot_app = bot_app
+        self.secret = secret
+
+    async def post(self):
+        if not _has_secret(self.request, self.secret):
+            self.set_status(403)
+            return
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_app.bot)
+        except ValueError:
+            self.set_status(400)
+            return
+        # The update queue is bounded: when it is full the router waits here, and so does Telegram.
+        await self.bot_app.update_queue.put(update)
+        self.set_status(200)
+
+
+class _RouterHandler(tornado.web.RequestHandler):
+    def initialize(self, client, workers, secret):
+        self.client = client
+        self.workers = workers
+        self.secret = secret
+
+    async def post(self):
+        if not _has_secret(self.request, self.secret):
+            self.set_status(403)
+            return
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        worker = self.workers[shard_for(chat_key(data), len(self.workers))]
+        try:
+            response = await self.client.post(
+                worker,
+                content=self.request.body,
+                headers={"Content-Type": "application/json", SECRET_HEADER: self.secret}
+            )
+            self.set_status(response.status_code)
+        except httpx.HTTPError as e:
+            # A non-2xx answer makes Telegram redeliver the update later.
+            logger.error("Forwarding update to %s failed: %s", worker, e)
+            self.set_status(502)
+
+
+async def _wait_for_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+async def _serve_worker(app: Application, listen, port, path, secret):
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    server = HTTPServer(tornado.web.Application([
+        (f"/{path}", _WorkerUpdateHandler, {"bot_app": app, "secret": secret}),
+    ]))
+    server.listen(port, address=listen)
+    logger.info("Worker listening on %s:%s/%s", listen, port, path)
+    try:
+        await _wait_for_signal()
+    finally:
+        server.stop()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+def run_worker(app: Application):
+    """Process updates forwarded by the router instead of talking to Telegram for them."""
+    secret = os.getenv("WEBHOOK_SECRET")
+    if not secret:
+        raise RuntimeError("WEBHOOK_SECRET must be set when BOT_MODE=worker")
+    asyncio.run(_serve_worker(
+        app,
+        listen=os.getenv("WORKER_LISTEN") or "127.0.0.1",
+        port=int(os.getenv("WORKER_PORT") or 8450),
+        path=(os.getenv("WORKER_PATH") or "updates").strip("/"),
+        secret=secret
+    ))
+
+
+async def _serve_router(token, api_url, workers, listen, port, path, webhook_url, secret, max_connections):
+    bot_kwargs = {}
+    if api_url:
+        bot_kwargs = {"base_url": f"{api_url.rstrip('/')}/bot", "base_file_url": f"{api_url.rstrip('/')}/file/bot"}
+    async with Bot(token, **bot_kwargs) as bot:
+        await bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret,
+            max_connections=max_connections,
+            allowed_updates=Update.ALL_TYPES
+        )
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(30.0)) as client:
+        server = HTTPServer(tornado.web.Application([
+            (f"/{path}", _RouterHandler, {"client": client, "workers": workers, "secret": secret}),
+        ]))
+        server.listen(port, address=listen)
+        logger.info("Router listening on %s:%s/%s, forwarding to %s workers", listen, port, path, len(workers))
+        try:
+            await _wait_for_signal()
+        finally:
+            server.stop()
+
+
+def run_router():
+    """Receive Telegram's webhook and forward each update to the worker that owns its chat."""
+    secret = os.getenv("WEBHOOK_SECRET")
+    webhook_url = os.getenv("WEBHOOK_URL")
+    workers = [url.strip() for url in (os.getenv("WORKER_URLS") or "").split(",") if url.strip()]
+    if not (secret and webhook_url and workers):
+        raise RuntimeError("WEBHOOK_SECRET, WEBHOOK_URL and WORKER_URLS must be set when BOT_MODE=router")
+    path = (os.getenv("WEBHOOK_PATH") or "telegram").strip("/")
+    asyncio.run(_serve_router(
+        token=os.getenv("BOT_TOKEN"),
+        api_url=os.getenv("TELEGRAM_API_URL"),
+        workers=workers,
+        listen=os.getenv("WEBHOOK_LISTEN") or "127.0.0.1",
+        port=int(os.getenv("WEBHOOK_PORT") or 8443),
+        path=path,
+        webhook_url=f"{webhook_url.rstrip('/')}/{path}",
+        secret=secret,
+        max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS") or 40)
+    ))
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector
+from mysql.connector import errors
+from mysql.connector.constants import ClientFlag
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+pool = None
+_executor = None
+
+
+class PooledConnection:
+    """Connection handed out by the pool; close() returns it instead of disconnecting."""
+
+    __slots__ = ("_pool", "_conn")
+
+    def __init__(self, owner, conn):
+        self._pool = owner
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise errors.OperationalError("Connection already returned to the pool")
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def prepared(self, sql):
+        """Server-side prepared cursor for sql, reused for as long as this connection lives."""
+        return self._pool.prepared(self._conn, sql)
+
+    def unprepare(self, sql):
+        self._pool.unprepare(self._conn, sql)
+
+
+class ConnectionPool:
+    def __init__(self, size, timeout, recycle, ping_after, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._connect_args = connect_args
+        self._idle = deque()
+        self._lock = threading.Lock()
+        # id(connection) -> {sql: prepared cursor}; only touched by the thread holding the connection.
+        self._statements = {}
+        self._slots = threading.BoundedSemaphore(size)
+        self.in_use = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.created = 0
+        self.recycled = 0
+        self.broken = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self._connect_args)
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def _discard(self, conn):
+        self._statements.pop(id(conn), None)
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                item = self._idle.pop() if self._idle else None
+            if item is None:
+                return self._connect()
+            conn, last_used = item
+            idle_for = time.monotonic() - last_used
+            if idle_for > self.recycle:
+                with self._lock:
+                    self.recycled += 1
+                self._discard(conn)
+                continue
+            if idle_for > self.ping_after:
+                try:
+                    conn.ping(reconnect=False)
+                except mysql.connector.Error as e:
+                    logger.warning("Dropping broken pooled connection: %s", e)
+                    with self._lock:
+                        self.broken += 1
+                    self._discard(conn)
+                    continue
+            return conn
+
+    def prepared(self, conn, sql):
+        statements = self._statements.get(id(conn))
+        if statements is None:
+            statements = self._statements[id(conn)] = {}
+        cursor = statements.get(sql)
+        if cursor is None:
+            cursor = statements[sql] = conn.cursor(prepared=True)
+        return cursor
+
+    def unprepare(self, conn, sql):
+        cursor = self._statements.get(id(conn), {}).pop(sql, None)
+        if cursor is not None:
+            try:
+                cursor.close()
+            except mysql.connector.Error:
+                pass
+
+    def acquire(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise errors.PoolError(f"No free connection in pool after {self.timeout}s")
+        waited = time.monotonic() - started
+        with self._lock:
+            self.acquired += 1
+            self.in_use += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        try:
+            conn = self._checkout()
+        except BaseException:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+            raise
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        try:
+            if conn.unread_result:
+                conn.consume_results()
+            if conn.in_transaction:
+                conn.rollback()
+        except mysql.connector.Error as e:
+            logger.warning("Dropping pooled connection on release: %s", e)
+            with self._lock:
+                self.broken += 1
+            self._discard(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def prune_idle(self):
+        """Close idle connections that have not been used for longer than `recycle`."""
+        cutoff = time.monotonic() - self.recycle
+        stale = []
+        with self._lock:
+            # The deque is ordered by release time, so stale entries sit at the left.
+            while self._idle and self._idle[0][1] < cutoff:
+                stale.append(self._idle.popleft()[0])
+            self.recycled += len(stale)
+        for conn in stale:
+            self._discard(conn)
+        return len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "acquired": self.acquired,
+                "created": self.created,
+                "recycled": self.recycled,
+                "broken": self.broken,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": round(self.wait_total / self.acquired * 1000, 3) if self.acquired else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+def init_pool():
+    global pool, _executor
+    if pool is not None:
+        return pool
+    pool = ConnectionPool(
+        size=int(os.getenv("MYSQL_POOL_SIZE") or 10),
+        timeout=float(os.getenv("MYSQL_POOL_TIMEOUT") or 5),
+        recycle=float(os.getenv("MYSQL_POOL_RECYCLE") or 3600),
+        ping_after=float(os.getenv("MYSQL_POOL_PING_AFTER") or 60),
+        host=os.getenv("MYSQL_HOST", "127.0.0.1"),
+        port=int(os.getenv("MYSQL_PORT") or 3307),
+        user=os.getenv("MYSQL_USER", "root"),
+        password=os.getenv("MYSQL_PASSWORD"),
+        database=os.getenv("MYSQL_DATABASE") or "dnsbot",
+        autocommit=True,
+        # Report matched rather than changed rows, so re-saving an unchanged value still counts.
+        client_flags=[ClientFlag.FOUND_ROWS]
+    )
+    # One worker per pooled connection: queries never wait on a thread while holding a
+    # connection, and a burst of slow queries cannot grow the thread count unbounded.
+    _executor = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="db")
+    logger.info("MySQL pool created with %s connections", pool.size)
+    return pool
+
+
+def get_connection():
+    if pool is None:
+        raise errors.PoolError("Connection pool is not initialised")
+    return pool.acquire()
+
+
+def close_pool():
+    global pool, _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    if pool is not None:
+        pool.close_all()
+        pool = None
+
+
+def _call(func, args):
+    conn = get_connection()
+    try:
+        return func(conn, *args)
+    finally:
+        conn.close()
+
+
+async def run(func, *args):
+    """Run func(conn, *args) on a pooled connection in the DB thread pool."""
+    if _executor is None:
+        raise errors.PoolError("Connection pool is not initialised")
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, _call, func, args)
+    finally:
+        metrics.observe_query(time.perf_counter() - started)
+
+
+def _fetchone(conn, sql, params):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def _fetchall(conn, sql, params):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _execute(conn, sql, params):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+async def fetchone(sql, params=()):
+    return await run(_fetchone, sql, params)
+
+
+async def fetchall(sql, params=()):
+    return await run(_fetchall, sql, params)
+
+
+async def execute(sql, params=()):
+    return await run(_execute, sql, params)
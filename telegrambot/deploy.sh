@@ -12,7 +12,8 @@ if [ -f "$LOCK_FILE" ]; then
     rm -f "$LOCK_FILE"
 fi
 # Kill running bot, web, and Docker processes
-pkill -f "python3.*(bot.py|web.py)" 2>/dev/null
+pkill -f "python3.*(bot.py|web.py|metrics.py)" 2>/dev/null
+pkill -f "hypercorn web:app" 2>/dev/null
 docker rm -f $(docker ps -aq) 2>/dev/null
 docker network prune -f 2>/dev/null
 sleep 2
@@ -44,7 +45,7 @@ chmod +x /usr/local/bin/docker-compose
 
 # 6. Install Python modules with no cache and force reinstall
 echo "Installing Python modules with no cache and force reinstall..."
-pip3 install --no-cache-dir --force-reinstall "python-telegram-bot[job-queue]==22.3" mysql-connector-python==9.4.0 python-dotenv==1.1.1 requests==2.32.5 flask==3.1.1
+pip3 install --no-cache-dir --force-reinstall "python-telegram-bot[job-queue,webhooks]==22.3" mysql-connector-python==9.4.0 python-dotenv==1.1.1 quart==0.22.0 hypercorn==0.18.0 prometheus-client==0.26.0
 
 # 7. Create project directory
 echo "Creating project directory..."
@@ -84,8 +85,75 @@ MYSQL_PASSWORD=$mysql_password
 IPDNS1=$ipdns1
 IPDNS2=$ipdns2
 MYSQL_HOST=127.0.0.1
+MYSQL_POOL_SIZE=10
+MYSQL_POOL_TIMEOUT=5
+MYSQL_POOL_RECYCLE=3600
+DB_MIGRATE_ON_START=1
+BOT_CONCURRENT_UPDATES=64
+GEOIP_DB_PATH=geoip.csv
+GEOIP_RELOAD_INTERVAL=3600
+GEOIP_CACHE_SIZE=50000
+GEOIP_CACHE_TTL=86400
+GEOIP_CACHE_NEGATIVE_TTL=300
+EXPIRY_CHUNK_SIZE=500
+EXPIRY_DELETE_BATCH=200
+EXPIRY_RETENTION_DAYS=7
+OUTBOX_GLOBAL_RATE=25
+OUTBOX_CHAT_RATE=1
+OUTBOX_WORKERS=4
+OUTBOX_MAX_ATTEMPTS=5
+BROADCAST_PAGE_SIZE=200
+BROADCAST_PROGRESS_INTERVAL=5
+STATS_CACHE_TTL=30
+SERVICE_CACHE_SIZE=10000
+SERVICE_CACHE_TTL=300
+SERVICE_CACHE_NEGATIVE_TTL=30
+CACHE_POLL_INTERVAL=1
+CACHE_INVALIDATION_RETENTION=3600
+MEMBERSHIP_RECONCILE_INTERVAL=3600
+MEMBERSHIP_MERGE_AT=50000
+ALLOWLIST_TOKEN=$(openssl rand -hex 32)
+ALLOWLIST_RETENTION_DAYS=7
+ALLOWLIST_URL=http://127.0.0.1:5001
+IPINDEX_LISTEN=127.0.0.1
+IPINDEX_PORT=8553
+IPINDEX_POLL_INTERVAL=1
+SNAPSHOT_PATH=allowlist.bin
+SNAPSHOT_INTERVAL=1
+PAYMENT_BATCH_SIZE=50
+PAYMENT_DEDUP_TTL=3600
+BOT_MODE=polling
+BOT_UPDATE_QUEUE_SIZE=1000
+WEBHOOK_URL=
+WEBHOOK_PATH=telegram
+WEBHOOK_LISTEN=127.0.0.1
+WEBHOOK_PORT=8443
+WEBHOOK_SECRET=$(openssl rand -hex 32)
+WEBHOOK_MAX_CONNECTIONS=40
+BOT_RUN_JOBS=1
+WORKER_URLS=
+WORKER_LISTEN=127.0.0.1
+WORKER_PORT=8450
+WORKER_PATH=updates
+STATE_FLUSH_INTERVAL=10
+STATE_TTL=86400
+METRICS_LISTEN=127.0.0.1
+METRICS_PORT=9101
+WEB_METRICS_LISTEN=127.0.0.1
+WEB_METRICS_PORT=9102
+LOG_LEVEL=INFO
+LOG_DEBUG_SAMPLE=10
+LOG_MAX_BYTES=10485760
+LOG_BACKUP_COUNT=5
+LOG_QUEUE_SIZE=10000
 EOL
 
+# Download the offline GeoIP dataset and refresh it monthly
+echo "Downloading GeoIP dataset..."
+chmod +x update_geoip.sh
+./update_geoip.sh
+(crontab -l 2>/dev/null | grep -v update_geoip.sh; echo "0 4 3 * * $(pwd)/update_geoip.sh >> $(pwd)/geoip.log 2>&1") | crontab -
+
 # 11. Set up MySQL database
 echo "Setting up MySQL database..."
 mysql -u root << EOL
@@ -95,54 +163,7 @@ GRANT ALL PRIVILEGES ON dnsbot.* TO 'root'@'localhost';
 FLUSH PRIVILEGES;
 EOL
 
-# 12. Apply database schema directly with index check
-echo "Applying database schema..."
-mysql -u root -p"$mysql_password" dnsbot << 'EOL'
-DROP INDEX IF EXISTS idx_services_telegram_id ON services;
-DROP INDEX IF EXISTS idx_pending_payments_telegram_id ON pending_payments;
-DROP INDEX IF EXISTS idx_pending_payments_service_id ON pending_payments;
-
-CREATE TABLE IF NOT EXISTS users (
-    telegram_id VARCHAR(255) PRIMARY KEY,
-    blocked BOOLEAN DEFAULT FALSE,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-
-CREATE TABLE IF NOT EXISTS services (
-    service_id VARCHAR(36) PRIMARY KEY,
-    telegram_id VARCHAR(255) NOT NULL,
-    name VARCHAR(255) NOT NULL,
-    ip_address VARCHAR(45),
-    purchase_date DATETIME NOT NULL,
-    expiry_date DATETIME NOT NULL,
-    duration INT NOT NULL,
-    status ENUM('active', 'expired') NOT NULL,
-    is_test BOOLEAN DEFAULT FALSE,
-    deleted BOOLEAN DEFAULT FALSE,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-
-CREATE TABLE IF NOT EXISTS pending_payments (
-    payment_id VARCHAR(36) PRIMARY KEY,
-    telegram_id VARCHAR(255) NOT NULL,
-    service_id VARCHAR(36) NOT NULL,
-    service_name VARCHAR(255) NOT NULL,
-    duration INT NOT NULL,
-    price INT NOT NULL,
-    caption TEXT,
-    status ENUM('pending', 'approved', 'rejected') NOT NULL,
-    reason TEXT,
-    is_renewal BOOLEAN DEFAULT FALSE,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (telegram_id) REFERENCES users(telegram_id),
-    FOREIGN KEY (service_id) REFERENCES services(service_id)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-
-CREATE INDEX idx_services_telegram_id ON services(telegram_id);
-CREATE INDEX idx_pending_payments_telegram_id ON pending_payments(telegram_id);
-CREATE INDEX idx_pending_payments_service_id ON pending_payments(service_id);
-EOL
+# 12. The schema is applied by migrations.py once the database container is up (step 15)
 
 # 13. Create docker-compose.yml with corrected MySQL settings
 echo "Creating docker-compose.yml..."
@@ -182,14 +203,22 @@ if ! mysqladmin -u root -p"$mysql_password" -h 127.0.0.1 -P 3307 ping 2>/dev/nul
     exit 1
 fi
 
-# 15. Free port 5000 and set up Python virtual environment
-echo "Freeing port 5000 and setting up Python virtual environment..."
-fuser -k 5000/tcp 2>/dev/null
+# 15. Free port 5001 and set up Python virtual environment
+echo "Freeing port 5001 and setting up Python virtual environment..."
+fuser -k 5001/tcp 2>/dev/null
 python3 -m venv venv
 source venv/bin/activate
 pip install --no-cache-dir -r requirements.txt
+# Create or upgrade the schema; every step is online and safe to re-run
+if ! python3 migrations.py migrate; then
+    echo "Error: database migration failed."
+    exit 1
+fi
 python3 bot.py &
-FLASK_APP=web.py FLASK_RUN_PORT=5001 python3 -m flask run --no-debugger &
+# Each hypercorn worker writes its metrics here; metrics.py serves them merged on WEB_METRICS_PORT
+rm -rf "$(pwd)/prometheus_web" && mkdir -p "$(pwd)/prometheus_web"
+PROMETHEUS_MULTIPROC_DIR="$(pwd)/prometheus_web" hypercorn web:app --bind 127.0.0.1:5001 --workers 4 --worker-class asyncio &
+PROMETHEUS_MULTIPROC_DIR="$(pwd)/prometheus_web" python3 metrics.py serve &
 deactivate
 
 # 16. Clean up lock file
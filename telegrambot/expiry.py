@@ -0,0 +1,136 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import allowlist
+import db
+import servicecache
+
+logger = logging.getLogger(__name__)
+
+# Shared with migrations.CHECKED_QUERIES; {} is filled with one placeholder per id.
+DUE_SERVICES = (
+    "SELECT service_id, telegram_id, ip_address FROM services "
+    "WHERE status = 'active' AND expiry_date <= NOW() AND deleted = FALSE "
+    "ORDER BY expiry_date LIMIT %s"
+)
+EXPIRE_SERVICES = (
+    "UPDATE services SET status = 'expired', ip_address = NULL "
+    "WHERE service_id IN ({}) AND status = 'active' AND expiry_date <= NOW()"
+)
+UNNOTIFIED_TESTS = (
+    "SELECT service_id, telegram_id, name FROM services "
+    "WHERE status = 'expired' AND is_test = TRUE AND deleted = FALSE AND notified_at IS NULL "
+    "ORDER BY expiry_date LIMIT %s FOR UPDATE"
+)
+DELETABLE_SERVICES = (
+    "SELECT service_id, telegram_id FROM services "
+    "WHERE status = 'expired' AND expiry_date <= %s AND deleted = FALSE AND is_test = FALSE "
+    "ORDER BY expiry_date LIMIT %s"
+)
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def expire_chunk(conn, limit):
+    """Mark up to `limit` overdue active services expired and return (service_id, telegram_id, ip_address) rows."""
+    conn.start_transaction()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(DUE_SERVICES, (limit,))
+        rows = cursor.fetchall()
+        if rows:
+            ids = [row[0] for row in rows]
+            # Re-check the predicate so a renewal that landed after the SELECT is not expired.
+            cursor.execute(EXPIRE_SERVICES.format(_placeholders(ids)), ids)
+            allowlist.record(cursor, [row[0] for row in rows if row[2]])
+        conn.commit()
+        return rows
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def claim_notifications(conn, limit):
+    """Claim up to `limit` expired test services that have not been notified yet.
+
+    notified_at is set before anything is sent, so a row is handed out at most once: the
+    rows are locked, and an overlapping sweep waits for this commit and then no longer
+    matches them.
+    """
+    conn.start_transaction()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(UNNOTIFIED_TESTS, (limit,))
+        rows = cursor.fetchall()
+        if rows:
+            ids = [row[0] for row in rows]
+            cursor.execute(
+                f"UPDATE services SET notified_at = NOW() "
+                f"WHERE service_id IN ({_placeholders(ids)}) AND notified_at IS NULL",
+                ids
+            )
+        conn.commit()
+        return rows
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def delete_batch(conn, cutoff, limit):
+    """Delete up to `limit` long-expired purchased services and return their (service_id, telegram_id) rows."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(DELETABLE_SERVICES, (cutoff, limit))
+        rows = cursor.fetchall()
+        if rows:
+            ids = [row[0] for row in rows]
+            cursor.execute(
+                f"DELETE FROM services WHERE service_id IN ({_placeholders(ids)}) AND status = 'expired'",
+                ids
+            )
+        return rows
+    finally:
+        cursor.close()
+
+
+async def sweep(notify):
+    """Run one expiry pass; `notify(service_id, telegram_id, name)` is awaited per claimed test service."""
+    chunk_size = int(os.getenv("EXPIRY_CHUNK_SIZE") or 500)
+    delete_batch_size = int(os.getenv("EXPIRY_DELETE_BATCH") or 200)
+    retention_days = int(os.getenv("EXPIRY_RETENTION_DAYS") or 7)
+    started = time.monotonic()
+    report = {"expired": 0, "deleted": 0, "notifications_queued": 0}
+
+    while True:
+        rows = await db.run(expire_chunk, chunk_size)
+        report["expired"] += len(rows)
+        await servicecache.invalidate_many((telegram_id, service_id) for service_id, telegram_id, _ in rows)
+        if len(rows) < chunk_size:
+            break
+
+    while True:
+        rows = await db.run(claim_notifications, chunk_size)
+        for service_id, telegram_id, name in rows:
+            await notify(service_id, telegram_id, name)
+            report["notifications_queued"] += 1
+        if len(rows) < chunk_size:
+            break
+
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    while True:
+        rows = await db.run(delete_batch, cutoff, delete_batch_size)
+        report["deleted"] += len(rows)
+        await servicecache.invalidate_many((telegram_id, service_id) for service_id, telegram_id in rows)
+        if len(rows) < delete_batch_size:
+            break
+
+    report["duration_s"] = round(time.monotonic() - started, 3)
+    return report
@@ -0,0 +1,239 @@
+import bisect
+import csv
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+from array import array
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+table = None
+_reload_lock = threading.Lock()
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class GeoIPUnavailable(Exception):
+    """No dataset is loaded yet (still loading at startup, or every load failed)."""
+
+
+class _U128Array:
+    """Sorted 128-bit integers stored as two 64-bit arrays, indexable for bisect."""
+
+    __slots__ = ("hi", "lo")
+
+    def __init__(self):
+        self.hi = array("Q")
+        self.lo = array("Q")
+
+    def append(self, value):
+        self.hi.append(value >> 64)
+        self.lo.append(value & 0xFFFFFFFFFFFFFFFF)
+
+    def __len__(self):
+        return len(self.hi)
+
+    def __getitem__(self, i):
+        return (self.hi[i] << 64) | self.lo[i]
+
+
+class CountryTable:
+    """Non-overlapping IP ranges sorted by start address, one table per family."""
+
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.v4_starts = array("I")
+        self.v4_ends = array("I")
+        self.v4_codes = bytearray()
+        self.v6_starts = _U128Array()
+        self.v6_ends = _U128Array()
+        self.v6_codes = bytearray()
+
+    def __len__(self):
+        return len(self.v4_starts) + len(self.v6_starts)
+
+    def _add(self, version, start, end, country):
+        code = country.strip().upper().encode("ascii", "replace")[:2]
+        if len(code) != 2:
+            return
+        if version == 4:
+            self.v4_starts.append(start)
+            self.v4_ends.append(end)
+            self.v4_codes += code
+        else:
+            self.v6_starts.append(start)
+            self.v6_ends.append(end)
+            self.v6_codes += code
+
+    def _sort(self):
+        """Order both families by start address; only needed for datasets that are not already sorted."""
+        for family in ("v4", "v6"):
+            starts = getattr(self, f"{family}_starts")
+            ends = getattr(self, f"{family}_ends")
+            codes = getattr(self, f"{family}_codes")
+            order = sorted(range(len(starts)), key=starts.__getitem__)
+            new_starts, new_ends = (array("I"), array("I")) if family == "v4" else (_U128Array(), _U128Array())
+            new_codes = bytearray()
+            for i in order:
+                new_starts.append(starts[i])
+                new_ends.append(ends[i])
+                new_codes += codes[2 * i:2 * i + 2]
+            setattr(self, f"{family}_starts", new_starts)
+            setattr(self, f"{family}_ends", new_ends)
+            setattr(self, f"{family}_codes", new_codes)
+
+    @staticmethod
+    def _search(starts, ends, codes, value):
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        return codes[2 * i:2 * i + 2].decode("ascii")
+
+    def lookup(self, ip):
+        try:
+            addr = ipaddress.ip_address(ip.strip() if isinstance(ip, str) else ip)
+        except ValueError:
+            return None
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+        if addr.version == 4:
+            return self._search(self.v4_starts, self.v4_ends, self.v4_codes, int(addr))
+        return self._search(self.v6_starts, self.v6_ends, self.v6_codes, int(addr))
+
+
+def _address(text):
+    """(version, integer) of an IP in text; raises OSError/ValueError if it is not one."""
+    text = text.strip()
+    if ":" in text:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, text), "big")
+    return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, text), "big")
+
+
+def _rows(path):
+    """(version, start, end, country) per range, as integers; no ipaddress objects per row."""
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith("#"):
+                continue
+            try:
+                if len(row) >= 3 and "/" not in row[0]:
+                    # start_ip,end_ip,country (db-ip / ip2location "lite" layout)
+                    version, start = _address(row[0])
+                    end_version, end = _address(row[1])
+                    if end_version != version:
+                        continue
+                    yield version, start, end, row[2]
+                elif len(row) >= 2:
+                    # network/prefix,country
+                    text, _, prefix = row[0].partition("/")
+                    version, start = _address(text)
+                    host_bits = (32 if version == 4 else 128) - int(prefix or (32 if version == 4 else 128))
+                    if host_bits < 0:
+                        continue
+                    start = start >> host_bits << host_bits
+                    yield version, start, start | ((1 << host_bits) - 1), row[1]
+            except (OSError, ValueError):
+                continue
+
+
+def load(path):
+    """Build a table from the CSV; db-ip's files are sorted, so rows are appended as they stream in."""
+    started = time.monotonic()
+    mtime = os.path.getmtime(path)
+    new_table = CountryTable(path, mtime)
+    last = {4: -1, 6: -1}
+    in_order = True
+    for version, start, end, country in _rows(path):
+        if start < last[version]:
+            in_order = False
+        last[version] = start
+        new_table._add(version, start, end, country)
+    if not in_order:
+        new_table._sort()
+    if not len(new_table):
+        raise ValueError("no usable ranges")
+    logger.info("Loaded %s GeoIP ranges from %s in %.2fs", len(new_table), path, time.monotonic() - started)
+    return new_table
+
+
+def reload_if_changed(path=None):
+    """Load the dataset if it is new or its mtime changed; the swap is a single assignment."""
+    global table
+    path = path or os.getenv("GEOIP_DB_PATH") or "geoip.csv"
+    with _reload_lock:
+        try:
+            mtime = os.path.getmtime(path)
+            if table is not None and table.path == path and table.mtime == mtime:
+                return False
+            table = load(path)
+            if _cache is not None:
+                _cache.clear()
+            return True
+        except (OSError, ValueError, csv.Error) as e:
+            logger.error("Failed to load GeoIP dataset %s: %s", path, e)
+            return False
+
+
+def start_auto_reload(interval=None, path=None):
+    """Load the dataset in a background thread, then reload it when it changes.
+
+    Raises RuntimeError if there is no dataset at all, so a misdeployed process fails at startup
+    instead of rejecting every IP; until the first load finishes lookups raise GeoIPUnavailable.
+    """
+    interval = float(interval or os.getenv("GEOIP_RELOAD_INTERVAL") or 3600)
+    dataset = path or os.getenv("GEOIP_DB_PATH") or "geoip.csv"
+    if not os.path.isfile(dataset):
+        raise RuntimeError(f"GeoIP dataset {dataset} not found; run update_geoip.sh")
+
+    def loop():
+        reload_if_changed(path)
+        while True:
+            time.sleep(interval)
+            reload_if_changed(path)
+            logger.info("GeoIP cache stats: %s", cache_stats())
+
+    thread = threading.Thread(target=loop, name="geoip-reload", daemon=True)
+    thread.start()
+    return thread
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TTLCache(
+                    maxsize=int(os.getenv("GEOIP_CACHE_SIZE") or 50000),
+                    ttl=float(os.getenv("GEOIP_CACHE_TTL") or 86400),
+                    negative_ttl=float(os.getenv("GEOIP_CACHE_NEGATIVE_TTL") or 300)
+                )
+    return _cache
+
+
+def _lookup(ip):
+    current = table
+    if current is None:
+        raise GeoIPUnavailable("GeoIP dataset is not loaded")
+    return current.lookup(ip)
+
+
+def country_of(ip):
+    if not isinstance(ip, str):
+        return None
+    ip = ip.strip()
+    return _get_cache().get_or_load(ip, lambda: _lookup(ip))
+
+
+def cache_stats():
+    return _get_cache().stats()
+
+
+def is_iranian_ip(ip):
+    """Raises GeoIPUnavailable while no dataset is loaded."""
+    return country_of(ip) == "IR"
@@ -0,0 +1,180 @@
+"""In-memory index of the client IPs that have an active service, for the DNS frontend.
+
+    python ipindex.py serve     # follow the allowlist feed and answer lookups over UDP
+
+IPs are kept as canonical text (what inet_ntop returns, which is also how sockets report
+peers) in a dict of how many services use each, so a lookup of a well-formed address is a
+single hash probe; only IPv6 text and packed addresses are normalised first. The index
+follows allowlist.py's feed: load() takes a snapshot, apply() the changes after it.
+Lookups never touch the database.
+
+The UDP service takes one or more newline-separated IPs per datagram and answers with one
+byte per IP, b"1" if it is allowed and b"0" if not.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+from collections import Counter
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+V4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+
+def canonical(ip):
+    """Canonical text of an IP given as text or packed bytes, or None if it is not an IP."""
+    if isinstance(ip, str):
+        try:
+            packed = socket.inet_pton(socket.AF_INET6 if ":" in ip else socket.AF_INET, ip)
+        except (OSError, ValueError):
+            return None
+    else:
+        packed = ip
+    if len(packed) == 16 and packed[:12] == V4_MAPPED_PREFIX:
+        # Dual-stack sockets report IPv4 clients as ::ffff:a.b.c.d.
+        packed = packed[12:]
+    if len(packed) == 4:
+        return socket.inet_ntop(socket.AF_INET, packed)
+    if len(packed) == 16:
+        return socket.inet_ntop(socket.AF_INET6, packed)
+    return None
+
+
+class IPIndex:
+    def __init__(self):
+        self.seq = None
+        self._owners = {}
+        self._counts = Counter()
+
+    @property
+    def loaded(self):
+        return self.seq is not None
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, ip):
+        if ip in self._counts:
+            return True
+        # IPv4 text that missed is either not allowed or not canonical, and then not an IP
+        # a socket would report.
+        if isinstance(ip, str) and ":" not in ip:
+            return False
+        return canonical(ip) in self._counts
+
+    def ips(self):
+        """The allowed IPs, as canonical text."""
+        return self._counts.keys()
+
+    def load(self, seq, services):
+        """Replace the contents with a snapshot: [(service_id, ip)] current as of seq; call before apply()."""
+        owners = {}
+        for service_id, ip in services:
+            ip = canonical(ip)
+            if ip is not None:
+                owners[service_id] = ip
+        self._owners = owners
+        self._counts = Counter(owners.values())
+        self.seq = seq
+
+    def apply(self, changes):
+        """Apply [(seq, service_id, ip or None)] in seq order; changes already seen are skipped."""
+        counts = self._counts
+        for seq, service_id, ip in changes:
+            if seq <= self.seq:
+                continue
+            old = self._owners.pop(service_id, None)
+            if old is not None:
+                counts[old] -= 1
+                if not counts[old]:
+                    del counts[old]
+            ip = canonical(ip) if ip else None
+            if ip is not None:
+                self._owners[service_id] = ip
+                counts[ip] += 1
+            self.seq = seq
+
+    def stats(self):
+        return {"seq": self.seq, "services": len(self._owners), "ips": len(self._counts)}
+
+
+async def follow(index, url, token, interval):
+    """Keep index in step with the allowlist feed served by web.py at url."""
+    async with httpx.AsyncClient(
+        base_url=url.rstrip("/"), headers={"Authorization": f"Bearer {token}"}, timeout=30
+    ) as client:
+        while True:
+            try:
+                if not index.loaded:
+                    response = await client.get("/api/allowlist/snapshot")
+                    response.raise_for_status()
+                    body = response.json()
+                    index.load(body["seq"], body["services"])
+                    logger.info("Loaded allowlist snapshot: %s", index.stats())
+                response = await client.get("/api/allowlist/changes", params={"since": index.seq})
+                if response.status_code == 410:
+                    logger.warning("Allowlist changes after %s were pruned; reloading the snapshot", index.seq)
+                    index.seq = None
+                    continue
+                response.raise_for_status()
+                body = response.json()
+                index.apply(body["changes"])
+                if body["more"]:
+                    continue
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                logger.error("Failed to sync the allowlist: %s", e)
+            await asyncio.sleep(interval)
+
+
+class _LookupProtocol(asyncio.DatagramProtocol):
+    def __init__(self, index):
+        self.index = index
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            ips = data.decode("ascii").split()
+        except UnicodeDecodeError:
+            return
+        index = self.index
+        self.transport.sendto(b"".join(b"1" if ip in index else b"0" for ip in ips), addr)
+
+
+async def serve():
+    index = IPIndex()
+    host = os.getenv("IPINDEX_LISTEN") or "127.0.0.1"
+    port = int(os.getenv("IPINDEX_PORT") or 8553)
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: _LookupProtocol(index), local_addr=(host, port))
+    logger.info("Answering allowlist lookups on %s:%s", host, port)
+    try:
+        await follow(
+            index,
+            os.getenv("ALLOWLIST_URL") or "http://127.0.0.1:5001",
+            os.getenv("ALLOWLIST_TOKEN") or "",
+            float(os.getenv("IPINDEX_POLL_INTERVAL") or 1)
+        )
+    finally:
+        transport.close()
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Local allowlist lookup service")
+    parser.add_argument("command", choices=("serve",))
+    parser.parse_args()
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
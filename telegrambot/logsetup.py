@@ -0,0 +1,137 @@
+import atexit
+import fcntl
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+_listener = None
+# Open lock files of the claimed per-process slots; closing one frees its slot.
+_slot_locks = []
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg and exc when there is one."""
+
+    def format(self, record):
+        entry = {
+            "ts": f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DebugSampler(logging.Filter):
+    """Let everything above DEBUG through, and one in `rate` DEBUG records per message template."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._counts = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate <= 1:
+            return True
+        key = (record.name, record.msg)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        return count % self.rate == 0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread without formatting them first.
+
+    The stock QueueHandler formats in prepare(), i.e. on the event loop; here the message is
+    only built by the listener, so log arguments must not be mutated after the call.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block a handler on log I/O; losing a line under overload is the lesser evil.
+            self.dropped += 1
+
+
+def _claim_slot(filename):
+    """web.log -> web.N.log for the lowest N no running process holds.
+
+    The slot is held with a lock on web.N.lock until this process exits, so a restarted
+    worker takes over the file of the one it replaces and the number of files stays at the
+    number of processes.
+    """
+    root_name, extension = os.path.splitext(filename)
+    slot = 0
+    while True:
+        lock = open(f"{root_name}.{slot}.lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            slot += 1
+            continue
+        _slot_locks.append(lock)
+        return f"{root_name}.{slot}{extension}"
+
+
+def configure(filename, console=False, per_process=False):
+    """Route all logging through a bounded queue to a rotating JSON-lines file.
+
+    With per_process each process writes its own file (see _claim_slot): processes that
+    share one rotating file rename it under each other at rollover and lose records.
+    Safe to call more than once; only the first call installs the pipeline.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    if per_process:
+        filename = _claim_slot(filename)
+    file_handler = logging.handlers.RotatingFileHandler(
+        filename,
+        maxBytes=int(os.getenv("LOG_MAX_BYTES") or 10 * 1024 * 1024),
+        backupCount=int(os.getenv("LOG_BACKUP_COUNT") or 5),
+        encoding="utf-8"
+    )
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handlers.append(stream_handler)
+
+    log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE") or 10000))
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(int(os.getenv("LOG_DEBUG_SAMPLE") or 10)))
+
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, (os.getenv("LOG_LEVEL") or "INFO").upper(), logging.INFO))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+def dropped():
+    """Records dropped because the queue was full."""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, _QueueHandler):
+            return handler.dropped
+    return 0
@@ -0,0 +1,171 @@
+"""In-memory index of known and blocked users, so hot handlers can skip the users table.
+
+Known ids live in a sorted array('q') (8 bytes per user, about 8 MB at a million users)
+plus a set of ids added since the last merge; blocked ids are a plain set, as few users
+are ever blocked. The index is filled by reload(), one streaming pass over users, which
+the bot also runs periodically to reconcile with the table. Until the first reload
+finishes every check falls through to the database.
+"""
+import heapq
+import logging
+import os
+from array import array
+from bisect import bisect_left
+
+import db
+import servicecache
+
+logger = logging.getLogger(__name__)
+
+FETCH_SIZE = 10000
+
+_known = array("q")
+_added = set()
+_blocked = set()
+# Users whose blocked flag may have changed in another process since we last looked.
+_unverified = set()
+# Blocks seen while a reload is running, which its snapshot may predate.
+_recent_blocks = None
+_loaded = False
+_skipped = 0
+
+
+def _key(telegram_id):
+    try:
+        return int(telegram_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _contains(values, key):
+    i = bisect_left(values, key)
+    return i < len(values) and values[i] == key
+
+
+def _merge():
+    global _known
+    _known = array("q", heapq.merge(_known, sorted(_added)))
+    _added.clear()
+
+
+def is_known(telegram_id):
+    """True if the user is certainly in the users table."""
+    global _skipped
+    key = _key(telegram_id)
+    if key is None or not (key in _added or _contains(_known, key)):
+        return False
+    _skipped += 1
+    return True
+
+
+def add(telegram_id):
+    key = _key(telegram_id)
+    if key is None or key in _added or _contains(_known, key):
+        return
+    _added.add(key)
+    if len(_added) >= int(os.getenv("MEMBERSHIP_MERGE_AT") or 50000):
+        _merge()
+
+
+def is_blocked(telegram_id):
+    """True or False when the index knows, None when the caller has to ask the database."""
+    global _skipped
+    key = _key(telegram_id)
+    if not _loaded or key is None or key in _unverified:
+        return None
+    if key in _blocked:
+        _skipped += 1
+        return True
+    if key in _added or _contains(_known, key):
+        _skipped += 1
+        return False
+    return None
+
+
+def remember(telegram_id, exists, blocked):
+    """Record the result of a users lookup made because is_blocked() returned None."""
+    key = _key(telegram_id)
+    if key is None:
+        return
+    _unverified.discard(key)
+    if blocked:
+        _blocked.add(key)
+    else:
+        _blocked.discard(key)
+    if exists:
+        add(telegram_id)
+
+
+def block(telegram_id):
+    key = _key(telegram_id)
+    if key is None:
+        return
+    _blocked.add(key)
+    _unverified.discard(key)
+    if _recent_blocks is not None:
+        _recent_blocks.add(key)
+
+
+def forget(telegram_id):
+    """Make the next is_blocked() for this user go to the database."""
+    key = _key(telegram_id)
+    if key is not None and _loaded:
+        _unverified.add(key)
+
+
+def _load(conn):
+    known = array("q")
+    blocked = set()
+    # Unbuffered, so rows stream in FETCH_SIZE batches instead of landing in memory at once.
+    cursor = conn.cursor(buffered=False)
+    try:
+        cursor.execute("SELECT telegram_id, blocked FROM users")
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for telegram_id, is_blocked_flag in rows:
+                key = _key(telegram_id)
+                if key is None:
+                    continue
+                known.append(key)
+                if is_blocked_flag:
+                    blocked.add(key)
+    finally:
+        cursor.close()
+    # telegram_id is a VARCHAR, so ORDER BY would sort it as text; sort the numbers here.
+    return array("q", sorted(known)), blocked
+
+
+async def reload():
+    """Replace the index with the current contents of users."""
+    global _known, _blocked, _recent_blocks, _loaded
+    _recent_blocks = set()
+    stale = set(_unverified)
+    try:
+        known, blocked = await db.run(_load)
+        # Users added or blocked while the snapshot was being read stay in.
+        _added.difference_update({key for key in _added if _contains(known, key)})
+        _known = known
+        _blocked = blocked | _recent_blocks
+        _unverified.difference_update(stale)
+        _loaded = True
+    finally:
+        _recent_blocks = None
+    logger.info("Loaded %s known users (%s blocked)", len(_known) + len(_added), len(_blocked))
+
+
+def stats():
+    return {
+        "loaded": _loaded,
+        "known": len(_known) + len(_added),
+        "pending_merge": len(_added),
+        "blocked": len(_blocked),
+        "unverified": len(_unverified),
+        "lookups_skipped": _skipped,
+        "bytes": _known.itemsize * len(_known),
+    }
+
+
+# A block made in another process reaches us as an invalidation for that user.
+servicecache.on_invalidation(forget)
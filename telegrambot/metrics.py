@@ -0,0 +1,171 @@
+import contextvars
+import functools
+import logging
+import os
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, multiprocess, start_http_server
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Most handlers answer in tens of milliseconds; the tail goes up to the 5s DB pool timeout.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HANDLER_SECONDS = Histogram(
+    "redex_handler_seconds", "Time spent in an update handler", ["handler"], buckets=LATENCY_BUCKETS
+)
+HANDLER_ERRORS = Counter("redex_handler_errors_total", "Exceptions raised by an update handler", ["handler"])
+UNROUTED_MESSAGES = Counter(
+    "redex_unrouted_messages_total", "Text and photo messages with no handler for the sender's state", ["kind", "state"]
+)
+UPDATE_DB_QUERIES = Histogram(
+    "redex_update_db_queries", "DB round trips made while handling one update", ["handler"],
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 20)
+)
+UPDATE_DB_SECONDS = Histogram(
+    "redex_update_db_seconds", "DB time spent while handling one update", ["handler"], buckets=LATENCY_BUCKETS
+)
+DB_QUERY_SECONDS = Histogram(
+    "redex_db_query_seconds", "DB round trip time including pool and thread wait", buckets=LATENCY_BUCKETS
+)
+DB_STATEMENT_SECONDS = Histogram(
+    "redex_db_statement_seconds", "Execution time of a registered statement on its connection", ["query"],
+    buckets=LATENCY_BUCKETS
+)
+TELEGRAM_API_SECONDS = Histogram(
+    "redex_telegram_api_seconds", "Bot API call time", ["method"], buckets=LATENCY_BUCKETS
+)
+TELEGRAM_API_ERRORS = Counter(
+    "redex_telegram_api_errors_total", "Bot API calls that failed or returned an error status", ["method"]
+)
+JOB_SECONDS = Histogram(
+    "redex_job_seconds", "Run time of a job-queue job", ["job"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+JOB_ERRORS = Counter("redex_job_errors_total", "Exceptions raised by a job-queue job", ["job"])
+WEB_REQUEST_SECONDS = Histogram(
+    "redex_web_request_seconds", "Time spent serving a web request", ["endpoint", "status"], buckets=LATENCY_BUCKETS
+)
+
+# [query count, seconds] for the update or request being handled in this task.
+_current = contextvars.ContextVar("redex_db_usage", default=None)
+
+
+def track_queries():
+    """Start counting DB round trips for the current task and return the counter."""
+    usage = [0, 0.0]
+    _current.set(usage)
+    return usage
+
+
+def observe_query(seconds):
+    DB_QUERY_SECONDS.observe(seconds)
+    usage = _current.get()
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += seconds
+
+
+def instrument(callback, name=None):
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        usage = track_queries()
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+            UPDATE_DB_QUERIES.labels(name).observe(usage[0])
+            UPDATE_DB_SECONDS.labels(name).observe(usage[1])
+
+    return wrapper
+
+
+def instrument_handlers(application):
+    """Wrap the callback of every registered handler."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument(handler.callback)
+
+
+def instrument_job(callback, name=None):
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(context):
+        started = time.perf_counter()
+        try:
+            return await callback(context)
+        except Exception:
+            JOB_ERRORS.labels(name).inc()
+            raise
+        finally:
+            JOB_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest that records the duration of every Bot API call."""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            TELEGRAM_API_ERRORS.labels(api_method).inc()
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.labels(api_method).observe(time.perf_counter() - started)
+        if code >= 400:
+            TELEGRAM_API_ERRORS.labels(api_method).inc()
+        return code, payload
+
+
+def start_server():
+    """Serve metrics on METRICS_LISTEN:METRICS_PORT (METRICS_PORT=0 disables it)."""
+    port = int(os.getenv("METRICS_PORT") or 9101)
+    if not port:
+        return
+    listen = os.getenv("METRICS_LISTEN") or "127.0.0.1"
+    start_http_server(port, addr=listen)
+    logger.info("Metrics available on http://%s:%s/metrics", listen, port)
+
+
+def serve_multiprocess():
+    """Serve the metrics the web workers write to PROMETHEUS_MULTIPROC_DIR, merged, on
+    WEB_METRICS_LISTEN:WEB_METRICS_PORT; the workers cannot share one port themselves."""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    port = int(os.getenv("WEB_METRICS_PORT") or 9102)
+    listen = os.getenv("WEB_METRICS_LISTEN") or "127.0.0.1"
+    start_http_server(port, addr=listen, registry=registry)
+    logger.info("Web metrics available on http://%s:%s/metrics", listen, port)
+
+
+def main():
+    import argparse
+    import threading
+
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Serve the web workers' merged metrics")
+    parser.add_argument("command", choices=("serve",))
+    parser.parse_args()
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        raise SystemExit("PROMETHEUS_MULTIPROC_DIR must point at the web workers' metrics directory")
+    serve_multiprocess()
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""Versioned schema migrations.
+
+    python migrations.py migrate   # apply pending migrations
+    python migrations.py status    # list applied and pending migrations
+    python migrations.py check     # EXPLAIN every checked query and report full scans and filesorts
+
+Applied versions are recorded in schema_migrations. Every step checks information_schema
+before changing anything, and index changes run with ALGORITHM=INPLACE, LOCK=NONE, so a
+migration can be re-run after a failure and never blocks writes while it builds an index.
+"""
+import argparse
+import logging
+import os
+import sys
+
+import mysql.connector
+
+import allowlist
+import broadcast
+import db
+import expiry
+import outbox
+import payments
+import persistence
+import queries
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+# Held while migrating, so workers starting side by side do not run the same ALTER twice.
+LOCK_NAME = "redex_schema_migrations"
+LOCK_TIMEOUT = 600
+
+
+def _scalar(cursor, sql, params=()):
+    cursor.execute(sql, params)
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def has_table(cursor, table):
+    return bool(_scalar(
+        cursor,
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
+        (table,)
+    ))
+
+
+def has_column(cursor, table, column):
+    return bool(_scalar(
+        cursor,
+        "SELECT COUNT(*) FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s",
+        (table, column)
+    ))
+
+
+def has_index(cursor, table, index):
+    return bool(_scalar(
+        cursor,
+        "SELECT COUNT(*) FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+        (table, index)
+    ))
+
+
+def add_column(cursor, table, column, definition):
+    if has_column(cursor, table, column):
+        return False
+    logger.info("Adding %s.%s", table, column)
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}, ALGORITHM=INPLACE, LOCK=NONE")
+    return True
+
+
+def add_index(cursor, table, index, columns):
+    if has_index(cursor, table, index):
+        return False
+    logger.info("Adding index %s on %s(%s)", index, table, columns)
+    cursor.execute(f"ALTER TABLE {table} ADD INDEX {index} ({columns}), ALGORITHM=INPLACE, LOCK=NONE")
+    return True
+
+
+def drop_index(cursor, table, index):
+    if not has_index(cursor, table, index):
+        return False
+    logger.info("Dropping index %s on %s", index, table)
+    cursor.execute(f"ALTER TABLE {table} DROP INDEX {index}, ALGORITHM=INPLACE, LOCK=NONE")
+    return True
+
+
+def drop_foreign_key(cursor, table, column, referenced_table):
+    name = _scalar(
+        cursor,
+        "SELECT constraint_name FROM information_schema.key_column_usage "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s AND referenced_table_name = %s",
+        (table, column, referenced_table)
+    )
+    if name is None:
+        return False
+    logger.info("Dropping foreign key %s on %s(%s)", name, table, column)
+    cursor.execute(f"ALTER TABLE {table} DROP FOREIGN KEY `{name}`, ALGORITHM=INPLACE, LOCK=NONE")
+    return True
+
+
+def _baseline(cursor):
+    with open(SCHEMA_FILE, encoding="utf-8") as f:
+        text = "\n".join(line for line in f.read().splitlines() if not line.lstrip().startswith("--"))
+    for statement in text.split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+
+
+def _notified_at(cursor):
+    # Databases created before the expiry sweeper existed.
+    if add_column(cursor, "services", "notified_at", "DATETIME NULL DEFAULT NULL"):
+        # Existing expired services were already notified (repeatedly) by the old sweeper.
+        cursor.execute("UPDATE services SET notified_at = NOW() WHERE status = 'expired'")
+
+
+def _hot_query_indexes(cursor):
+    add_index(cursor, "services", "idx_services_status_expiry", "status, expiry_date, deleted")
+    add_index(cursor, "services", "idx_services_telegram_deleted", "telegram_id, deleted")
+    add_index(cursor, "services", "idx_services_telegram_name", "telegram_id, name, deleted")
+    add_index(cursor, "services", "idx_services_telegram_test", "telegram_id, is_test, deleted")
+    add_index(cursor, "services", "idx_services_duration_test", "duration, is_test")
+    add_index(cursor, "pending_payments", "idx_pending_payments_telegram_status", "telegram_id, status")
+    # The new indexes start with telegram_id, which also covers the foreign keys these served.
+    drop_index(cursor, "services", "idx_services_telegram_id")
+    drop_index(cursor, "pending_payments", "idx_pending_payments_telegram_id")
+
+
+def _cache_invalidations(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS cache_invalidations ("
+        "id BIGINT AUTO_INCREMENT PRIMARY KEY, "
+        "telegram_id VARCHAR(255) NOT NULL, "
+        "service_id VARCHAR(36) NULL, "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+        "INDEX idx_cache_invalidations_created_at (created_at)"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+    )
+
+
+def _allowlist_changes(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS allowlist_changes ("
+        "seq BIGINT AUTO_INCREMENT PRIMARY KEY, "
+        "service_id VARCHAR(36) NOT NULL, "
+        "ip_address VARCHAR(45) NULL, "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+        "INDEX idx_allowlist_changes_created_at (created_at)"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+    )
+
+
+def _payment_engine(cursor):
+    # A new purchase's payment names the service it will create on approval, and the expiry
+    # sweep deletes services that old payments still name, so this key could only fail writes.
+    drop_foreign_key(cursor, "pending_payments", "service_id", "services")
+    add_index(cursor, "pending_payments", "idx_pending_payments_status_created", "status, created_at")
+
+
+def _broadcast_deferred(cursor):
+    add_column(cursor, "broadcasts", "deferred", "INT NOT NULL DEFAULT 0")
+
+
+def _unnotified_tests_index(cursor):
+    # Expired test services are never deleted; without this the claim walks all of them on every sweep.
+    add_index(
+        cursor, "services", "idx_services_unnotified_tests", "status, is_test, deleted, notified_at, expiry_date"
+    )
+
+
+# (version, description, step). Append only; never edit or renumber an applied migration.
+MIGRATIONS = [
+    (1, "baseline schema", _baseline),
+    (2, "services.notified_at", _notified_at),
+    (3, "composite indexes for the hot queries", _hot_query_indexes),
+    (4, "cache_invalidations feed", _cache_invalidations),
+    (5, "allowlist_changes feed", _allowlist_changes),
+    (6, "payment approval: unchecked pending_payments.service_id, queue index", _payment_engine),
+    (7, "broadcasts.deferred", _broadcast_deferred),
+    (8, "index for the expired test service notifications", _unnotified_tests_index),
+]
+
+
+def _ensure_table(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INT PRIMARY KEY, "
+        "description VARCHAR(255) NOT NULL, "
+        "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+        ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+    )
+
+
+def applied_versions(conn):
+    cursor = conn.cursor()
+    try:
+        _ensure_table(cursor)
+        cursor.execute("SELECT version FROM schema_migrations")
+        return {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def migrate(conn):
+    """Apply pending migrations on conn (autocommit); returns the versions applied."""
+    cursor = conn.cursor()
+    try:
+        if _scalar(cursor, "SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT)) != 1:
+            raise RuntimeError(f"Timed out waiting for the {LOCK_NAME} lock")
+        try:
+            done = applied_versions(conn)
+            applied = []
+            for version, description, step in MIGRATIONS:
+                if version in done:
+                    continue
+                logger.info("Applying migration %s: %s", version, description)
+                step(cursor)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description)
+                )
+                applied.append(version)
+            return applied
+        finally:
+            _scalar(cursor, "SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+    finally:
+        cursor.close()
+
+
+def apply_pending():
+    """Migrate through the shared pool; called by bot.py at startup."""
+    conn = db.get_connection()
+    try:
+        applied = migrate(conn)
+    finally:
+        conn.close()
+    if applied:
+        logger.info("Applied migrations %s", applied)
+    return applied
+
+
+# Statements the batch jobs and transactions run outside queries.REGISTRY, with placeholder
+# parameters; IN lists are checked with a single id.
+CHECKED_QUERIES = [
+    ("expiry.due", expiry.DUE_SERVICES, (500,)),
+    ("expiry.expire", expiry.EXPIRE_SERVICES.format("%s"), ("s",)),
+    ("expiry.unnotified", expiry.UNNOTIFIED_TESTS, (500,)),
+    ("expiry.deletable", expiry.DELETABLE_SERVICES, ("2000-01-01", 500)),
+    ("payments.lock", payments.LOCK_PAYMENTS.format(payments.BY_ID), ("p", "1")),
+    ("payments.lock_oldest", payments.LOCK_PAYMENTS.format(payments.OLDEST_PENDING), (50,)),
+    ("payments.lock_services", payments.LOCK_SERVICES.format("%s"), ("s",)),
+    ("broadcast.page", broadcast.NEXT_PAGE, ("0", 500)),
+    ("persistence.load", persistence.LOAD_ALL, (86400,)),
+    ("persistence.get", persistence.LOAD_ONE, ("1", 86400)),
+    ("persistence.prune", persistence.DELETE_EXPIRED, (86400,)),
+    ("outbox.due_retries", outbox.CLAIM_DUE_RETRIES, (500,)),
+    ("allowlist.snapshot_seq", allowlist.SNAPSHOT_SEQ, (10,)),
+    ("allowlist.snapshot", allowlist.SNAPSHOT_SERVICES, ()),
+    ("allowlist.prune", allowlist.PRUNE_CHANGES, (7, 0)),
+]
+
+
+def explain(conn):
+    """EXPLAIN every registered query and CHECKED_QUERIES; returns [(name, table, access type, key, rows, extra)]."""
+    # Placeholder values are enough for the optimizer to pick an access path.
+    checked = [
+        (query.name, query.sql, ("0",) * query.sql.count("%s"))
+        for query in queries.REGISTRY.values()
+        if not query.sql.lstrip().upper().startswith("INSERT")
+    ] + CHECKED_QUERIES
+    report = []
+    cursor = conn.cursor(dictionary=True)
+    try:
+        for name, sql, params in checked:
+            cursor.execute(f"EXPLAIN {sql}", params)
+            for row in cursor.fetchall():
+                report.append((
+                    name, row.get("table"), row.get("type"), row.get("key"), row.get("rows"), row.get("Extra") or ""
+                ))
+    finally:
+        cursor.close()
+    return report
+
+
+def slow_plans(report):
+    """Entries that read a whole table or index, or sort the rows they read."""
+    # type is NULL when the optimizer answered from the index alone or found nothing to read.
+    return [
+        entry for entry in report
+        if entry[1] and (entry[2] in ("ALL", "index") or "Using filesort" in entry[5])
+    ]
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Apply or inspect schema migrations")
+    parser.add_argument("command", choices=("migrate", "status", "check"))
+    args = parser.parse_args()
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    db.init_pool()
+    conn = db.get_connection()
+    try:
+        if args.command == "migrate":
+            applied = migrate(conn)
+            print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+        elif args.command == "status":
+            done = applied_versions(conn)
+            for version, description, _ in MIGRATIONS:
+                print(f"{version:>4}  {'applied' if version in done else 'pending':<8} {description}")
+        else:
+            report = explain(conn)
+            for name, table, access, key, rows, extra in report:
+                print(f"{name:<24} {table or '-':<18} {access or '-':<8} {key or '-':<40} {rows!s:<8} {extra}")
+            slow = slow_plans(report)
+            if slow:
+                print(f"Full scans or filesorts: {', '.join(sorted({entry[0] for entry in slow}))}")
+                sys.exit(1)
+            print("Every checked query uses an index range or lookup without a filesort")
+    except (mysql.connector.Error, RuntimeError) as e:
+        logger.error("Migration command %s failed: %s", args.command, e)
+        sys.exit(1)
+    finally:
+        conn.close()
+        db.close_pool()
+
+
+if __name__ == "__main__":
+    main()
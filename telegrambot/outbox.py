@@ -0,0 +1,326 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+
+import mysql.connector
+from telegram import InlineKeyboardMarkup
+from telegram.error import Forbidden, BadRequest, NetworkError, RetryAfter, TelegramError
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Lower value is sent first.
+PRIORITY_ADMIN = 0
+PRIORITY_PAYMENT = 1
+PRIORITY_BULK = 2
+
+# What a send future resolves to when the message was moved to outbox_retries instead of sent.
+DEFERRED = object()
+
+CLAIM_DUE_RETRIES = (
+    "SELECT id, chat_id, method, payload, priority, attempts FROM outbox_retries "
+    "WHERE next_attempt_at <= NOW() ORDER BY next_attempt_at LIMIT %s FOR UPDATE"
+)
+
+_outbox = None
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class Message:
+    __slots__ = ("method", "chat_id", "kwargs", "priority", "attempts", "future")
+
+    def __init__(self, method, chat_id, kwargs, priority, attempts=0, future=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.attempts = attempts
+        self.future = future
+
+    def dump(self):
+        kwargs = dict(self.kwargs)
+        if isinstance(kwargs.get("reply_markup"), InlineKeyboardMarkup):
+            kwargs["reply_markup"] = kwargs["reply_markup"].to_dict()
+        return json.dumps(kwargs, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, bot, method, chat_id, payload, priority, attempts):
+        kwargs = json.loads(payload)
+        if kwargs.get("reply_markup"):
+            kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(kwargs["reply_markup"], bot)
+        return cls(method, chat_id, kwargs, priority, attempts)
+
+
+def _insert_retries(conn, rows):
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(
+            "INSERT INTO outbox_retries (chat_id, method, payload, priority, attempts, next_attempt_at, last_error) "
+            "VALUES (%s, %s, %s, %s, %s, NOW() + INTERVAL %s SECOND, %s)",
+            rows
+        )
+    finally:
+        cursor.close()
+
+
+def _claim_due_retries(conn, limit):
+    # Locking read inside a transaction: when several workers poll at once, the second one
+    # waits for the first to commit its DELETE and then no longer sees those rows.
+    conn.start_transaction()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(CLAIM_DUE_RETRIES, (limit,))
+        rows = cursor.fetchall()
+        if rows:
+            ids = [row[0] for row in rows]
+            cursor.execute(
+                f"DELETE FROM outbox_retries WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                ids
+            )
+        conn.commit()
+        return rows
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+class Outbox:
+    """Priority queue in front of the Bot API with global and per-chat token buckets.
+
+    Messages that fail with a transient error are parked in the outbox_retries table and
+    picked up again once due, so they survive restarts.
+    """
+
+    def __init__(self, bot, global_rate, chat_rate, workers, max_attempts, retry_batch):
+        self.bot = bot
+        self.max_attempts = max_attempts
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chats = {}
+        self._worker_count = workers
+        self._retry_batch = retry_batch
+        self._parked = {}
+        self._tasks = []
+        self._paused_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.deferred = 0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(), name=f"outbox-worker-{i}") for i in range(self._worker_count)]
+        self._tasks.append(loop.create_task(self._poll_retries(), name="outbox-retries"))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        pending = []
+        for message, _, handle in self._parked.values():
+            handle.cancel()
+            pending.append(message)
+        self._parked.clear()
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait()[2])
+        if pending:
+            await self._defer(pending, "shutdown", delay=0)
+            logger.info("Outbox persisted %s unsent messages on shutdown", len(pending))
+
+    def enqueue(self, method, chat_id, priority, kwargs):
+        future = asyncio.get_running_loop().create_future()
+        self._put(Message(method, chat_id, kwargs, priority, future=future))
+        return future
+
+    def _put(self, message, seq=None):
+        self._queue.put_nowait((message.priority, next(self._seq) if seq is None else seq, message))
+
+    def _park(self, message, seq, delay):
+        handle = asyncio.get_running_loop().call_later(delay, self._unpark, seq)
+        self._parked[seq] = (message, seq, handle)
+
+    def _unpark(self, seq):
+        message, seq, _ = self._parked.pop(seq)
+        self._put(message, seq)
+
+    def _chat_bucket(self, chat_id):
+        chat_id = str(chat_id)
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, 1)
+        return bucket
+
+    def _global_wait(self):
+        return max(self._global.delay(), self._paused_until - time.monotonic())
+
+    async def _worker(self):
+        while True:
+            # Wait for global capacity before taking a message, so nothing is held while sleeping
+            # and a later message can never overtake an earlier one.
+            wait = self._global_wait()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            priority, seq, message = await self._queue.get()
+            if self._global_wait() > 0:
+                self._put(message, seq)
+                continue
+            chat_delay = self._chat_bucket(message.chat_id).delay()
+            if chat_delay > 0:
+                # Park it and keep its sequence number so it keeps its place in line.
+                self._park(message, seq, chat_delay)
+                continue
+            self._global.take()
+            self._chat_bucket(message.chat_id).take()
+            await self._send(message, seq)
+
+    async def _send(self, message, seq):
+        try:
+            result = await getattr(self.bot, message.method)(chat_id=message.chat_id, **message.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            logger.warning("Flood limit hit, pausing outbox for %ss", retry_after)
+            self._paused_until = time.monotonic() + retry_after
+            self._put(message, seq)
+        except (Forbidden, BadRequest) as e:
+            self.failed += 1
+            logger.warning("Dropping %s to %s: %s", message.method, message.chat_id, e)
+            self._resolve(message, error=e)
+        except (NetworkError, TelegramError) as e:
+            message.attempts += 1
+            if message.attempts >= self.max_attempts:
+                self.failed += 1
+                logger.error("Giving up on %s to %s after %s attempts: %s", message.method, message.chat_id, message.attempts, e)
+                self._resolve(message, error=e)
+            else:
+                await self._defer([message], str(e), delay=min(2 ** message.attempts * 5, 600))
+        except Exception as e:
+            # Not a Telegram error (bad kwargs, an unwrapped transport error); retrying will not help,
+            # and letting it escape would end this worker with its caller still waiting.
+            self.failed += 1
+            logger.exception("Dropping %s to %s after an unexpected error", message.method, message.chat_id)
+            self._resolve(message, error=e)
+        else:
+            self.sent += 1
+            self._resolve(message, result=result)
+
+    def _resolve(self, message, result=None, error=None):
+        future, message.future = message.future, None
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+            future.exception()
+        else:
+            future.set_result(result)
+
+    async def _defer(self, messages, reason, delay):
+        rows = [
+            (str(m.chat_id), m.method, m.dump(), m.priority, m.attempts, delay, reason[:1000])
+            for m in messages
+        ]
+        try:
+            await db.run(_insert_retries, rows)
+        except mysql.connector.Error as e:
+            logger.error("Failed to persist %s outbox messages: %s", len(rows), e)
+            for m in messages:
+                self._resolve(m, error=e)
+            return
+        self.deferred += len(messages)
+        for m in messages:
+            # Callers waiting on delivery are released; the retry no longer belongs to them.
+            self._resolve(m, result=DEFERRED)
+
+    async def _poll_retries(self):
+        interval = float(os.getenv("OUTBOX_RETRY_POLL") or 5)
+        while True:
+            await asyncio.sleep(interval)
+            self._chats = {chat_id: b for chat_id, b in self._chats.items() if not b.is_full()}
+            # Leave retries in the table while the live queue is already backed up.
+            if self._queue.qsize() >= self._retry_batch:
+                continue
+            try:
+                rows = await db.run(_claim_due_retries, self._retry_batch - self._queue.qsize())
+            except mysql.connector.Error as e:
+                logger.error("Failed to load outbox retries: %s", e)
+                continue
+            for _, chat_id, method, payload, priority, attempts in rows:
+                self._put(Message.load(self.bot, method, chat_id, payload, priority, attempts))
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "parked": len(self._parked),
+            "sent": self.sent,
+            "failed": self.failed,
+            "deferred": self.deferred,
+            "chats_tracked": len(self._chats),
+        }
+
+
+def start(bot):
+    global _outbox
+    _outbox = Outbox(
+        bot,
+        global_rate=float(os.getenv("OUTBOX_GLOBAL_RATE") or 25),
+        chat_rate=float(os.getenv("OUTBOX_CHAT_RATE") or 1),
+        workers=int(os.getenv("OUTBOX_WORKERS") or 4),
+        max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS") or 5),
+        retry_batch=int(os.getenv("OUTBOX_RETRY_BATCH") or 500)
+    )
+    _outbox.start()
+    return _outbox
+
+
+async def stop():
+    global _outbox
+    if _outbox is not None:
+        await _outbox.stop()
+        _outbox = None
+
+
+def send_message(chat_id, priority=PRIORITY_BULK, **kwargs):
+    """Queue a send_message call; the returned future resolves once it is delivered, or to DEFERRED."""
+    return _outbox.enqueue("send_message", chat_id, priority, kwargs)
+
+
+def send_photo(chat_id, priority=PRIORITY_BULK, **kwargs):
+    return _outbox.enqueue("send_photo", chat_id, priority, kwargs)
+
+
+def stats():
+    return _outbox.stats() if _outbox is not None else {}
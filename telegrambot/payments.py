@@ -0,0 +1,179 @@
+"""Payment decisions, each applied in one short transaction.
+
+The payment rows are locked with SELECT ... FOR UPDATE and only acted on while still
+pending, so a double-tapped or replayed callback finds the payment decided and changes
+nothing; payments decided by this process are also remembered for PAYMENT_DEDUP_TTL
+seconds, so such repeats do not reach the database at all. Approving a renewal extends
+the existing service (from its expiry date while it is still active) instead of creating
+one; an expired service lost its IP when it expired, so its user registers one again.
+Nothing is sent to Telegram here: callers notify after these functions return, which is
+after commit.
+"""
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import db
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# applied is False when the payment had already been decided (status says how).
+Decision = namedtuple(
+    "Decision",
+    "payment_id telegram_id service_id service_name duration is_renewal status applied purchase_date expiry_date"
+)
+
+# {} takes the WHERE clause of _lock_payments, or the IN list of LOCK_SERVICES.
+LOCK_PAYMENTS = (
+    "SELECT payment_id, telegram_id, service_id, service_name, duration, is_renewal, status "
+    "FROM pending_payments WHERE {} FOR UPDATE"
+)
+BY_ID = "payment_id = %s AND telegram_id = %s"
+OLDEST_PENDING = "status = 'pending' ORDER BY created_at LIMIT %s"
+LOCK_SERVICES = (
+    "SELECT service_id, telegram_id, status, purchase_date, expiry_date, deleted FROM services "
+    "WHERE service_id IN ({}) FOR UPDATE"
+)
+
+_decided = None
+
+
+def _recent():
+    global _decided
+    if _decided is None:
+        _decided = TTLCache(maxsize=10000, ttl=float(os.getenv("PAYMENT_DEDUP_TTL") or 3600))
+    return _decided
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def _lock_payments(cursor, where, params):
+    cursor.execute(LOCK_PAYMENTS.format(where), params)
+    return cursor.fetchall()
+
+
+def _approve(conn, where, params):
+    conn.start_transaction()
+    cursor = conn.cursor()
+    try:
+        rows = _lock_payments(cursor, where, params)
+        pending = [row for row in rows if row[6] == "pending"]
+        decisions = [
+            Decision(*row[:5], bool(row[5]), row[6], False, None, None) for row in rows if row[6] != "pending"
+        ]
+        if pending:
+            now = datetime.now()
+            renewals = [row for row in pending if row[5]]
+            services = {}
+            if renewals:
+                ids = [row[2] for row in renewals]
+                cursor.execute(LOCK_SERVICES.format(_placeholders(ids)), ids)
+                services = {row[0]: row[1:] for row in cursor.fetchall()}
+            # service_id -> row to insert; a later renewal in the batch amends it instead of inserting twice.
+            inserts = {}
+            for payment_id, telegram_id, service_id, name, duration, is_renewal, _ in pending:
+                current = services.get(service_id) if is_renewal else None
+                if current is not None and current[0] == telegram_id:
+                    _, status, purchase_date, expiry_date, deleted = current
+                    # Time left on an active service is kept; an expired one restarts today.
+                    start = expiry_date if status == "active" and not deleted and expiry_date > now else now
+                    expiry_date = start + timedelta(days=duration)
+                    if service_id in inserts:
+                        inserts[service_id] = (service_id, telegram_id, name, purchase_date, expiry_date, duration)
+                    else:
+                        cursor.execute(
+                            "UPDATE services SET status = 'active', deleted = FALSE, expiry_date = %s, duration = %s, "
+                            "notified_at = NULL WHERE service_id = %s",
+                            (expiry_date, duration, service_id)
+                        )
+                else:
+                    # A new purchase, or a renewal of a service the expiry sweep already deleted.
+                    purchase_date, expiry_date = now, now + timedelta(days=duration)
+                    inserts[service_id] = (service_id, telegram_id, name, purchase_date, expiry_date, duration)
+                # Later renewals of the same service in this batch build on this one.
+                services[service_id] = (telegram_id, "active", purchase_date, expiry_date, False)
+                decisions.append(Decision(
+                    payment_id, telegram_id, service_id, name, duration, bool(is_renewal), "approved", True,
+                    purchase_date, expiry_date
+                ))
+            if inserts:
+                cursor.executemany(
+                    "INSERT INTO services (service_id, telegram_id, name, purchase_date, expiry_date, duration, "
+                    "status, is_test) VALUES (%s, %s, %s, %s, %s, %s, 'active', FALSE)",
+                    list(inserts.values())
+                )
+            ids = [row[0] for row in pending]
+            cursor.execute(
+                f"UPDATE pending_payments SET status = 'approved' WHERE payment_id IN ({_placeholders(ids)})",
+                ids
+            )
+        conn.commit()
+        return decisions
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _reject(conn, payment_id, telegram_id, reason, block):
+    conn.start_transaction()
+    cursor = conn.cursor()
+    try:
+        rows = _lock_payments(cursor, BY_ID, (payment_id, telegram_id))
+        if not rows:
+            conn.commit()
+            return None
+        row = rows[0]
+        applied = row[6] == "pending"
+        if applied:
+            cursor.execute(
+                "UPDATE pending_payments SET status = 'rejected', reason = %s WHERE payment_id = %s",
+                (reason, payment_id)
+            )
+            if block:
+                cursor.execute("UPDATE users SET blocked = TRUE WHERE telegram_id = %s", (telegram_id,))
+        conn.commit()
+        return Decision(*row[:5], bool(row[5]), "rejected" if applied else row[6], applied, None, None)
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def _remember(decisions):
+    recent = _recent()
+    for decision in decisions:
+        recent.set((decision.payment_id, decision.telegram_id), decision._replace(applied=False))
+    return decisions
+
+
+async def approve(payment_id, telegram_id):
+    """Approve one payment; None if it does not exist."""
+    decision = _recent().get((payment_id, telegram_id))
+    if decision is not None:
+        return decision
+    decisions = await db.run(_approve, BY_ID, (payment_id, telegram_id))
+    return _remember(decisions)[0] if decisions else None
+
+
+async def approve_pending(limit):
+    """Approve the oldest `limit` pending payments in one transaction."""
+    decisions = await db.run(_approve, OLDEST_PENDING, (limit,))
+    return _remember(decisions)
+
+
+async def reject(payment_id, telegram_id, reason, block=False):
+    """Reject one payment, and block its user if `block`; None if it does not exist."""
+    decision = _recent().get((payment_id, telegram_id))
+    if decision is not None:
+        return decision
+    decision = await db.run(_reject, payment_id, telegram_id, reason, block)
+    if decision is not None:
+        _remember([decision])
+    return decision
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import logging
+import time
+
+import mysql.connector
+from telegram.ext import BasePersistence, PersistenceInput
+
+import db
+
+logger = logging.getLogger(__name__)
+
+LOAD_ALL = "SELECT telegram_id, data FROM user_state WHERE updated_at > NOW() - INTERVAL %s SECOND"
+LOAD_ONE = "SELECT data FROM user_state WHERE telegram_id = %s AND updated_at > NOW() - INTERVAL %s SECOND"
+DELETE_EXPIRED = "DELETE FROM user_state WHERE updated_at <= NOW() - INTERVAL %s SECOND"
+
+
+def _load_all(conn, ttl):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(LOAD_ALL, (int(ttl),))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _load_one(conn, telegram_id, ttl):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(LOAD_ONE, (telegram_id, int(ttl)))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        cursor.close()
+
+
+def _write(conn, upserts, deletes):
+    cursor = conn.cursor()
+    try:
+        if upserts:
+            cursor.executemany(
+                "INSERT INTO user_state (telegram_id, data) VALUES (%s, %s) "
+                "ON DUPLICATE KEY UPDATE data = VALUES(data), updated_at = NOW()",
+                upserts
+            )
+        if deletes:
+            cursor.execute(
+                f"DELETE FROM user_state WHERE telegram_id IN ({', '.join(['%s'] * len(deletes))})",
+                deletes
+            )
+    finally:
+        cursor.close()
+
+
+def _delete_expired(conn, ttl):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(DELETE_EXPIRED, (int(ttl),))
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+class MySQLPersistence(BasePersistence):
+    """Keeps context.user_data in the user_state table.
+
+    The application hands over changed users every `update_interval` seconds; those changes
+    are written in one batch, so handlers never wait for a state write. With `shared`
+    (worker mode) a user's state is re-read when their first update in a while arrives, so
+    any worker can pick up any flow.
+    """
+
+    def __init__(self, update_interval, ttl, shared=False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.ttl = ttl
+        self.shared = shared
+        # user_id -> JSON, or None to delete. Replaced wholesale when a batch is written.
+        self._pending = {}
+        self._writing = {}
+        self._flush_task = None
+        self._touched = {}
+        # Users dropped from memory only; their stored state may belong to another worker now.
+        self._forget = set()
+
+    async def get_user_data(self):
+        if self.shared:
+            return {}
+        try:
+            rows = await db.run(_load_all, self.ttl)
+        except mysql.connector.Error as e:
+            # Start anyway; only flows that were in progress before the restart are lost.
+            logger.error("Failed to restore conversation state: %s", e)
+            return {}
+        now = time.monotonic()
+        data = {}
+        for telegram_id, payload in rows:
+            data[int(telegram_id)] = json.loads(payload)
+            self._touched[int(telegram_id)] = now
+        logger.info("Restored conversation state for %s users", len(data))
+        return data
+
+    async def refresh_user_data(self, user_id, user_data):
+        now = time.monotonic()
+        last, self._touched[user_id] = self._touched.get(user_id), now
+        if not self.shared or user_id in self._pending or user_id in self._writing:
+            return
+        # While a user keeps clicking, this worker's copy is newer than the table (it is only
+        # written every update_interval); after a pause the table is the one to trust.
+        if last is not None and now - last < 2 * self.update_interval:
+            return
+        payload = await db.run(_load_one, str(user_id), self.ttl)
+        user_data.clear()
+        if payload:
+            user_data.update(json.loads(payload))
+
+    async def update_user_data(self, user_id, data):
+        self._pending[user_id] = json.dumps(data, ensure_ascii=False) if data else None
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._touched.pop(user_id, None)
+        if user_id in self._forget:
+            self._forget.discard(user_id)
+            return
+        self._pending[user_id] = None
+        self._schedule_write()
+
+    def _schedule_write(self):
+        # update_persistence() hands users over one coroutine each; the batch is written
+        # once they have all run.
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        if not self._pending:
+            return
+        self._writing, self._pending = self._pending, {}
+        upserts = [(str(user_id), payload) for user_id, payload in self._writing.items() if payload is not None]
+        deletes = [str(user_id) for user_id, payload in self._writing.items() if payload is None]
+        try:
+            await db.run(_write, upserts, deletes)
+            logger.debug("Saved conversation state: %s updated, %s removed", len(upserts), len(deletes))
+        except mysql.connector.Error as e:
+            logger.error("Failed to save conversation state for %s users: %s", len(self._writing), e)
+            # Keep them for the next round unless a newer change already replaced them.
+            for user_id, payload in self._writing.items():
+                self._pending.setdefault(user_id, payload)
+        finally:
+            self._writing = {}
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
+
+    async def expire(self, application):
+        """Forget flows nobody touched for `ttl` seconds, in memory and in the table."""
+        cutoff = time.monotonic() - self.ttl
+        stale = [user_id for user_id, touched in self._touched.items() if touched < cutoff]
+        for user_id in stale:
+            del self._touched[user_id]
+            if self.shared:
+                self._forget.add(user_id)
+            application.drop_user_data(user_id)
+        deleted = await db.run(_delete_expired, self.ttl)
+        if stale or deleted:
+            logger.info("Expired conversation state: %s in memory, %s stored", len(stale), deleted)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
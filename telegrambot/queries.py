@@ -0,0 +1,221 @@
+"""The statements the handlers run, defined once and executed as server-side prepared statements.
+
+Each pooled connection prepares a statement the first time it runs it and reuses it after
+that, so only the parameters cross the wire. Results come back as small __slots__ row
+objects, and every statement keeps its own call count and timing (see stats()).
+"""
+import threading
+import time
+
+import mysql.connector
+
+import db
+import metrics
+
+REGISTRY = {}
+_stats_lock = threading.Lock()
+
+
+class Row:
+    __slots__ = ()
+
+    def __init__(self, values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+def row_type(name, *fields):
+    return type(name, (Row,), {"__slots__": fields})
+
+
+class Query:
+    __slots__ = ("name", "sql", "row", "calls", "errors", "seconds", "max_seconds")
+
+    def __init__(self, name, sql, row=None):
+        self.name = name
+        self.sql = sql
+        self.row = row
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds, failed):
+        with _stats_lock:
+            self.calls += 1
+            self.errors += failed
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+        metrics.DB_STATEMENT_SECONDS.labels(self.name).observe(seconds)
+
+
+def define(name, sql, row=None):
+    if name in REGISTRY:
+        raise ValueError(f"Query {name} is defined twice")
+    query = REGISTRY[name] = Query(name, sql, row)
+    return query
+
+
+User = row_type("User", "blocked")
+ServiceSummary = row_type("ServiceSummary", "service_id", "name", "status", "is_test")
+Service = row_type(
+    "Service", "service_id", "name", "ip_address", "purchase_date", "expiry_date", "duration", "status", "is_test"
+)
+Invalidation = row_type("Invalidation", "id", "telegram_id", "service_id")
+AllowlistChange = row_type("AllowlistChange", "seq", "service_id", "ip_address", "settled")
+
+ADD_USER = define("users.add", "INSERT IGNORE INTO users (telegram_id) VALUES (%s)")
+USER = define("users.get", "SELECT blocked FROM users WHERE telegram_id = %s", User)
+
+USER_SERVICES = define(
+    "services.list",
+    "SELECT service_id, name, status, is_test FROM services WHERE telegram_id = %s AND deleted = FALSE",
+    ServiceSummary
+)
+SERVICE = define(
+    "services.get",
+    "SELECT service_id, name, ip_address, purchase_date, expiry_date, duration, status, is_test FROM services "
+    "WHERE service_id = %s AND telegram_id = %s AND deleted = FALSE",
+    Service
+)
+SERVICE_NAME_TAKEN = define(
+    "services.name_taken",
+    "SELECT COUNT(*) FROM services WHERE telegram_id = %s AND name = %s AND deleted = FALSE"
+)
+TEST_SERVICE_COUNT = define(
+    "services.test_count",
+    "SELECT COUNT(*) FROM services WHERE telegram_id = %s AND is_test = TRUE AND deleted = FALSE"
+)
+ADD_SERVICE = define(
+    "services.add",
+    "INSERT INTO services (service_id, telegram_id, name, purchase_date, expiry_date, duration, status, is_test) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+)
+SET_SERVICE_IP = define(
+    "services.set_ip",
+    "UPDATE services SET ip_address = %s WHERE service_id = %s AND telegram_id = %s"
+)
+
+PENDING_PAYMENT_COUNT = define(
+    "payments.pending_count",
+    "SELECT COUNT(*) FROM pending_payments WHERE telegram_id = %s AND status = 'pending'"
+)
+PENDING_RENEWAL_COUNT = define(
+    "payments.pending_renewal_count",
+    "SELECT COUNT(*) FROM pending_payments "
+    "WHERE telegram_id = %s AND service_id = %s AND status = 'pending' AND is_renewal = TRUE"
+)
+PENDING_PAYMENTS_TOTAL = define(
+    "payments.pending_total",
+    "SELECT COUNT(*) FROM pending_payments WHERE status = 'pending'"
+)
+ADD_PAYMENT = define(
+    "payments.add",
+    "INSERT INTO pending_payments "
+    "(payment_id, telegram_id, service_id, service_name, duration, price, caption, status, is_renewal) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s, 'pending', %s)"
+)
+
+LAST_INVALIDATION = define("cache_invalidations.last", "SELECT MAX(id) FROM cache_invalidations")
+INVALIDATIONS_SINCE = define(
+    "cache_invalidations.since",
+    "SELECT id, telegram_id, service_id FROM cache_invalidations WHERE id > %s ORDER BY id LIMIT 1000",
+    Invalidation
+)
+PRUNE_INVALIDATIONS = define(
+    "cache_invalidations.prune",
+    "DELETE FROM cache_invalidations WHERE created_at < NOW() - INTERVAL %s SECOND"
+)
+
+RECORD_ALLOWLIST_CHANGE = define(
+    "allowlist_changes.record",
+    "INSERT INTO allowlist_changes (service_id, ip_address) "
+    "SELECT service_id, IF(status = 'active' AND deleted = FALSE, ip_address, NULL) FROM services "
+    "WHERE service_id = %s"
+)
+ALLOWLIST_CHANGES_SINCE = define(
+    "allowlist_changes.since",
+    "SELECT seq, service_id, ip_address, created_at <= NOW() - INTERVAL %s SECOND FROM allowlist_changes "
+    "WHERE seq > %s ORDER BY seq LIMIT 1000",
+    AllowlistChange
+)
+ALLOWLIST_BOUNDS = define("allowlist_changes.bounds", "SELECT MIN(seq), MAX(seq) FROM allowlist_changes")
+
+
+def _run(conn, query, params, fetch):
+    cursor = conn.prepared(query.sql)
+    started = time.perf_counter()
+    failed = True
+    try:
+        # query.sql is passed as the same object every time, which is how the cursor
+        # recognises the statement it already prepared.
+        cursor.execute(query.sql, params)
+        # Rows are always read to the end; a prepared statement cannot be reused with a
+        # result still pending on the connection.
+        result = cursor.fetchall() if fetch else cursor.rowcount
+        failed = False
+        return result
+    except mysql.connector.Error:
+        conn.unprepare(query.sql)
+        raise
+    finally:
+        query.record(time.perf_counter() - started, failed)
+
+
+def execute_in(conn, query, *params):
+    """execute() on a connection the caller already holds, e.g. inside a transaction."""
+    return _run(conn, query, params, False)
+
+
+def fetchall_in(conn, query, *params):
+    rows = _run(conn, query, params, True)
+    return [query.row(row) for row in rows] if query.row else rows
+
+
+async def fetchall(query, *params):
+    rows = await db.run(_run, query, params, True)
+    return [query.row(row) for row in rows] if query.row else rows
+
+
+async def fetchone(query, *params):
+    rows = await db.run(_run, query, params, True)
+    if not rows:
+        return None
+    return query.row(rows[0]) if query.row else rows[0]
+
+
+async def scalar(query, *params):
+    """First column of the first row, or None."""
+    rows = await db.run(_run, query, params, True)
+    return rows[0][0] if rows else None
+
+
+async def execute(query, *params):
+    """Run an INSERT/UPDATE/DELETE and return the number of matched rows."""
+    return await db.run(_run, query, params, False)
+
+
+def stats(limit=None):
+    """Per-statement counters, the statement with the most total time first."""
+    with _stats_lock:
+        entries = [
+            {
+                "query": query.name,
+                "calls": query.calls,
+                "errors": query.errors,
+                "total_ms": round(query.seconds * 1000, 1),
+                "avg_ms": round(query.seconds / query.calls * 1000, 3) if query.calls else 0.0,
+                "max_ms": round(query.max_seconds * 1000, 3),
+            }
+            for query in REGISTRY.values()
+            if query.calls
+        ]
+    entries.sort(key=lambda entry: entry["total_ms"], reverse=True)
+    return entries[:limit] if limit else entries
@@ -0,0 +1,56 @@
+import os
+
+import db
+from cache import TTLCache
+
+_cache = None
+
+# One statement, one scan per table: services and pending_payments are each aggregated
+# in a single pass with conditional sums instead of a COUNT(*) per figure.
+STATS_SQL = """
+SELECT u.total_users,
+       s.test_services, s.one_month, s.two_month, s.three_month, s.active_services, s.expired_services,
+       p.revenue, p.approved_payments, p.pending_payments
+FROM (SELECT COUNT(*) AS total_users FROM users) u
+CROSS JOIN (
+    SELECT COALESCE(SUM(is_test = TRUE AND deleted = FALSE), 0) AS test_services,
+           COALESCE(SUM(duration = 30 AND is_test = FALSE), 0) AS one_month,
+           COALESCE(SUM(duration = 60 AND is_test = FALSE), 0) AS two_month,
+           COALESCE(SUM(duration = 90 AND is_test = FALSE), 0) AS three_month,
+           COALESCE(SUM(status = 'active' AND deleted = FALSE), 0) AS active_services,
+           COALESCE(SUM(status = 'expired' AND deleted = FALSE), 0) AS expired_services
+    FROM services
+) s
+CROSS JOIN (
+    SELECT COALESCE(SUM(CASE WHEN status = 'approved' THEN price ELSE 0 END), 0) AS revenue,
+           COALESCE(SUM(status = 'approved'), 0) AS approved_payments,
+           COALESCE(SUM(status = 'pending'), 0) AS pending_payments
+    FROM pending_payments
+) p
+"""
+
+FIELDS = (
+    "total_users", "test_services", "one_month", "two_month", "three_month",
+    "active_services", "expired_services", "revenue", "approved_payments", "pending_payments",
+)
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        _cache = TTLCache(maxsize=1, ttl=float(os.getenv("STATS_CACHE_TTL") or 30))
+    return _cache
+
+
+async def _load():
+    row = await db.fetchone(STATS_SQL)
+    return dict(zip(FIELDS, (int(value) for value in row)))
+
+
+async def get_stats():
+    """Return the admin stats, computed at most once per STATS_CACHE_TTL seconds."""
+    return await _get_cache().aget_or_load("stats", _load)
+
+
+def invalidate():
+    _get_cache().clear()
@@ -0,0 +1,101 @@
+-- Current full schema. migrations.py runs this file as migration 1 on an empty database; the
+-- later migrations check information_schema before changing anything, so on a database created
+-- from here they find their work already done. Change a table here and add a migration for it.
+
+CREATE TABLE IF NOT EXISTS users (
+    telegram_id VARCHAR(255) PRIMARY KEY,
+    blocked BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS services (
+    service_id VARCHAR(36) PRIMARY KEY,
+    telegram_id VARCHAR(255) NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    ip_address VARCHAR(45),
+    purchase_date DATETIME NOT NULL,
+    expiry_date DATETIME NOT NULL,
+    duration INT NOT NULL,
+    status ENUM('active', 'expired') NOT NULL,
+    is_test BOOLEAN DEFAULT FALSE,
+    deleted BOOLEAN DEFAULT FALSE,
+    notified_at DATETIME NULL DEFAULT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (telegram_id) REFERENCES users(telegram_id),
+    INDEX idx_services_status_expiry (status, expiry_date, deleted),
+    INDEX idx_services_telegram_deleted (telegram_id, deleted),
+    INDEX idx_services_telegram_name (telegram_id, name, deleted),
+    INDEX idx_services_telegram_test (telegram_id, is_test, deleted),
+    INDEX idx_services_duration_test (duration, is_test),
+    INDEX idx_services_unnotified_tests (status, is_test, deleted, notified_at, expiry_date)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS pending_payments (
+    payment_id VARCHAR(36) PRIMARY KEY,
+    telegram_id VARCHAR(255) NOT NULL,
+    service_id VARCHAR(36) NOT NULL,
+    service_name VARCHAR(255) NOT NULL,
+    duration INT NOT NULL,
+    price INT NOT NULL,
+    caption TEXT,
+    status ENUM('pending', 'approved', 'rejected') NOT NULL,
+    reason TEXT,
+    is_renewal BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- service_id has no foreign key: a new purchase's service only exists once it is approved.
+    FOREIGN KEY (telegram_id) REFERENCES users(telegram_id),
+    INDEX idx_pending_payments_telegram_status (telegram_id, status),
+    INDEX idx_pending_payments_status_created (status, created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS outbox_retries (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    chat_id VARCHAR(255) NOT NULL,
+    method VARCHAR(32) NOT NULL,
+    payload TEXT NOT NULL,
+    priority TINYINT NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_outbox_retries_next_attempt (next_attempt_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS broadcasts (
+    broadcast_id VARCHAR(36) PRIMARY KEY,
+    text TEXT NOT NULL,
+    status ENUM('running', 'done', 'cancelled') NOT NULL,
+    cursor_id VARCHAR(255) NOT NULL DEFAULT '',
+    total INT NOT NULL DEFAULT 0,
+    sent INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    deferred INT NOT NULL DEFAULT 0,
+    admin_chat_id VARCHAR(255) NOT NULL,
+    progress_message_id BIGINT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_broadcasts_status (status)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS user_state (
+    telegram_id VARCHAR(255) PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_user_state_updated_at (updated_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS cache_invalidations (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    telegram_id VARCHAR(255) NOT NULL,
+    service_id VARCHAR(36) NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_cache_invalidations_created_at (created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS allowlist_changes (
+    seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+    service_id VARCHAR(36) NOT NULL,
+    ip_address VARCHAR(45) NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_allowlist_changes_created_at (created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
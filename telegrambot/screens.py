@@ -0,0 +1,173 @@
+"""Static screens (text and inline keyboard), built once when the bot starts.
+
+PTB's Telegram objects are immutable once created, so every click reuses the same
+InlineKeyboardMarkup instead of rebuilding it.
+"""
+from collections import namedtuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+Screen = namedtuple("Screen", "text reply_markup")
+
+WELCOME_TEXT = "•.¸♡ به ربات ردکس گیم خوش اومدی ♡¸.•\n🚀 با DNS اختصاصی ما از بازی کردن لذت ببر 🚀"
+MAIN_MENU_TEXT = "•.¸♡ به ربات ردکس گیم خوش اومدی ♡¸.•\nلطفاً گزینه مورد نظر خود را انتخاب کنید: 🚀"
+TUTORIALS_TEXT = "📚 لطفاً پلتفرم مورد نظر خود را برای آموزش تنظیم DNS انتخاب کنید:"
+
+
+def _main_menu(admin):
+    keyboard = [
+        [InlineKeyboardButton("📋 سرویس‌های من", callback_data="my_services")],
+        [InlineKeyboardButton("🛒 خرید سرویس جدید", callback_data="buy_new_service")],
+        [InlineKeyboardButton("🧪 تست رایگان", callback_data="get_test")],
+        [InlineKeyboardButton("🌐 تنظیمات DNS", callback_data="dns_servers")],
+        [InlineKeyboardButton("📚 آموزش‌ها", callback_data="tutorials")],
+        [InlineKeyboardButton("❓ سوالات متداول", callback_data="faq")]
+    ]
+    if admin:
+        keyboard.append([InlineKeyboardButton("📊 آمار کاربران", callback_data="stats")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def build(dns1, dns2, admin=False):
+    """Every static screen by the callback_data that opens it."""
+    back_to_menu = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")]])
+    screens = {
+        "main_menu": Screen(MAIN_MENU_TEXT, _main_menu(admin)),
+        "tutorials": Screen(TUTORIALS_TEXT, InlineKeyboardMarkup([
+            [InlineKeyboardButton("📱 Android", callback_data="tutorial_android")],
+            [InlineKeyboardButton("🍎 iOS", callback_data="tutorial_ios")],
+            [InlineKeyboardButton("💻 Windows", callback_data="tutorial_windows")],
+            [InlineKeyboardButton("🔙 بازگشت", callback_data="main_menu")]
+        ])),
+        "tutorial_android": Screen(
+            (
+                f"📱 آموزش تنظیم DNS در اندروید (دو روش):\n\n"
+                f"🔧 روش اول: تنظیم دستی DNS روی وای‌فای\n"
+                f"1. به تنظیمات دستگاه بروید و گزینه Wi-Fi را انتخاب کنید.\n"
+                f"2. روی نام شبکه وای‌فای خود کلیک کنید (یا گزینه Modify Network).\n"
+                f"3. گزینه Advanced را انتخاب کنید.\n"
+                f"4. تنظیمات IP را از DHCP به Static تغییر دهید.\n"
+                f"5. DNSهای قبلی را حذف کرده و مقادیر زیر را وارد کنید:\n"
+                f"     - DNS1: {dns1}\n"
+                f"     - DNS2: {dns2}\n"
+                f"6. تنظیمات را ذخیره کنید.\n\n"
+                f"---\n\n"
+                f"📲 روش دوم: استفاده از برنامه DNS Changer\n"
+                f"1. برنامه DNS Changer را از گوگل‌پلی دانلود کنید.\n"
+                f"2. برنامه را اجرا کرده و DNSهای زیر را وارد کنید:\n"
+                f"     - DNS1: {dns1}\n"
+                f"     - DNS2: {dns2}\n"
+                f"3. گزینه اتصال را فعال کنید.\n"
+                f"4. مجوز VPN را تأیید کنید (صرفاً برای تغییر DNS).\n"
+                f"5. اینترنت شما اکنون با DNS جدید فعال است!\n\n"
+                f"---\n"
+                f"📌 نکات مهم:\n"
+                f"- در صورت بروز مشکل، تنظیمات را به DHCP بازگردانید.\n"
+                f"- پس از اتمام دوره اشتراک ردکس گیم، تنظیمات را به حالت Automatic برگردانید.\n"
+                f"- در صورت تغییر آی‌پی، لطفاً آی‌پی جدید خود را ثبت کنید.\n\n"
+                f"✅ تنظیمات تکمیل شد! اکنون اینترنت شما بهینه‌تر است."
+            ),
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("📥 دانلود DNS Changer", url="https://play.google.com/store/apps/details?id=com.burakgon.dnschanger")],
+                [InlineKeyboardButton("🔙 بازگشت", callback_data="tutorials")]
+            ])
+        ),
+        "tutorial_ios": Screen(
+            (
+                f"🍎 آموزش تنظیم DNS در iOS (دو روش):\n\n"
+                f"🔧 روش اول: تنظیم دستی DNS روی وای‌فای\n"
+                f"1. به تنظیمات دستگاه بروید و گزینه Wi-Fi را انتخاب کنید.\n"
+                f"2. روی آیکون (i) کنار شبکه وای‌فای خود کلیک کنید.\n"
+                f"3. به بخش DNS بروید.\n"
+                f"4. گزینه Manual را انتخاب کرده و DNSهای قبلی را حذف کنید.\n"
+                f"5. DNSهای زیر را اضافه کنید:\n"
+                f"     - DNS1: {dns1}\n"
+                f"     - DNS2: {dns2}\n"
+                f"6. تنظیمات را ذخیره کنید.\n\n"
+                f"---\n\n"
+                f"📲 روش دوم: استفاده از برنامه DNS Changer\n"
+                f"1. برنامه DNS Changer را از اپ‌استور دانلود کنید.\n"
+                f"2. برنامه را اجرا کرده و DNSهای زیر را وارد کنید:\n"
+                f"     - DNS1: {dns1}\n"
+                f"     - DNS2: {dns2}\n"
+                f"3. گزینه اتصال را فعال کنید.\n"
+                f"4. اینترنت شما اکنون با DNS جدید فعال است!\n\n"
+                f"---\n"
+                f"📌 نکات مهم:\n"
+                f"- در صورت بروز مشکل، تنظیمات DNS را به حالت Automatic بازگردانید.\n"
+                f"- پس از اتمام دوره اشتراک ردکس گیم، تنظیمات را به حالت Automatic برگردانید.\n"
+                f"- در صورت تغییر آی‌پی، لطفاً آی‌پی جدید خود را ثبت کنید.\n\n"
+                f"✅ تنظیمات تکمیل شد! اکنون اینترنت شما بهینه‌تر است."
+            ),
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("📥 دانلود DNS Changer", url="https://apps.apple.com/us/app/dns-ip-changer-secure-vpn/id1562292463")],
+                [InlineKeyboardButton("🔙 بازگشت", callback_data="tutorials")]
+            ])
+        ),
+        "tutorial_windows": Screen(
+            (
+                f"💻 آموزش تنظیم DNS در ویندوز (دو روش):\n\n"
+                f"🔧 روش اول: تنظیم دستی از طریق Control Panel\n"
+                f"1. کلیدهای Win+R را فشار دهید، control را تایپ کرده و Enter بزنید.\n"
+                f"2. در کنترل پنل:\n"
+                f"   - گزینه View by را روی Large icons تنظیم کنید.\n"
+                f"   - روی Network and Sharing Center کلیک کنید.\n"
+                f"3. در صفحه جدید:\n"
+                f"   - از منوی سمت چپ، Change adapter settings را انتخاب کنید.\n"
+                f"4. روی اتصال اینترنت خود (Wi-Fi یا Ethernet):\n"
+                f"   - راست‌کلیک کرده و Properties را انتخاب کنید.\n"
+                f"5. در پنجره Properties:\n"
+                f"   - گزینه Internet Protocol Version 4 (TCP/IPv4) را انتخاب کنید.\n"
+                f"   - روی Properties کلیک کنید.\n"
+                f"6. تنظیم DNS:\n"
+                f"   - گزینه Use the following DNS server addresses را فعال کنید.\n"
+                f"   - در قسمت Preferred DNS: {dns1}\n"
+                f"   - در قسمت Alternate DNS: {dns2}\n"
+                f"7. روی OK کلیک کنید.\n"
+                f"8. تمام پنجره‌ها را با کلیک روی OK ببندید.\n\n"
+                f"---\n\n"
+                f"📲 روش دوم: استفاده از DNS Jumper\n"
+                f"1. برنامه DNS Jumper را از لینک زیر دانلود کنید.\n"
+                f"2. پس از دانلود:\n"
+                f"   - فایل ZIP را استخراج کنید.\n"
+                f"   - روی DnsJumper.exe دوبار کلیک کنید.\n"
+                f"3. در برنامه:\n"
+                f"   - از منوی بالا، Network Adapter را انتخاب کنید.\n"
+                f"   - در بخش Custom، مقادیر زیر را وارد کنید:\n"
+                f"     - DNS1: {dns1}\n"
+                f"     - DNS2: {dns2}\n"
+                f"4. روی Apply DNS کلیک کنید.\n"
+                f"5. پیام سبز رنگ Successfully applied نشان‌دهنده موفقیت است.\n\n"
+                f"---\n"
+                f"📌 نکات مهم:\n"
+                f"- برای بازگشت به حالت اولیه، در DNS Jumper روی Restore Original DNS کلیک کنید.\n"
+                f"- برای تست DNS جدید، در CMD دستور ping 1.1.1.1 را اجرا کنید.\n\n"
+                f"✅ تنظیمات تکمیل شد! اکنون اینترنت شما سریع‌تر و امن‌تر است."
+            ),
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("📥 دانلود DNS Jumper", url="https://www.sordum.org/files/downloads.php?dns-jumper")],
+                [InlineKeyboardButton("🔙 بازگشت", callback_data="tutorials")]
+            ])
+        ),
+        "faq": Screen(
+            (
+                f"❓ سوالات متداول:\n\n"
+                f"🔍 DNS چیست و آیا خطری برای حساب‌های من دارد؟\n"
+                f"خیر، DNS (Domain Name System) مانند دفترچه تلفن اینترنت عمل می‌کند. برای مثال، Google.com را به آی‌پی 8.8.8.8 تبدیل می‌کند و هیچ خطری برای شما یا حساب‌هایتان ندارد.\n\n"
+                f"📡 DNS چگونه پینگ را کاهش می‌دهد؟\n"
+                f"بدون تنظیم DNS، دستگاه شما به سرورهای DNS عمومی (مانند 1.1.1.1) متصل می‌شود که معمولاً شلوغ و دور هستند. ردکس گیم با سرورهای قدرتمند در ایران و روتینگ بهینه، تأخیر را کاهش داده و پینگ شما را بهبود می‌بخشد.\n\n"
+                f"⚠️ آیا استفاده از DNS باعث بن شدن حساب بازی می‌شود؟\n"
+                f"خیر، استفاده از DNS ردکس گیم هیچ خطری برای حساب بازی شما ندارد."
+            ),
+            back_to_menu
+        ),
+        "dns_servers": Screen(
+            (
+                f"🌐 آدرس‌های DNS ردکس گیم (IPv4):\n"
+                f"     - DNS1: {dns1}\n"
+                f"     - DNS2: {dns2}"
+            ),
+            back_to_menu
+        )
+    }
+    return screens
@@ -0,0 +1,183 @@
+"""Read-through cache for the "my services" list and the service details screen.
+
+Entries are bounded by SERVICE_CACHE_SIZE (LRU) and SERVICE_CACHE_TTL. Every write that
+changes a service calls invalidate(), which drops the local entries and appends a row to
+cache_invalidations; every process that reads the cache (the bot, each worker in worker mode)
+runs start() to poll that table and drop the same entries, so it serves stale data for at most
+CACHE_POLL_INTERVAL seconds. The web workers only write, so they call invalidate() without polling.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import mysql.connector
+
+import db
+import queries
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# A row whose id is skipped over may still be committed a moment later; give it this long.
+GAP_WAIT = 10
+PRUNE_EVERY = 600
+
+_lists = None
+_details = None
+_poller = None
+_listeners = []
+
+
+def _caches():
+    global _lists, _details
+    if _lists is None:
+        size = int(os.getenv("SERVICE_CACHE_SIZE") or 10000)
+        ttl = float(os.getenv("SERVICE_CACHE_TTL") or 300)
+        _lists = TTLCache(maxsize=size, ttl=ttl, is_negative=lambda value: False)
+        _details = TTLCache(maxsize=size, ttl=ttl, negative_ttl=float(os.getenv("SERVICE_CACHE_NEGATIVE_TTL") or 30))
+    return _lists, _details
+
+
+async def user_services(telegram_id):
+    """ServiceSummary rows of the user's services, as a tuple."""
+    lists, _ = _caches()
+    telegram_id = str(telegram_id)
+
+    async def load():
+        return tuple(await queries.fetchall(queries.USER_SERVICES, telegram_id))
+
+    return await lists.aget_or_load(telegram_id, load)
+
+
+async def service(service_id, telegram_id):
+    """The user's Service row, or None if it does not exist (or is not theirs)."""
+    _, details = _caches()
+    telegram_id = str(telegram_id)
+    return await details.aget_or_load(
+        (service_id, telegram_id), lambda: queries.fetchone(queries.SERVICE, service_id, telegram_id)
+    )
+
+
+def _forget(telegram_id, service_id):
+    lists, details = _caches()
+    lists.invalidate(telegram_id)
+    if service_id is not None:
+        details.invalidate((service_id, telegram_id))
+
+
+def on_invalidation(callback):
+    """Call callback(telegram_id) for every invalidation read from the feed, including our own."""
+    _listeners.append(callback)
+
+
+def _record(conn, rows):
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("INSERT INTO cache_invalidations (telegram_id, service_id) VALUES (%s, %s)", rows)
+    finally:
+        cursor.close()
+
+
+async def invalidate_many(pairs):
+    """Drop cached data for each (telegram_id, service_id or None), here and in the other processes."""
+    rows = [(str(telegram_id), service_id) for telegram_id, service_id in pairs]
+    if not rows:
+        return
+    for telegram_id, service_id in rows:
+        _forget(telegram_id, service_id)
+    try:
+        await db.run(_record, rows)
+    except mysql.connector.Error as e:
+        # The other processes catch up when their entries expire.
+        logger.error("Failed to publish %s cache invalidations: %s", len(rows), e)
+
+
+async def invalidate(telegram_id, service_id=None):
+    await invalidate_many([(telegram_id, service_id)])
+
+
+class _Poller:
+    def __init__(self, interval, retention):
+        self.interval = interval
+        self.retention = retention
+        self.last_id = None
+        # Skipped ids that may still show up, mapped to when we stop waiting for them.
+        self.gaps = {}
+        self.applied = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="servicecache-poller")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _apply(self, rows):
+        now = time.monotonic()
+        for row in rows:
+            if row.id > self.last_id:
+                for missing in range(self.last_id + 1, min(row.id, self.last_id + 1000)):
+                    self.gaps[missing] = now + GAP_WAIT
+                self.last_id = row.id
+            elif self.gaps.pop(row.id, None) is None:
+                continue
+            _forget(row.telegram_id, row.service_id)
+            for callback in _listeners:
+                callback(row.telegram_id)
+            self.applied += 1
+        self.gaps = {gap: deadline for gap, deadline in self.gaps.items() if deadline > now}
+
+    async def _poll(self):
+        if self.last_id is None:
+            self.last_id = await queries.scalar(queries.LAST_INVALIDATION) or 0
+            # Anything cached before we knew where the feed stood may have missed a change.
+            for cache in _caches():
+                cache.clear()
+            return
+        since = min(self.gaps) - 1 if self.gaps else self.last_id
+        self._apply(await queries.fetchall(queries.INVALIDATIONS_SINCE, since))
+
+    async def _run(self):
+        next_prune = time.monotonic() + PRUNE_EVERY
+        while True:
+            try:
+                await self._poll()
+                if time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + PRUNE_EVERY
+                    await queries.execute(queries.PRUNE_INVALIDATIONS, int(self.retention))
+            except mysql.connector.Error as e:
+                logger.error("Failed to read cache invalidations: %s", e)
+                # Until the feed is readable again there is no telling what changed.
+                for cache in _caches():
+                    cache.clear()
+            await asyncio.sleep(self.interval)
+
+
+def start():
+    global _poller
+    _poller = _Poller(
+        interval=float(os.getenv("CACHE_POLL_INTERVAL") or 1),
+        retention=float(os.getenv("CACHE_INVALIDATION_RETENTION") or 3600)
+    )
+    _poller.start()
+    return _poller
+
+
+async def stop():
+    global _poller
+    if _poller is not None:
+        await _poller.stop()
+        _poller = None
+
+
+def stats():
+    lists, details = _caches()
+    return {
+        "lists": lists.stats(),
+        "details": details.stats(),
+        "invalidations_applied": _poller.applied if _poller is not None else 0,
+    }
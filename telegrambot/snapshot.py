@@ -0,0 +1,246 @@
+"""Binary snapshot of the allowed client IPs, shared with other local processes through mmap.
+
+    python snapshot.py info             # print the header of SNAPSHOT_PATH
+    python snapshot.py check IP [IP..]  # look IPs up in it
+
+The file is a 32-byte header followed by the allowed IPs as 16-byte entries (IPv4 stored
+IPv4-mapped), sorted, so readers binary-search the mapped file in place. The bot's
+Publisher follows the allowlist feed and rewrites the file whenever it changes; a new
+version is written to a temporary file and renamed over the old one, so a reader only
+ever maps a complete file. Reader re-opens the path when the file behind it is replaced.
+"""
+import argparse
+import asyncio
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+import mysql.connector
+
+import allowlist
+import ipindex
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RDXA"
+FORMAT_VERSION = 1
+ENTRY_SIZE = 16
+# magic, format version, entry size, feed seq, entry count, published at (unix ms)
+HEADER = struct.Struct("<4sHHQQQ")
+
+
+def pack(ip):
+    """16-byte entry of an IP in canonical text."""
+    if ":" in ip:
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return ipindex.V4_MAPPED_PREFIX + socket.inet_pton(socket.AF_INET, ip)
+
+
+def write(path, seq, ips):
+    """Write a snapshot of ips (canonical text) at feed position seq, replacing path atomically."""
+    entries = sorted(pack(ip) for ip in ips)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, ENTRY_SIZE, seq, len(entries), int(time.time() * 1000))
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(b"".join(entries))
+            f.flush()
+            os.fsync(f.fileno())
+        # Readers can map it straight away; mkstemp creates files readable by the owner only.
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(entries)
+
+
+class Reader:
+    """Looks IPs up in the snapshot at path, switching to a new version when one is published."""
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.seq = None
+        self.count = 0
+        self.published_at = None
+        self._map = None
+        self._inode = None
+        self._next_check = 0.0
+
+    def _open(self):
+        try:
+            with open(self.path, "rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode == self._inode:
+                    return
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            # ValueError: an empty file cannot be mapped.
+            logger.warning("Cannot open allowlist snapshot %s: %s", self.path, e)
+            return
+        if len(mapped) < HEADER.size:
+            mapped.close()
+            return
+        magic, version, entry_size, seq, count, published_ms = HEADER.unpack_from(mapped)
+        if (magic, version, entry_size) != (MAGIC, FORMAT_VERSION, ENTRY_SIZE) or \
+                len(mapped) != HEADER.size + count * ENTRY_SIZE:
+            logger.warning("Ignoring malformed allowlist snapshot %s", self.path)
+            mapped.close()
+            return
+        old, self._map = self._map, mapped
+        self._inode = inode
+        self.seq, self.count, self.published_at = seq, count, published_ms / 1000
+        if old is not None:
+            old.close()
+
+    def refresh(self):
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self._open()
+
+    def __contains__(self, ip):
+        self.refresh()
+        if not self.count:
+            return False
+        ip = ipindex.canonical(ip)
+        if ip is None:
+            return False
+        key = pack(ip)
+        mapped = self._map
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * ENTRY_SIZE
+            entry = mapped[offset:offset + ENTRY_SIZE]
+            if entry < key:
+                low = middle + 1
+            elif entry > key:
+                high = middle
+            else:
+                return True
+        return False
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class Publisher:
+    """Keeps the snapshot file in step with the allowlist feed."""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.index = ipindex.IPIndex()
+        self.published_seq = None
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="snapshot-publisher")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self):
+        self._wake.set()
+
+    async def _sync(self):
+        while True:
+            if not self.index.loaded:
+                seq, services = await allowlist.snapshot()
+                self.index.load(seq, services)
+            changes = await allowlist.changes(self.index.seq)
+            if changes is None:
+                logger.warning("Allowlist changes after %s were pruned; reloading", self.index.seq)
+                self.index.seq = None
+                continue
+            self.index.apply(changes)
+            if len(changes) < allowlist.PAGE_SIZE:
+                return
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self._sync()
+                if self.index.seq != self.published_seq:
+                    seq = self.index.seq
+                    count = await loop.run_in_executor(None, write, self.path, seq, list(self.index.ips()))
+                    self.published_seq = seq
+                    logger.debug("Published allowlist snapshot %s with %s IPs", seq, count)
+            except (mysql.connector.Error, OSError) as e:
+                logger.error("Failed to publish the allowlist snapshot: %s", e)
+            except Exception:
+                # Anything else (odd data in the feed) must not end the task and leave the file stale.
+                logger.exception("Unexpected error while publishing the allowlist snapshot")
+
+
+_publisher = None
+
+
+def start():
+    global _publisher
+    _publisher = Publisher(
+        os.getenv("SNAPSHOT_PATH") or "allowlist.bin",
+        float(os.getenv("SNAPSHOT_INTERVAL") or 1)
+    )
+    _publisher.start()
+    return _publisher
+
+
+async def stop():
+    global _publisher
+    if _publisher is not None:
+        await _publisher.stop()
+        _publisher = None
+
+
+def notify():
+    """Publish soon, e.g. after an IP was registered; a no-op in processes that do not publish."""
+    if _publisher is not None:
+        _publisher.notify()
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Inspect the allowlist snapshot file")
+    parser.add_argument("command", choices=("info", "check"))
+    parser.add_argument("ips", nargs="*")
+    args = parser.parse_args()
+    load_dotenv()
+    reader = Reader(os.getenv("SNAPSHOT_PATH") or "allowlist.bin")
+    reader.refresh()
+    if reader.seq is None:
+        print("No readable snapshot", file=sys.stderr)
+        sys.exit(1)
+    if args.command == "info":
+        published = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(reader.published_at))
+        print(f"seq {reader.seq}, {reader.count} IPs, published {published}")
+    else:
+        for ip in args.ips:
+            print(f"{ip} {'allowed' if ip in reader else 'not allowed'}")
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+"""Benchmark the bot's handlers and the web API against a throwaway MySQL database.
+
+Start MySQL with the repo's docker-compose.yml, then from the telegrambot directory:
+
+    python tools/bench.py --output bench.json
+    python tools/bench.py --baseline bench.json
+
+The real handlers from bot.py run in-process and talk to tools/fake_telegram.py instead of
+Telegram. migrations.py builds the schema in a fresh database (redex_bench by
+default), which is dropped afterwards. /api/register_ip is called in-process through
+web.py's ASGI app; to load-test a running server instead, pass --web-url and point that
+server at the same database with MYSQL_DATABASE.
+
+Each scenario reports throughput and p50/p95/p99 latency. With --baseline, the run is
+compared to a saved result, and the exit status is 1 when any scenario regressed by more
+than --tolerance.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timedelta
+
+import mysql.connector
+from dotenv import load_dotenv
+from telegram import Update
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.dirname(TOOLS_DIR)
+sys.path.insert(0, BOT_DIR)
+
+from fake_telegram import callback_update  # noqa: E402
+
+ADMIN_ID = 1000000
+# Inside 5.160.0.0/14, which the bench GeoIP dataset maps to IR.
+BENCH_IP = "5.160.10.20"
+SCENARIOS = ("start", "my_services", "service_info", "get_test", "purchase", "approve_payment", "register_ip")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def start_fake_telegram():
+    port = _free_port()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(TOOLS_DIR, "fake_telegram.py"), "serve", "--port", str(port)],
+        stdout=subprocess.DEVNULL
+    )
+    api = f"http://127.0.0.1:{port}"
+    _wait_for(f"{api}/_stats")
+    return process, api
+
+
+def _connect(database=None):
+    kwargs = {}
+    if database:
+        kwargs["database"] = database
+    return mysql.connector.connect(
+        host=os.getenv("MYSQL_HOST", "127.0.0.1"),
+        port=int(os.getenv("MYSQL_PORT") or 3307),
+        user=os.getenv("MYSQL_USER", "root"),
+        password=os.getenv("MYSQL_PASSWORD"),
+        autocommit=True,
+        **kwargs
+    )
+
+
+def create_database(name):
+    import migrations
+
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"DROP DATABASE IF EXISTS `{name}`")
+        cursor.execute(f"CREATE DATABASE `{name}` DEFAULT CHARSET utf8mb4")
+        cursor.execute(f"USE `{name}`")
+        cursor.close()
+        migrations.migrate(conn)
+    finally:
+        conn.close()
+
+
+def drop_database(name):
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"DROP DATABASE IF EXISTS `{name}`")
+        cursor.close()
+    finally:
+        conn.close()
+
+
+def seed(database, users, services_per_user):
+    """Users with a few active services each; returns [(telegram_id, service_id), ...]."""
+    now = datetime.now()
+    user_rows = [(str(user_id),) for user_id in users] + [(str(ADMIN_ID),)]
+    service_rows = []
+    for user_id in users:
+        for i in range(services_per_user):
+            service_rows.append((
+                str(uuid.uuid4()), str(user_id), f"bench{user_id}s{i}", now, now + timedelta(days=30), 30, "active"
+            ))
+    conn = _connect(database)
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT INTO users (telegram_id) VALUES (%s)", user_rows)
+        cursor.executemany(
+            "INSERT INTO services (service_id, telegram_id, name, purchase_date, expiry_date, duration, status) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+            service_rows
+        )
+        cursor.close()
+    finally:
+        conn.close()
+    return [(row[1], row[0]) for row in service_rows]
+
+
+def write_geoip_dataset():
+    path = os.path.join(tempfile.mkdtemp(prefix="redex-bench-"), "geoip.csv")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("5.160.0.0/14,IR\n8.8.8.0/24,US\n")
+    return path
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"}
+
+
+def _message(update_id, user_id, **fields):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+    }
+    message.update(fields)
+    return {"update_id": update_id, "message": message}
+
+
+def command_update(update_id, user_id, command):
+    return _message(
+        update_id, user_id, text=command, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}]
+    )
+
+
+def text_update(update_id, user_id, text):
+    return _message(update_id, user_id, text=text)
+
+
+def photo_update(update_id, user_id, caption):
+    photo = [{"file_id": f"receipt{update_id}", "file_unique_id": f"r{update_id}", "width": 800, "height": 600}]
+    return _message(update_id, user_id, photo=photo, caption=caption)
+
+
+def summarize(latencies, errors, elapsed):
+    report = {
+        "count": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    }
+    if latencies:
+        latencies = sorted(latencies)
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+        report.update({
+            "p50_ms": round(quantiles[49] * 1000, 2),
+            "p95_ms": round(quantiles[94] * 1000, 2),
+            "p99_ms": round(quantiles[98] * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2),
+        })
+    return report
+
+
+class BotBench:
+    def __init__(self, application, concurrency):
+        self.application = application
+        self.concurrency = concurrency
+        self.update_ids = itertools.count(1)
+        self.errors = 0
+        application.add_error_handler(self._on_error)
+
+    async def _on_error(self, update, context):
+        self.errors += 1
+
+    async def send(self, build, *args):
+        """Process one update and return how long the handler took."""
+        update = Update.de_json(build(next(self.update_ids), *args), self.application.bot)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        return time.perf_counter() - started
+
+    async def phase(self, items, flow):
+        """Run flow(item) for every item, `concurrency` at a time; returns (latencies, errors, elapsed)."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        latencies = []
+        errors_before = self.errors
+
+        async def run(item):
+            async with semaphore:
+                latencies.extend(await flow(item))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run(item) for item in items))
+        return latencies, self.errors - errors_before, time.perf_counter() - started
+
+
+async def run_bot_scenarios(args, users, services, results):
+    import bot
+    import db
+
+    db.init_pool()
+    application = bot.build_application("worker")
+    bench = BotBench(application, args.concurrency)
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    try:
+        selected = set(args.scenarios)
+
+        async def record(name, items, flow):
+            latencies, errors, elapsed = await bench.phase(items, flow)
+            results[name] = summarize(latencies, errors, elapsed)
+            print(f"{name}: {json.dumps(results[name])}", file=sys.stderr)
+
+        async def start_flow(user_id):
+            return [await bench.send(command_update, user_id, "/start") for _ in range(args.iterations)]
+
+        async def my_services_flow(user_id):
+            return [await bench.send(callback_update, user_id, "my_services") for _ in range(args.iterations)]
+
+        async def service_info_flow(item):
+            user_id, service_id = item
+            return [
+                await bench.send(callback_update, int(user_id), f"service_info_{service_id}")
+                for _ in range(args.iterations)
+            ]
+
+        async def get_test_flow(user_id):
+            # The first press creates the test service, the rest hit the "already received" path.
+            return [await bench.send(callback_update, user_id, "get_test") for _ in range(args.iterations)]
+
+        def purchase_flow(iteration):
+            async def flow(user_id):
+                return [
+                    await bench.send(callback_update, user_id, "buy_new_service"),
+                    await bench.send(text_update, user_id, f"bench{user_id}n{iteration}"),
+                    await bench.send(callback_update, user_id, "duration_30"),
+                    await bench.send(photo_update, user_id, "bench receipt"),
+                ]
+            return flow
+
+        async def approve_flow(item):
+            payment_id, user_id = item
+            return [await bench.send(callback_update, ADMIN_ID, f"approve_payment_{payment_id}_{user_id}")]
+
+        if "start" in selected:
+            await record("start", users, start_flow)
+        if "my_services" in selected:
+            await record("my_services", users, my_services_flow)
+        if "service_info" in selected:
+            await record("service_info", services, service_info_flow)
+        if "get_test" in selected:
+            await record("get_test", users, get_test_flow)
+        if "purchase" in selected or "approve_payment" in selected:
+            purchase, approve = ([], 0, 0.0), ([], 0, 0.0)
+            for iteration in range(args.iterations):
+                latencies, errors, elapsed = await bench.phase(users, purchase_flow(iteration))
+                purchase = (purchase[0] + latencies, purchase[1] + errors, purchase[2] + elapsed)
+                pending = await db.fetchall("SELECT payment_id, telegram_id FROM pending_payments WHERE status = 'pending'")
+                latencies, errors, elapsed = await bench.phase(pending, approve_flow)
+                approve = (approve[0] + latencies, approve[1] + errors, approve[2] + elapsed)
+            if "purchase" in selected:
+                results["purchase"] = summarize(*purchase)
+                print(f"purchase: {json.dumps(results['purchase'])}", file=sys.stderr)
+            if "approve_payment" in selected:
+                results["approve_payment"] = summarize(*approve)
+                print(f"approve_payment: {json.dumps(results['approve_payment'])}", file=sys.stderr)
+    finally:
+        await application.stop()
+        await bot.post_stop(application)
+        await application.shutdown()
+        db.close_pool()
+
+
+async def run_register_ip(args, services, results):
+    import httpx
+
+    payloads = [
+        {"ip": BENCH_IP, "service_id": service_id, "telegram_id": telegram_id}
+        for telegram_id, service_id in services
+    ] * args.iterations
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+
+    async def post(client, payload):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post("/api/register_ip", json=payload)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200 or not response.json().get("success"):
+                errors += 1
+
+    async def run(client):
+        started = time.perf_counter()
+        await asyncio.gather(*(post(client, payload) for payload in payloads))
+        return time.perf_counter() - started
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    if args.web_url:
+        async with httpx.AsyncClient(base_url=args.web_url, limits=limits, timeout=30) as client:
+            elapsed = await run(client)
+    else:
+        import web
+        async with web.app.test_app():
+            transport = httpx.ASGITransport(app=web.app, client=("127.0.0.1", 40000))
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=30) as client:
+                elapsed = await run(client)
+    results["register_ip"] = summarize(latencies, errors, elapsed)
+    print(f"register_ip: {json.dumps(results['register_ip'])}", file=sys.stderr)
+
+
+def compare(results, baseline, tolerance):
+    """Print the change per scenario; returns the names of the scenarios that regressed."""
+    regressed = []
+    print(f"{'scenario':<16}{'p95 ms':>18}{'p99 ms':>18}{'throughput/s':>22}", file=sys.stderr)
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous or "p95_ms" not in current or "p95_ms" not in previous:
+            continue
+        slower = current["p95_ms"] > previous["p95_ms"] * (1 + tolerance)
+        fewer = current["throughput"] < previous["throughput"] * (1 - tolerance)
+        if slower or fewer or current["errors"] > previous["errors"]:
+            regressed.append(name)
+        print(
+            f"{name:<16}"
+            f"{previous['p95_ms']:>8} -> {current['p95_ms']:<8}"
+            f"{previous['p99_ms']:>8} -> {current['p99_ms']:<8}"
+            f"{previous['throughput']:>10} -> {current['throughput']:<10}"
+            f"{' REGRESSION' if name in regressed else ''}",
+            file=sys.stderr
+        )
+    return regressed
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def bench(args):
+    first = args.first_user
+    users = list(range(first, first + args.users))
+    create_database(args.database)
+    fake_api = None
+    try:
+        services = seed(args.database, users, args.services_per_user)
+        if args.api is None:
+            fake_api, args.api = start_fake_telegram()
+        os.environ["TELEGRAM_API_URL"] = args.api
+        results = {}
+        bot_scenarios = [name for name in args.scenarios if name != "register_ip"]
+        if bot_scenarios:
+            await run_bot_scenarios(args, users, services, results)
+        if "register_ip" in args.scenarios:
+            await run_register_ip(args, services, results)
+    finally:
+        if fake_api is not None:
+            fake_api.terminate()
+            fake_api.wait()
+        if not args.keep_db:
+            drop_database(args.database)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--users", type=int, default=200, help="number of simulated users")
+    parser.add_argument("--first-user", type=int, default=7000000)
+    parser.add_argument("--services-per-user", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=5, help="repetitions of each scenario per user")
+    parser.add_argument("--concurrency", type=int, default=20, help="users (or web clients) active at once")
+    parser.add_argument("--database", default="redex_bench", help="throwaway database, dropped after the run")
+    parser.add_argument("--keep-db", action="store_true", help="keep the database for inspection")
+    parser.add_argument("--api", help="use an already running fake Telegram API instead of starting one")
+    parser.add_argument("--web-url", help="load-test a running web.py (e.g. http://127.0.0.1:5001) instead of in-process")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against the results saved in this file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.database == "dnsbot":
+        parser.error("refusing to use the production database")
+
+    load_dotenv(os.path.join(BOT_DIR, ".env"))
+    # Set before bot/web are imported, since they read these at import time.
+    os.environ.update({
+        "MYSQL_DATABASE": args.database,
+        "ADMIN_ID": str(ADMIN_ID),
+        "BOT_TOKEN": "1000:bench",
+        "BOT_RUN_JOBS": "1",
+        "METRICS_PORT": "0",
+        "LOG_LEVEL": args.log_level,
+    })
+    if not os.path.exists(os.getenv("GEOIP_DB_PATH") or "geoip.csv"):
+        os.environ["GEOIP_DB_PATH"] = write_geoip_dataset()
+
+    results = asyncio.run(bench(args))
+    output = {
+        "meta": {
+            "revision": _git_revision(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "users": args.users,
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "web": args.web_url or "in-process",
+        },
+        "results": results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressed = compare(results, baseline, args.tolerance)
+        if regressed:
+            print(f"Regressed: {', '.join(regressed)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Minimal stand-in for the Telegram Bot API, for running the bot locally.
+
+Start it, point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:8081, run the bot
+with BOT_MODE=webhook and then post synthetic updates:
+
+    python tools/fake_telegram.py serve --port 8081
+    python tools/fake_telegram.py post --api http://127.0.0.1:8081 --count 500 --concurrency 20
+
+`post` sends button presses (callback queries) to the webhook the bot registered and
+reports the latency until the bot answered each one.
+"""
+import argparse
+import itertools
+import json
+import statistics
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "RedexGame", "username": "redex_test_bot"}
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.webhook = None
+        self.secret = None
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+        self.answered = {}
+
+    def handle(self, method, params):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self.webhook = params.get("url")
+            self.secret = params.get("secret_token")
+            return True
+        if method == "deleteWebhook":
+            self.webhook = None
+            return True
+        if method == "getWebhookInfo":
+            return {"url": self.webhook or "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "getUpdates":
+            time.sleep(min(float(params.get("timeout") or 0), 1.0))
+            return []
+        if method == "answerCallbackQuery":
+            with self.lock:
+                self.answered[params.get("callback_query_id")] = time.monotonic()
+                self.lock.notify_all()
+            return True
+        if method in ("sendMessage", "sendPhoto", "editMessageText", "editMessageReplyMarkup"):
+            return {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text") or "",
+            }
+        return True
+
+    def wait_answered(self, callback_query_id, timeout):
+        with self.lock:
+            self.lock.wait_for(lambda: callback_query_id in self.answered, timeout)
+            return self.answered.get(callback_query_id)
+
+    def stats(self):
+        with self.lock:
+            return {"webhook": self.webhook, "secret": self.secret, "calls": dict(self.calls), "answered": len(self.answered)}
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, payload, status=200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _params(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            content_type = self.headers.get("Content-Type") or ""
+            if "json" in content_type:
+                return json.loads(raw or b"{}")
+            if "multipart" in content_type:
+                # Uploaded files are not needed; the receipt flows only forward file_ids.
+                return {}
+            return dict(parse_qsl(raw.decode()))
+
+        def do_GET(self):
+            if self.path == "/_stats":
+                return self._reply(api.stats())
+            if self.path.startswith("/_answered/"):
+                # Blocks until the bot answered the callback query (or 10s passed).
+                callback_query_id = self.path.rsplit("/", 1)[1]
+                return self._reply({"answered_at": api.wait_answered(callback_query_id, 10)})
+            self._reply({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+
+        def do_POST(self):
+            # /bot<token>/<method>
+            parts = self.path.strip("/").split("/")
+            if len(parts) != 2 or not parts[0].startswith("bot"):
+                return self._reply({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+            self._reply({"ok": True, "result": api.handle(parts[1], self._params())})
+
+    return Handler
+
+
+def serve(args):
+    api = FakeTelegram()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(api))
+    print(f"Fake Telegram API listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def _get(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": f"cb{update_id}",
+            "chat_instance": str(user_id),
+            "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"},
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "menu",
+            },
+        },
+    }
+
+
+def post(args):
+    info = _get(f"{args.api}/_stats")
+    webhook = args.webhook or info["webhook"]
+    if not webhook:
+        raise SystemExit("The bot has not registered a webhook yet")
+    secret = args.secret or info["secret"] or ""
+
+    def send(update_id):
+        update = callback_update(update_id, args.first_user + update_id % args.users, args.data)
+        request = urllib.request.Request(
+            webhook,
+            data=json.dumps(update).encode(),
+            headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+        )
+        started = time.monotonic()
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+        answered_at = _get(f"{args.api}/_answered/cb{update_id}")["answered_at"]
+        return None if answered_at is None else answered_at - started
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(send, range(1, args.count + 1)))
+    elapsed = time.monotonic() - started
+    latencies = sorted(r for r in results if r is not None)
+    report = {"updates": args.count, "answered": len(latencies), "elapsed_s": round(elapsed, 3),
+              "throughput": round(args.count / elapsed, 1)}
+    if latencies:
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        report.update({
+            "p50_ms": round(quantiles[49] * 1000, 1),
+            "p95_ms": round(quantiles[94] * 1000, 1),
+            "p99_ms": round(quantiles[98] * 1000, 1),
+        })
+    print(json.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_serve = sub.add_parser("serve", help="run the fake Bot API server")
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=8081)
+    p_serve.set_defaults(func=serve)
+    p_post = sub.add_parser("post", help="post synthetic updates to the bot's webhook")
+    p_post.add_argument("--api", default="http://127.0.0.1:8081")
+    p_post.add_argument("--webhook", help="override the webhook URL the bot registered")
+    p_post.add_argument("--secret", help="override the secret token the bot registered")
+    p_post.add_argument("--count", type=int, default=100)
+    p_post.add_argument("--concurrency", type=int, default=10)
+    p_post.add_argument("--users", type=int, default=50, help="number of distinct simulated users")
+    p_post.add_argument("--first-user", type=int, default=5000000)
+    p_post.add_argument("--data", default="faq", help="callback_data of the simulated button press")
+    p_post.set_defaults(func=post)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark ipindex.IPIndex lookups, without a database.
+
+    python tools/ipindex_bench.py --services 1000000 --lookups 2000000
+
+Builds an index of random IPv4 services (a few IPv6), applies a batch of changes, then
+times `ip in index` for text and packed addresses, half of them allowed. Prints one JSON
+object.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ipindex import IPIndex  # noqa: E402
+
+
+def _random_v4(rng):
+    return socket.inet_ntoa(rng.getrandbits(32).to_bytes(4, "big"))
+
+
+def _random_v6(rng):
+    return socket.inet_ntop(socket.AF_INET6, rng.getrandbits(128).to_bytes(16, "big"))
+
+
+def _time_lookups(index, ips, rounds):
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        hits = 0
+        for ip in ips:
+            if ip in index:
+                hits += 1
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        "lookups": len(ips),
+        "hits": hits,
+        "lookups_per_s": round(len(ips) / best),
+        "ns_per_lookup": round(best / len(ips) * 1e9, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--services", type=int, default=1000000)
+    parser.add_argument("--ipv6-share", type=float, default=0.01)
+    parser.add_argument("--changes", type=int, default=2000)
+    parser.add_argument("--lookups", type=int, default=1000000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    services = [
+        (str(uuid.UUID(int=rng.getrandbits(128))), _random_v6(rng) if rng.random() < args.ipv6_share else _random_v4(rng))
+        for _ in range(args.services)
+    ]
+    index = IPIndex()
+    started = time.perf_counter()
+    index.load(0, services)
+    load_s = time.perf_counter() - started
+
+    changes = [(seq, services[rng.randrange(len(services))][0], _random_v4(rng)) for seq in range(1, args.changes + 1)]
+    started = time.perf_counter()
+    index.apply(changes)
+    apply_s = time.perf_counter() - started
+
+    allowed = [ip for _, ip in rng.sample(services, min(args.lookups // 2, len(services)))]
+    queries = allowed + [_random_v4(rng) for _ in range(args.lookups - len(allowed))]
+    rng.shuffle(queries)
+    packed = [socket.inet_pton(socket.AF_INET6 if ":" in ip else socket.AF_INET, ip) for ip in queries]
+
+    print(json.dumps({
+        "services": args.services,
+        "load_s": round(load_s, 3),
+        "apply_per_change_us": round(apply_s / max(args.changes, 1) * 1e6, 2),
+        "index": index.stats(),
+        "text": _time_lookups(index, queries, args.rounds),
+        "packed": _time_lookups(index, packed, args.rounds),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
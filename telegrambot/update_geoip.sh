@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# Download the free db-ip.com country "lite" dataset used by geoip.py.
+# The file is replaced atomically; running bot/web processes pick it up on their next reload check.
+
+cd "$(dirname "$0")"
+GEOIP_URL="https://download.db-ip.com/free/dbip-country-lite-$(date +%Y-%m).csv.gz"
+if curl -fsSL "$GEOIP_URL" | gunzip > geoip.csv.tmp && [ -s geoip.csv.tmp ]; then
+    mv geoip.csv.tmp geoip.csv
+    echo "GeoIP dataset updated from $GEOIP_URL"
+else
+    rm -f geoip.csv.tmp
+    echo "Error: failed to download GeoIP dataset from $GEOIP_URL"
+    exit 1
+fi
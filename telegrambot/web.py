@@ -1,110 +1,117 @@
-from flask import Flask, render_template, request, jsonify
-import mysql.connector
-import requests
+import hmac
 import os
 import time
+from quart import Quart, Response, g, render_template, request, jsonify
+import mysql.connector
 import logging
 from dotenv import load_dotenv
+import allowlist
+import db
+import geoip
+import logsetup
+import metrics
+import servicecache
 
-app = Flask(__name__)
+app = Quart(__name__)
 load_dotenv()
-
-logging.basicConfig(
-    filename='web.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# hypercorn runs several worker processes.
+logsetup.configure('web.log', per_process=True)
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
+@app.before_serving
+async def startup():
+    db.init_pool()
+    geoip.start_auto_reload()
+
+@app.after_serving
+async def shutdown():
+    db.close_pool()
+
+@app.before_request
+async def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+async def record_timing(response):
+    metrics.WEB_REQUEST_SECONDS.labels(request.endpoint or "unknown", str(response.status_code)).observe(
+        time.perf_counter() - g.started
+    )
+    return response
+
+def allowlist_authorized():
+    token = os.getenv("ALLOWLIST_TOKEN")
+    # The feed is disabled until a token is configured.
+    return bool(token) and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+
+@app.route("/api/allowlist/snapshot")
+async def allowlist_snapshot():
+    if not allowlist_authorized():
+        return Response("Forbidden", status=403)
     try:
-        conn = mysql.connector.connect(
-            host="127.0.0.1",
-            port=3307,
-            user=os.getenv("MYSQL_USER"),
-            password=os.getenv("MYSQL_PASSWORD"),
-            database="dnsbot"
-        )
-        logger.info("Database connection established")
-        return conn
-    except mysql.connector.Error as err:
-        logger.error(f"Database connection error: {err}")
-        return None
+        seq, services = await allowlist.snapshot()
+    except mysql.connector.Error as e:
+        logger.error("Database error in allowlist_snapshot: %s", e)
+        return jsonify({"error": "database unavailable"}), 503
+    return jsonify({"seq": seq, "services": services})
 
-def is_iranian_ip(ip):
+@app.route("/api/allowlist/changes")
+async def allowlist_changes():
+    if not allowlist_authorized():
+        return Response("Forbidden", status=403)
+    since = request.args.get("since", type=int)
+    if since is None or since < 0:
+        return jsonify({"error": "since must be a non-negative integer"}), 400
     try:
-        api_key = os.getenv("IPGEOLOCATION_API_KEY")
-        if not api_key:
-            logger.error("IPGEOLOCATION_API_KEY not set in .env")
-            return False
-        url = f"https://api.ipgeolocation.io/ipgeo?apiKey={api_key}&ip={ip}&fields=country_code2"
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        logger.info(f"IP check for {ip}: {data}")
-        country_code = data.get("country_code2")
-        if not country_code:
-            logger.warning(f"No country_code2 for IP {ip}")
-            return False
-        return country_code.upper() == "IR"
-    except requests.RequestException as e:
-        logger.error(f"Request error for IP {ip}: {e}")
-        return False
-    except ValueError as e:
-        logger.error(f"JSON decode error for IP {ip}: {e}")
-        return False
+        changes = await allowlist.changes(since)
+    except mysql.connector.Error as e:
+        logger.error("Database error in allowlist_changes: %s", e)
+        return jsonify({"error": "database unavailable"}), 503
+    if changes is None:
+        return jsonify({"error": "changes after since were pruned; fetch a new snapshot"}), 410
+    return jsonify({"changes": changes, "next": changes[-1][0] if changes else since, "more": len(changes) == allowlist.PAGE_SIZE})
 
 @app.route("/register/<service_id>/<telegram_id>")
-def register(service_id, telegram_id):
-    logger.info(f"Register route called with service_id: {service_id}, telegram_id: {telegram_id}")
-    return render_template("register.html", service_id=service_id, telegram_id=telegram_id)
+async def register(service_id, telegram_id):
+    logger.info("Register route called with service_id: %s, telegram_id: %s", service_id, telegram_id)
+    return await render_template("register.html", service_id=service_id, telegram_id=telegram_id)
 
 @app.route("/api/get_client_ip")
-def get_client_ip():
+async def get_client_ip():
     ip = request.remote_addr
-    logger.info(f"Client IP requested: {ip}")
+    logger.info("Client IP requested: %s", ip)
     return jsonify({"ip": ip})
 
 @app.route("/api/register_ip", methods=["POST"])
-def register_ip():
-    data = request.get_json()
+async def register_ip():
+    data = await request.get_json(silent=True) or {}
     ip = data.get("ip")
     service_id = data.get("service_id")
     telegram_id = data.get("telegram_id")
-    logger.info(f"Register IP called with ip: {ip}, service_id: {service_id}, telegram_id: {telegram_id}")
+    logger.info("Register IP called with ip: %s, service_id: %s, telegram_id: %s", ip, service_id, telegram_id)
 
-    time.sleep(1)
-    if not is_iranian_ip(ip):
-        logger.warning(f"IP {ip} is not Iranian")
+    try:
+        iranian = geoip.is_iranian_ip(ip)
+    except geoip.GeoIPUnavailable as e:
+        logger.error("Cannot check IP %s: %s", ip, e)
+        return jsonify({
+            "success": False,
+            "message": "بررسی آی‌پی موقتاً در دسترس نیست، لطفاً چند دقیقه دیگر دوباره امتحان کنید."
+        }), 503
+    if not iranian:
+        logger.warning("IP %s is not Iranian", ip)
         return jsonify({"success": False, "message": "اگر به فیلترشکن متصل هستید، آن را خاموش کنید"})
 
-    time.sleep(1)
-    conn = get_db_connection()
-    if not conn:
-        logger.error("Database connection failed")
-        return jsonify({"success": False, "message": "!خطای سرور"})
-
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE services SET ip_address = %s WHERE service_id = %s AND telegram_id = %s",
-            (ip, service_id, telegram_id)
-        )
-        if cursor.rowcount == 0:
-            logger.warning(f"No rows updated for service_id: {service_id}, telegram_id: {telegram_id}")
-            return jsonify({"success": False, "message": "!سرویس یا کاربر پیدا نشد"})
-        conn.commit()
-        time.sleep(1)
-        logger.info(f"IP {ip} registered successfully for service_id: {service_id}")
-        return jsonify({"success": True, "message": "آی‌پی با موفقیت ثبت شد!"})
+        updated = await allowlist.set_ip(ip, service_id, telegram_id)
     except mysql.connector.Error as e:
-        logger.error(f"Database error: {e}")
+        logger.error("Database error: %s", e)
         return jsonify({"success": False, "message": "مشکلی پیش آمد، لطفاً دوباره امتحان کنید!..."})
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if conn:
-            conn.close()
+    if updated == 0:
+        logger.warning("No rows updated for service_id: %s, telegram_id: %s", service_id, telegram_id)
+        return jsonify({"success": False, "message": "!سرویس یا کاربر پیدا نشد"})
+    await servicecache.invalidate(telegram_id, service_id)
+    logger.info("IP %s registered successfully for service_id: %s", ip, service_id)
+    return jsonify({"success": True, "message": "آی‌پی با موفقیت ثبت شد!"})
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+    app.run(host="127.0.0.1", port=5001)